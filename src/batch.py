@@ -0,0 +1,145 @@
+"""
+Analyse par lot de plusieurs métropoles
+
+- SIREN : une seule lecture du stock national (table des périodes) pour toutes les dates
+- GeoSIREN : une seule passe sur le fichier national, restreinte aux siret d'entrepôts de toutes les dates
+- une seule jointure point / polygone indexée contre les zones d'étude de toutes les métropoles :
+  un point peut appartenir à plusieurs zones qui se recouvrent
+- puis appariement et statistiques par métropole (voir main.compute_year, main.epoch_statistics)
+
+Les métropoles viennent de ENTRY_ROI ou d'un fichier json (même structure) ou csv (name,x,y,depts
+avec les départements séparés par ';').
+"""
+import argparse
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from src.config import *
+from src import metrics
+from src.cache import evict_run
+from src.main import YearResults, collect_task, compute_year, compute_year_task, epoch_statistics
+from src.ingest import read_siren_table
+from src.traitements import TraitementSiren, load_geosiren_sirets, load_ze
+from src.utils import get_year_from_datestring
+from src.metrics import instrument
+import logging
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def load_metros(path: str = None) -> Dict[str, Dict[str, Any]]:
+    """ métropoles à analyser : ENTRY_ROI par défaut, sinon fichier json ou csv """
+    if path is None:
+        return ENTRY_ROI
+
+    if path.endswith(".json"):
+        with open(path) as f:
+            metros = json.load(f)
+        return {name: {"CENTER": tuple(m["CENTER"]), "DEPT_LIST": list(m["DEPT_LIST"])} for name, m in metros.items()}
+
+    df = pd.read_csv(path, dtype={"depts": str})
+    return {
+        row["name"]: {"CENTER": (float(row["x"]), float(row["y"])), "DEPT_LIST": row["depts"].split(";")}
+        for _, row in df.iterrows()
+    }
+
+
+@instrument
+def scan_warehouse_points(metros: Dict[str, Dict[str, Any]],
+                          date_list: List[str]) -> Dict[Tuple[str, str], gpd.GeoDataFrame]:
+    """ Points GeoSIREN d'entrepôts de chaque (métropole, date) en une passe sur les fichiers nationaux.
+
+    Returns:
+        dict: (métropole, date) -> points dans la zone d'étude du rayon maximal (comme SemiJoinGeoSiren).
+    """
+    # SIREN : snapshots de chaque date tirés de la même table des périodes
+    sirets = {
+        date: read_siren_table(TraitementSiren(date, streaming=True), columns=["siret"])["siret"].unique()
+        for date in date_list
+    }
+    all_sirets = np.unique(np.concatenate(list(sirets.values())))
+
+    # zones d'étude de toutes les métropoles et années
+    zones = []
+    for name, metro in metros.items():
+        for date in date_list:
+            ze = load_ze(metro["CENTER"], DIST_RADIUS, name, get_year_from_datestring(date))
+            zones.append(ze[["geometry"]].assign(roi=name, date=date))
+    zones = gpd.GeoDataFrame(pd.concat(zones, ignore_index=True), geometry="geometry", crs=CRS)
+
+    # GeoSIREN : une passe, semi-jointure sur l'ensemble des siret d'entrepôts
+    geosiren = load_geosiren_sirets(all_sirets, zones.total_bounds)
+    geosiren = gpd.GeoDataFrame(
+        geosiren, geometry=gpd.points_from_xy(x=geosiren.x, y=geosiren.y), crs=CRS
+    )
+    logger.info(f"Batch GeoSiren warehouses : {geosiren.shape} for {len(metros)} metros")
+
+    # une jointure indexée : chaque point reçoit toutes les zones qui le contiennent
+    joined = gpd.sjoin(geosiren[["siret", "x", "y", "epsg", "geometry"]], zones, predicate="within", how="inner")
+
+    points = {}
+    for (name, date), group in joined.groupby(["roi", "date"]):
+        group = group[group["siret"].isin(sirets[date])]
+        points[(name, date)] = gpd.GeoDataFrame(
+            group[["siret", "x", "y", "epsg", "geometry"]].reset_index(drop=True), geometry="geometry", crs=CRS
+        )
+    for name, date in itertools.product(metros, date_list):
+        points.setdefault((name, date), gpd.GeoDataFrame(columns=["siret", "x", "y", "epsg", "geometry"], geometry="geometry", crs=CRS))
+    return points
+
+
+def run_batch(metros: Dict[str, Dict[str, Any]],
+              nested: bool = True,
+              workers: int = 1) -> Dict[str, List[pd.DataFrame]]:
+    """ statistiques de toutes les époques pour chaque métropole """
+
+    # workaround
+    date_list = ['-'.join([_, "01-01"]) for _ in SELECTED_YEARS]
+    epochs = list(itertools.combinations(date_list, 2))
+
+    points = scan_warehouse_points(metros, date_list)
+
+    def task_kwargs(name, date):
+        return dict(nested=nested,
+                    centroid=metros[name]["CENTER"],
+                    join_order="siret",
+                    save_geosiren=False,
+                    geosiren_ent=points[(name, date)])
+
+    tasks = list(itertools.product(metros, date_list))
+    if workers <= 1:
+        year_results = {task: compute_year(*task, **task_kwargs(*task)) for task in tasks}
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {task: pool.submit(compute_year_task, *task, **task_kwargs(*task)) for task in tasks}
+            year_results = {task: collect_task(future) for task, future in futures.items()}
+
+    results = {}
+    for name in metros:
+        logger.info(f"===== Statistics for {name} ========")
+        results[name] = [
+            epoch_statistics(name, date_start, date_end, year_results[(name, date_start)], year_results[(name, date_end)])
+            for date_start, date_end in epochs
+        ]
+        metrics.write_report(name)
+    evict_run()
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="logistics sprawl batch analysis over several metros")
+    parser.add_argument("--metros", default=None, help="json or csv file listing metros (default ENTRY_ROI)")
+    parser.add_argument("--workers", type=int, default=1, help="process pool size for (metro, year) tasks")
+    parser.add_argument("--per-radius", action="store_true", help="use AppariementRunner per radius instead of the nested engine")
+    args = parser.parse_args()
+
+    run_batch(load_metros(args.metros), nested=not args.per_radius, workers=args.workers)
@@ -0,0 +1,287 @@
+"""
+Benchmarks des étapes du pipeline sur données synthétiques
+
+- appariement SIREN / BDTOPO : boucle historique vs requête sur index spatial
+- stockage des couches intermédiaires : GeoParquet vs GPKG, écriture / lecture par étape
+- suite des étapes (TraitementSiren ... compute_statistics) sur un jeu synthétique à chaque échelle,
+  comparée aux temps de référence de reports/benchmarks/baseline.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely import box
+
+from src.config import *
+from src.synthetic import SYNTHETIC_CENTER, SYNTHETIC_ROI, generate_dataset, synthetic_communes
+from src.stats import compute_statistics
+from src.traitements import (
+    AppSirenBDTopo,
+    JoinSirenGeosiren,
+    TraitementGeoSiren,
+    TraitementSiren,
+    get_communes_from_radius,
+    nearest_bati_matching,
+)
+from src.utils import check_dir, get_year_from_datestring, make_path, read_layer, write_layer
+import logging
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def synthetic_matching_layers(n_points: int,
+                              n_bati: int,
+                              extent: float = 25_000.0,
+                              seed: int = 0):
+    """ points SIREN et bâtiments rectangulaires aléatoires autour d'un centre fictif """
+    rng = np.random.default_rng(seed)
+    x0, y0 = 841650.0, 6517765.0
+
+    bx = x0 + rng.uniform(-extent, extent, n_bati)
+    by = y0 + rng.uniform(-extent, extent, n_bati)
+    w = rng.uniform(10, 80, n_bati)
+    h = rng.uniform(10, 80, n_bati)
+    bati_indus = gpd.GeoDataFrame(
+        {"ID": [f"BATIMENT{i:010d}" for i in range(n_bati)]},
+        geometry=box(bx, by, bx + w, by + h),
+        crs=CRS,
+    )
+
+    # moitié des points près d'un bâtiment, moitié au hasard
+    near = rng.integers(0, n_bati, n_points // 2)
+    px = np.concatenate([bx[near] + rng.normal(0, 40, near.size), x0 + rng.uniform(-extent, extent, n_points - near.size)])
+    py = np.concatenate([by[near] + rng.normal(0, 40, near.size), y0 + rng.uniform(-extent, extent, n_points - near.size)])
+    entrepots_siren = gpd.GeoDataFrame(
+        {"siret": np.arange(n_points)},
+        geometry=gpd.points_from_xy(px, py),
+        crs=CRS,
+    )
+    return entrepots_siren, bati_indus
+
+
+def _legacy_nearest_loop(entrepots_siren: gpd.GeoDataFrame,
+                         bati_indus: gpd.GeoDataFrame,
+                         max_distance: float) -> pd.DataFrame:
+    """ reproduction de la boucle historique de AppSirenBDTopo (référence) """
+    rows = []
+    for idx, point in enumerate(entrepots_siren.geometry):
+        distances = bati_indus.geometry.distance(point)
+        nearest_bat = distances.idxmin()
+        if distances[nearest_bat] < max_distance:
+            rows.append((idx, nearest_bat, distances[nearest_bat]))
+    return pd.DataFrame(rows, columns=["point_index", "bati_index", "distance"])
+
+
+def bench_matching(n_points: int = 10_000,
+                   n_bati: int = 20_000,
+                   max_distance: float = 50.0) -> Dict[str, float]:
+    entrepots_siren, bati_indus = synthetic_matching_layers(n_points, n_bati)
+
+    start = time.perf_counter()
+    legacy = _legacy_nearest_loop(entrepots_siren, bati_indus, max_distance)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    matches = nearest_bati_matching(entrepots_siren, bati_indus, max_distance)
+    indexed_time = time.perf_counter() - start
+
+    identical = (
+        legacy[["point_index", "bati_index"]].to_numpy().tolist()
+        == matches[["point_index", "bati_index"]].to_numpy().tolist()
+    )
+    result = {
+        "n_points": n_points,
+        "n_bati": n_bati,
+        "n_matches": len(matches),
+        "legacy_s": round(legacy_time, 4),
+        "indexed_s": round(indexed_time, 4),
+        "speedup": round(legacy_time / indexed_time, 1),
+        "identical": identical,
+    }
+    logger.info(f"Matching benchmark : {result}")
+    return result
+
+
+def bench_storage(n_points: int = 100_000, n_bati: int = 100_000) -> pd.DataFrame:
+    """ temps d'écriture / lecture des couches de chaque étape sous GeoParquet et GPKG """
+    entrepots_siren, bati_indus = synthetic_matching_layers(n_points, n_bati)
+    communes = synthetic_communes(np.random.default_rng(0), n_communes=900)
+    layers = {
+        "ze": communes[["geometry"]].dissolve(),
+        "communes": communes,
+        "geosiren": entrepots_siren.assign(x=entrepots_siren.geometry.x, y=entrepots_siren.geometry.y, epsg=CRS),
+        "entrepots": entrepots_siren.iloc[: max(1, n_points // 10)],
+        "bati_indus": bati_indus,
+        "appariement": bati_indus.iloc[: max(1, n_bati // 20)],
+    }
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for stage, gdf in layers.items():
+            for ext in (".parquet", ".gpkg"):
+                path = os.path.join(tmp_dir, f"{stage}{ext}")
+
+                start = time.perf_counter()
+                write_layer(gdf, path, index=False)
+                write_s = time.perf_counter() - start
+
+                start = time.perf_counter()
+                read_layer(path)
+                read_s = time.perf_counter() - start
+
+                rows.append({
+                    "stage": stage,
+                    "format": ext[1:],
+                    "rows": len(gdf),
+                    "write_s": round(write_s, 4),
+                    "read_s": round(read_s, 4),
+                    "size_mb": round(os.path.getsize(path) / 1e6, 2),
+                })
+
+    result = pd.DataFrame(rows)
+    logger.info(f"Storage benchmark :\n{result.to_string(index=False)}")
+    return result
+
+
+# nombre de lignes du stock SIREN synthétique de chaque échelle de la suite
+BENCHMARK_SCALES = [10_000, 100_000, 1_000_000]
+# échelles nationales (plusieurs Go de disque et de mémoire), lancées seulement sur demande (--large)
+BENCHMARK_LARGE_SCALES = [10_000_000, 30_000_000]
+# écart toléré par rapport à la référence, et en deçà duquel un écart est du bruit (s)
+BENCHMARK_TOLERANCE = 0.25
+BENCHMARK_NOISE_S = 0.05
+
+
+def bench_stages(n_rows: int, seed: int = 0) -> Dict[str, float]:
+    """ temps de chaque étape du pipeline sur un jeu synthétique de n_rows lignes SIREN.
+
+    Le jeu est écrit dans le répertoire des données courant, qui doit être redirigé (LOGISTICS_SPRAWL_DATA).
+    Les étapes sont chronométrées sur la première année (cache vide), la seconde sert à compute_statistics.
+    """
+    generate_dataset(n_rows, seed=seed)
+    date_t0, date_t1 = [f"{year}-01-01" for year in (SELECTED_YEARS[0], SELECTED_YEARS[-1])]
+
+    timings = {}
+
+    def timed(stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings[stage] = timings.get(stage, 0.0) + round(time.perf_counter() - start, 4)
+        return result
+
+    results = {}
+    for date in (date_t0, date_t1):
+        year = get_year_from_datestring(date)
+        run = timed if date == date_t0 else (lambda stage, func, *args, **kwargs: func(*args, **kwargs))
+
+        siren_path = run("TraitementSiren", TraitementSiren, date)
+        geosiren_path = run("TraitementGeoSiren", TraitementGeoSiren, SYNTHETIC_CENTER, SYNTHETIC_ROI, year)
+        merged_path = run("JoinSirenGeosiren", JoinSirenGeosiren, siren_path, geosiren_path, year, SYNTHETIC_ROI, DIST_RADIUS)
+        warehouses = run("AppSirenBDTopo", AppSirenBDTopo, SYNTHETIC_ROI, merged_path, year, DIST_RADIUS)
+        communes = run("get_communes_from_radius", get_communes_from_radius,
+                       SYNTHETIC_CENTER, DIST_RADIUS, SYNTHETIC_ROI, year, columns=True)
+        results[date] = (warehouses, communes)
+
+    timed("compute_statistics", compute_statistics,
+          wh_t0=results[date_t0][0], wh_t1=results[date_t1][0],
+          communes_t0=results[date_t0][1], communes_t1=results[date_t1][1],
+          name=SYNTHETIC_ROI, period=(get_year_from_datestring(date_t0), get_year_from_datestring(date_t1)))
+
+    logger.info(f"Stages benchmark {n_rows} rows : {timings}")
+    return timings
+
+
+def _compare(current: Dict[str, Dict[str, float]],
+             baseline: Dict[str, Dict[str, float]],
+             tolerance: float = BENCHMARK_TOLERANCE,
+             noise_s: float = BENCHMARK_NOISE_S) -> pd.DataFrame:
+    """ temps de chaque (échelle, étape) face à la référence : régression au-delà de tolerance et de noise_s """
+    rows = []
+    for scale, timings in current.items():
+        for stage, seconds in timings.items():
+            reference = baseline.get(scale, {}).get(stage)
+            regression = (
+                reference is not None
+                and seconds > reference * (1 + tolerance)
+                and seconds - reference > noise_s
+            )
+            rows.append({"rows": int(scale), "stage": stage, "seconds": seconds,
+                         "baseline": reference, "regression": regression})
+    return pd.DataFrame(rows)
+
+
+def run_suite(scales: Sequence[int] = BENCHMARK_SCALES,
+              update_baseline: bool = False,
+              seed: int = 0) -> pd.DataFrame:
+    """ Suite des étapes à chaque échelle, chacune dans un processus et un répertoire de données temporaire.
+
+    Les temps sont comparés à reports/benchmarks/baseline.json (régression au-delà de BENCHMARK_TOLERANCE) ;
+    update_baseline remplace la référence des échelles mesurées.
+    """
+    bench_dir = check_dir(project_path, "reports", "benchmarks")
+    baseline_path = make_path("baseline.json", bench_dir)
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    current = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for n_rows in scales:
+            out_path = os.path.join(tmp_dir, f"stages_{n_rows}.json")
+            env = {**os.environ, DATA_DIR_ENV: os.path.join(tmp_dir, f"data_{n_rows}")}
+            subprocess.run([sys.executable, "-m", "src.benchmark", "--bench", "stages",
+                            "--rows", str(n_rows), "--seed", str(seed), "--out", out_path],
+                           env=env, check=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            with open(out_path) as f:
+                current[str(n_rows)] = json.load(f)
+
+    result = _compare(current, baseline)
+    result.to_csv(make_path("last_run.csv", bench_dir), index=False)
+    logger.info(f"Stages benchmark :\n{result.to_string(index=False)}")
+
+    if result["regression"].any():
+        logger.warning(f"Regressions : {result.loc[result['regression'], ['rows', 'stage']].values.tolist()}")
+    if update_baseline:
+        with open(baseline_path, "w") as f:
+            json.dump({**baseline, **current}, f, indent=2)
+        logger.info(f"Baseline updated : {baseline_path}")
+    return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="benchmarks logistics sprawl")
+    parser.add_argument("--points", type=int, default=10_000)
+    parser.add_argument("--bati", type=int, default=20_000)
+    parser.add_argument("--bench", choices=["matching", "storage", "stages", "suite"], default="matching")
+    parser.add_argument("--rows", type=int, default=10_000, help="SIREN rows of the synthetic dataset (stages)")
+    parser.add_argument("--scales", type=int, nargs="+", default=BENCHMARK_SCALES, help="SIREN rows of each scale (suite)")
+    parser.add_argument("--large", action="store_true", help="add the national scales BENCHMARK_LARGE_SCALES (suite)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="json output of the stage timings (stages)")
+    parser.add_argument("--update-baseline", action="store_true", help="store the suite timings as reference")
+    args = parser.parse_args()
+
+    if args.bench == "matching":
+        bench_matching(n_points=args.points, n_bati=args.bati)
+    elif args.bench == "storage":
+        bench_storage(n_points=args.points, n_bati=args.bati)
+    elif args.bench == "stages":
+        timings = bench_stages(args.rows, seed=args.seed)
+        if args.out:
+            with open(args.out, "w") as f:
+                json.dump(timings, f)
+    else:
+        scales = args.scales + [s for s in BENCHMARK_LARGE_SCALES if s not in args.scales] if args.large else args.scales
+        result = run_suite(scales, update_baseline=args.update_baseline, seed=args.seed)
+        sys.exit(int(result["regression"].any()))
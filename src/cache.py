@@ -0,0 +1,262 @@
+"""
+Cache des étapes du pipeline adressé par contenu
+
+Chaque sortie d'étape est nommée avec une clé (hash) de ses paramètres et de ses entrées :
+un changement de paramètre (rayon, centre, distance d'appariement, seuil de surface...) ou
+de fichier d'entrée produit une nouvelle clé au lieu de servir un résultat périmé.
+
+Une fiche de provenance <sortie>.meta.json accompagne chaque sortie ; elle sert aussi à
+l'éviction LRU qui borne la taille de data/processed (CACHE_MAX_BYTES). L'éviction est faite une fois
+en fin d'exécution (evict_run), après les pools : les sorties lues ou écrites pendant l'exécution,
+y compris par les autres processus, sont conservées.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+from uuid import uuid4
+from typing import Any, Dict, List, Sequence
+
+import pandas as pd
+
+from src import metrics
+from src.config import CACHE_MAX_BYTES, processed_data_path
+from src.utils import make_path
+import logging
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+META_SUFFIX = ".meta.json"
+
+# début de l'exécution : les sorties utilisées depuis sont protégées de l'éviction (voir evict_run)
+_RUN_START = time.time()
+
+
+def _meta_path(path: str) -> str:
+    return path + META_SUFFIX
+
+
+def _size(path: str) -> int:
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(r, f)) for r, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def fingerprint(obj: Any) -> Dict[str, Any]:
+    """ empreinte d'une entrée d'étape.
+
+    - sortie déjà en cache : sa clé (chaînage des clés d'étape en étape)
+    - fichier ou répertoire brut : taille et date de modification
+    - table en mémoire : hash des lignes
+    """
+    if isinstance(obj, pd.DataFrame):
+        frame = pd.DataFrame(obj.drop(columns="geometry", errors="ignore"))
+        if "geometry" in obj:
+            frame["wkb"] = obj.geometry.to_wkb()
+        return {"frame": hashlib.sha256(pd.util.hash_pandas_object(frame, index=False).values.tobytes()).hexdigest()}
+
+    path = str(obj)
+    if os.path.exists(_meta_path(path)):
+        with open(_meta_path(path)) as f:
+            return {"path": os.path.basename(path), "key": json.load(f)["key"]}
+    if os.path.isdir(path):
+        files = sorted(os.path.join(r, f) for r, _, fs in os.walk(path) for f in fs)
+        stats = [(os.path.relpath(f, path), os.stat(f).st_size, os.stat(f).st_mtime_ns) for f in files]
+        return {"path": path, "files": hashlib.sha256(json.dumps(stats).encode()).hexdigest()}
+    if os.path.exists(path):
+        stat = os.stat(path)
+        return {"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    return {"path": path, "missing": True}
+
+
+def _key(stage: str, params: Dict[str, Any], fingerprints: List[Dict[str, Any]]) -> str:
+    payload = {"stage": stage, "params": params, "inputs": fingerprints}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
+def stage_key(stage: str, params: Dict[str, Any], inputs: Sequence[Any]) -> str:
+    """ clé d'une étape : hash de son nom, de ses paramètres et des empreintes de ses entrées """
+    return _key(stage, params, [fingerprint(i) for i in inputs])
+
+
+def keyed_name(file_name: str, key: str) -> str:
+    """ SIREN_Entrepots_2008-01-01.csv -> SIREN_Entrepots_2008-01-01_<key>.csv """
+    stem, ext = os.path.splitext(file_name)
+    return f"{stem}_{key}{ext}"
+
+
+class CacheEntry:
+    """ sortie d'une étape identifiée par ses paramètres et ses entrées
+
+    Args:
+        stage (str): nom de l'étape.
+        file_name (str): nom de fichier de la sortie, complété par la clé.
+        out_dir (str): répertoire de la sortie.
+        params (dict): paramètres de l'étape (sérialisables json).
+        inputs (list): chemins ou tables en mémoire lus par l'étape.
+    """
+    def __init__(self,
+                 stage: str,
+                 file_name: str,
+                 out_dir: str,
+                 params: Dict[str, Any],
+                 inputs: Sequence[Any] = ()):
+        self.stage = stage
+        self.params = params
+        self.inputs = [fingerprint(i) for i in inputs]
+        self.key = _key(stage, params, self.inputs)
+        self.path = make_path(keyed_name(file_name, self.key), out_dir)
+
+    def hit(self) -> bool:
+        """ sortie présente : met à jour la date du dernier accès (LRU) """
+        if not (os.path.exists(self.path) and os.path.exists(_meta_path(self.path))):
+            logger.info(f"Cache miss {self.stage} : {os.path.basename(self.path)}")
+            metrics.cache_event(False)
+            return False
+        try:
+            # au mieux : d'autres processus peuvent lire la même sortie au même moment
+            meta = _read_meta(self.path)
+            meta["last_access"] = time.time()
+            _write_meta(self.path, meta)
+        except (OSError, ValueError):
+            logger.warning(f"Cache last access not updated : {os.path.basename(self.path)}")
+        logger.info(f"Cache hit {self.stage} : {os.path.basename(self.path)}")
+        metrics.cache_event(True)
+        return True
+
+    def commit(self) -> str:
+        """ enregistre la provenance de la sortie écrite (éviction en fin d'exécution, voir evict_run) """
+        now = time.time()
+        _write_meta(self.path, {
+            "stage": self.stage,
+            "key": self.key,
+            "params": self.params,
+            "inputs": self.inputs,
+            "created": now,
+            "last_access": now,
+            "size": _size(self.path),
+        })
+        return self.path
+
+
+def rekey(path: str, inputs: List[Dict[str, Any]]) -> str:
+    """ ré-enregistre une sortie dont le contenu reste valide pour de nouvelles entrées (voir src/refresh.py).
+
+    La sortie est liée (ou copiée) sous la clé calculée avec les nouvelles empreintes d'entrées,
+    l'ancienne sortie reste en place jusqu'à son éviction.
+    """
+    meta = _read_meta(path)
+    key = _key(meta["stage"], meta["params"], inputs)
+    stem, ext = os.path.splitext(os.path.basename(path))
+    base_name = stem[: -len(meta["key"]) - 1] + ext if stem.endswith("_" + meta["key"]) else stem + ext
+    new_path = make_path(keyed_name(base_name, key), os.path.dirname(path))
+
+    if not os.path.exists(new_path):
+        if os.path.isdir(path):
+            shutil.copytree(path, new_path)
+        else:
+            try:
+                os.link(path, new_path)
+            except OSError:
+                shutil.copy2(path, new_path)
+    now = time.time()
+    _write_meta(new_path, {**meta, "key": key, "inputs": inputs, "created": now, "last_access": now, "rekeyed_from": meta["key"]})
+    return new_path
+
+
+def _read_meta(path: str) -> Dict[str, Any]:
+    with open(_meta_path(path)) as f:
+        return json.load(f)
+
+
+def _write_meta(path: str, meta: Dict[str, Any]) -> None:
+    # fichier temporaire propre à l'écriture : plusieurs processus peuvent mettre à jour la même fiche
+    tmp = f"{_meta_path(path)}.{os.getpid()}.{uuid4().hex}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(meta, f, indent=2, default=str)
+        os.replace(tmp, _meta_path(path))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def cache_entries(root: str = processed_data_path) -> List[Dict[str, Any]]:
+    """ fiches de provenance des sorties en cache sous root """
+    entries = []
+    for r, _, files in os.walk(root):
+        for f in files:
+            if f.endswith(META_SUFFIX):
+                path = os.path.join(r, f[:-len(META_SUFFIX)])
+                try:
+                    meta = _read_meta(path)
+                except (OSError, ValueError):
+                    continue
+                entries.append({**meta, "path": path})
+    return entries
+
+
+def _inode(path: str) -> Any:
+    """ identifiant du contenu : les liens physiques créés par rekey partagent le même """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path
+    return path if os.path.isdir(path) else (stat.st_dev, stat.st_ino)
+
+
+def evict(max_bytes: int = CACHE_MAX_BYTES,
+          root: str = processed_data_path,
+          keep: Sequence[str] = (),
+          keep_since: float = None) -> List[str]:
+    """ supprime les sorties les moins récemment utilisées tant que le cache dépasse max_bytes.
+
+    Seules les sorties avec fiche de provenance sont concernées (les extractions BDTOPO ne le sont pas).
+    Les sorties de keep et celles utilisées depuis keep_since sont conservées. Un contenu partagé par
+    plusieurs liens physiques n'est compté qu'une fois, et libéré à la suppression de son dernier lien.
+    """
+    if max_bytes is None:
+        return []
+    entries = sorted(cache_entries(root), key=lambda e: e.get("last_access", 0))
+    links, sizes = {}, {}
+    for entry in entries:
+        entry["inode"] = _inode(entry["path"])
+        links[entry["inode"]] = links.get(entry["inode"], 0) + 1
+        sizes[entry["inode"]] = entry.get("size", 0)
+    total = sum(sizes.values())
+    removed = []
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if entry["path"] in keep or (keep_since is not None and entry.get("last_access", 0) >= keep_since):
+            continue
+        remove(entry["path"])
+        links[entry["inode"]] -= 1
+        if not links[entry["inode"]]:
+            total -= sizes[entry["inode"]]
+        removed.append(entry["path"])
+    if removed:
+        logger.info(f"Cache eviction : {len(removed)} entries removed")
+    return removed
+
+
+def evict_run(max_bytes: int = CACHE_MAX_BYTES, root: str = processed_data_path) -> List[str]:
+    """ éviction de fin d'exécution : une seule passe, sorties utilisées pendant l'exécution conservées """
+    return evict(max_bytes=max_bytes, root=root, keep_since=_RUN_START)
+
+
+def remove(path: str) -> None:
+    """ supprime une sortie en cache et sa fiche de provenance (déjà supprimées : ignoré) """
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    try:
+        os.remove(_meta_path(path))
+    except FileNotFoundError:
+        pass
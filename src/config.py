@@ -26,12 +26,47 @@ ENTRY_ROI = {
 
 project_path = os.path.dirname(find_dotenv())
 
-data_path = os.path.join(project_path, "data/")
-raw_data_path = os.path.join(project_path, "data/raw")
-processed_data_path = os.path.join(project_path, "data/processed")
+# le répertoire des données peut être redirigé (ex. données synthétiques des benchmarks - see src/synthetic.py)
+DATA_DIR_ENV = "LOGISTICS_SPRAWL_DATA"
+data_path = os.environ.get(DATA_DIR_ENV, os.path.join(project_path, "data/"))
+raw_data_path = os.path.join(data_path, "raw")
+processed_data_path = os.path.join(data_path, "processed")
+
+# taille maximale des sorties d'étapes en cache dans data/processed (éviction LRU) - see src/cache.py
+CACHE_MAX_BYTES = 50 * 1024**3
+
+# métriques des étapes (temps, mémoire, lignes, cache, octets) et rapport reports/<roi>/run_metrics_* - see src/metrics.py
+METRICS_ENABLED = os.environ.get("LOGISTICS_SPRAWL_METRICS", "1") != "0"
+
+"""STORAGE"""
+# format des couches intermédiaires : "parquet" (GeoParquet, WKB + colonne bbox) ou "gpkg"
+# le GPKG reste disponible à l'export (src.utils.export_layer)
+STORAGE_FORMAT = "parquet"
+LAYER_EXT = {"parquet": ".parquet", "gpkg": ".gpkg"}[STORAGE_FORMAT]
+
+"""STATISTICS"""
+# intervalles de confiance par bootstrap de Poisson des entrepôts (mode incertitude) - see src/stats.py
+BOOTSTRAP_SAMPLES = 2000
+BOOTSTRAP_ALPHA = 0.05
 
 """BDTOPO PARAMETERS"""
 URL_BDTOPO = "https://geoservices.ign.fr/bdtopo"
+# téléchargements : taille des blocs écrits (octets), départements en parallèle, timeout (s)
+DOWNLOAD_CHUNK_SIZE = 8 << 20
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_TIMEOUT = 60
+# couches BDTOPO extraites des archives (bâti industriel avant 2023, bâtiments 2023, communes)
+BDTOPO_LAYERS = ["BATI_INDUSTRIEL", "BATIMENT", "COMMUNE"]
+# bâtiments d'entrepôt de la nomenclature 2023 (couche BATIMENT) : nature, usage principal ou secondaire
+BDTOPO_NATURE_INDUS = "Industriel, agricole ou commercial"
+BDTOPO_USAGE_INDUS = "Industriel"
+BDTOPO_USAGE_COMMERCE = "Commercial et services"
+SHP_EXTENSIONS = [".shp", ".shx", ".dbf", ".prj", ".cpg"]
+# lecture des couches des départements en parallèle
+READ_WORKERS = 4
+# décompressions simultanées, archives téléchargées et pas encore lues (contre-pression du pipeline)
+EXTRACT_WORKERS = 2
+MAX_PENDING_ARCHIVES = 3
 
 
 # Chemins vers le dossier des fichiers BDTOPO communes
@@ -39,25 +74,41 @@ URL_BDTOPO = "https://geoservices.ign.fr/bdtopo"
 
 # chemins bati indus & communes for roi and year
 bati_indus_roi_dir = os.path.join(processed_data_path, "{}", "{}", "BDTOPO") #name, year
-bati_indus_file_name = "bati_indus_{}_{}.gpkg"
+bati_indus_file_name = "bati_indus_{}_{}" + LAYER_EXT
 
 communes_roi_dir = os.path.join(processed_data_path, "{}", "{}", "BDTOPO") #name, year
-communes_roi_file_name = "communes_{}_{}.gpkg" #name, #year
+communes_roi_file_name = "communes_{}_{}" + LAYER_EXT #name, #year
 
 
 """ZE"""
 # buffer area on communes intersection
-ze_name = "ze_{}_{}km.gpkg"
+ze_name = "ze_{}_{}km" + LAYER_EXT
 #ze_com_path = os.path.join(processed_data_path, "{}", {},"ZoneEtude")
 
 """entrepots"""
-warehouse_name = "Entrepots_{}_{}_{}km.gpkg"
+warehouse_name = "Entrepots_{}_{}_{}km" + LAYER_EXT
 #warehouse_path = os.path.join(processed_data_path, "{}", "ZoneEtude")
 
 
 
 """entrepots appariees"""
-appariement_name = "Entrepots_{}_{}_{}km_app.gpkg"
+appariement_name = "Entrepots_{}_{}_{}km_app" + LAYER_EXT
+# table siret -> bâtiment (ID BDTOPO, distance, type d'appariement) de l'appariement
+appariement_matches_name = "Entrepots_{}_{}_{}km_matches.parquet"
+
+"""index des bâtiments"""
+# répertoire de l'index persistant d'une couche de bâtiments (voir src/spatial_index.py), capacité des noeuds
+building_index_name = "bati_index_{}"
+BUILDING_INDEX_NODE_SIZE = 16
+
+"""liens entre millésimes"""
+# bâtiments d'entrepôt reliés entre deux millésimes BDTOPO (voir src/linking.py) : roi, année début, année fin, rayon
+building_links_name = "liens_bati_{}_{}_{}_{}km.parquet"
+# recouvrement (IoU) minimal d'un lien géométrique, et au-delà duquel un bâtiment relié est inchangé
+LINK_MIN_IOU = 0.5
+# recouvrement minimal d'un lien par ID (écarte les ID réutilisés et les candidats sur emprise seule)
+LINK_MIN_ID_IOU = 0.1
+LINK_PERSISTENT_IOU = 0.9
 #appariement_path = os.path.join(processed_data_path, "{}", "ZoneEtude")
 
 
@@ -67,6 +118,30 @@ appariement_name = "Entrepots_{}_{}_{}km_app.gpkg"
 GeosirenFPath = os.path.join(raw_data_path, "SIREN", "GeolocalisationEtablissement_Sirene_pour_etudes_statistiques_utf8.csv")
 SirenFPath = os.path.join(raw_data_path, "SIREN", "StockEtablissementHistorique_utf8.csv")
 
+# IN (ingest) : jeux Parquet partitionnés issus des csv - see src/ingest.py
+# SIREN partitionné par nomenclature / préfixe du code d'activité, GeoSIREN par tuile Lambert 93
+SirenParquetPath = os.path.join(raw_data_path, "SIREN", "StockEtablissementHistorique_parquet")
+GeosirenParquetPath = os.path.join(raw_data_path, "SIREN", "GeolocalisationEtablissement_parquet")
+GEOSIREN_TILE_SIZE = 100_000
+# jointure GeoSIREN hors mémoire (TraitementGeoSiren tiled) : côté des tuiles de la grille (m), processus,
+# activée par défaut avec LOGISTICS_SPRAWL_GEOSIREN_TILED=1
+GEOSIREN_JOIN_TILE_SIZE = 10_000
+GEOSIREN_WORKERS = 4
+GEOSIREN_TILED = os.environ.get("LOGISTICS_SPRAWL_GEOSIREN_TILED", "0") != "0"
+
+# Codes d'activité des entrepôts par nomenclature (préfixes)
+WAREHOUSE_CODES = {
+    "NAP": ["73.07", "73.08"],
+    "NAF1993": ["63.1D", "63.1E"],
+    "NAFRev1": ["63.1D", "63.1E"],
+    "NAFRev2": ["52.1"],
+}
+# lecture par blocs du stock SIREN (nombre de lignes)
+SIREN_CHUNKSIZE = 1_000_000
+
 # OUT : 
-geosiren_name = "GeoSiren_{}_{}km.gpkg"
-siren_name = "SIREN_Entrepots_{}.csv"
\ No newline at end of file
+geosiren_name = "GeoSiren_{}_{}km" + LAYER_EXT
+geosiren_ent_name = "GeoSiren_Entrepots_{}_{}km" + LAYER_EXT
+# tables SIREN au schéma compact (siret entier, codes catégoriels, dates) - see src/ingest.py
+siren_name = "SIREN_Entrepots_{}.parquet"
+siren_periods_name = "SIREN_Entrepots_periodes.parquet"
\ No newline at end of file
@@ -14,16 +14,23 @@ import os
 import numpy as np 
 import folium
 from shapely import Point
+import py7zr
 from py7zr import unpack_7zarchive
 from pathlib import Path
 import shutil
 import requests
-import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from bs4 import BeautifulSoup
-from typing import List, Dict, Any
-from src.utils import check_dir, timeit
+from typing import List, Dict, Any, Optional
+from src.utils import check_dir, write_layer
 
 from src.config import *
+from src import metrics
+from src.metrics import instrument
+from src.spatial_index import building_index
 
 import logging
 
@@ -31,10 +38,10 @@ logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level
 logger = logging.getLogger(__name__)
 
 
-def _download(url) -> requests.Response: 
+def _download(url) -> bytes: 
     try:
-        res = requests.get(url)
-    except:
+        res = requests.get(url, timeout=DOWNLOAD_TIMEOUT)
+    except requests.RequestException:
         raise requests.HTTPError("url not valid")
     if res.status_code == 200:
         return res.content
@@ -42,24 +49,89 @@ def _download(url) -> requests.Response:
         raise requests.HTTPError("Download Fail")
 
 
-def download_html(url) -> requests.Response: 
+def download_html(url) -> bytes: 
     return _download(url)
-    
-def download_7z(url, out_dir) -> str:
+
+
+@lru_cache(maxsize=None)
+def fetch_index(url: str) -> bytes:
+    """ page d'index des archives BDTOPO, téléchargée une seule fois par exécution """
+    logger.info(f"Fetch index {url}")
+    return download_html(url)
+
+
+def _file_md5(path: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def download_file(url: str,
+                  out_path: str,
+                  md5: Optional[str] = None,
+                  chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> str:
+    """ Téléchargement en flux par blocs vers <out_path>.part, repris par requête Range si interrompu.
+
+    La taille reçue est vérifiée contre Content-Length / Content-Range, et le md5 s'il est fourni.
+    La mémoire utilisée reste celle d'un bloc quelle que soit la taille de l'archive.
+    """
+    part_path = out_path + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    try:
+        res = requests.get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+    except requests.RequestException:
+        raise requests.HTTPError("url not valid")
+
+    with res:
+        if res.status_code == 416 and offset:
+            # plage demandée au-delà de la fin : le fichier partiel est déjà complet
+            expected = offset
+        elif res.status_code == 206:
+            expected = int(res.headers["Content-Range"].rsplit("/", 1)[-1])
+        elif res.status_code == 200:
+            # serveur sans support des plages : on repart de zéro
+            offset = 0
+            expected = int(res.headers["Content-Length"]) if "Content-Length" in res.headers else None
+        else:
+            raise requests.HTTPError(f"Download Fail ({res.status_code})")
+
+        if res.status_code != 416:
+            if offset:
+                logger.info(f"resume {os.path.basename(out_path)} at {offset} bytes")
+            with open(part_path, "ab" if offset else "wb") as out:
+                for chunk in res.iter_content(chunk_size=chunk_size):
+                    out.write(chunk)
+
+    size = os.path.getsize(part_path)
+    if expected is not None and size != expected:
+        raise requests.HTTPError(f"incomplete download {url} : {size} / {expected} bytes")
+    if md5 is not None and _file_md5(part_path) != md5.lower():
+        os.remove(part_path)
+        raise requests.HTTPError(f"checksum mismatch for {url}")
+
+    os.replace(part_path, out_path)
+    return out_path
+
+
+def download_7z(url, out_dir, md5: Optional[str] = None) -> str:
     logger.info(f"Go to to {url}")
-    content =  _download(url)
-    out_path = os.path.join(out_dir, os.path.basename(url))
-    with open(out_path, 'wb') as out:
-        out.write(content)
+    out_path = download_file(url, os.path.join(out_dir, os.path.basename(url)), md5=md5)
     logger.info(f"{out_path} downloaded !")
     return out_path
 
 
+def _hrefs(content) -> List[str]:
+    soup = BeautifulSoup(content, "html.parser")
+    return [_["href"] for _ in soup.find_all('a', href=True)]
+
 
 def parse_html(content, dept: str, year: int, format="SHP") -> str:
     
-    soup = BeautifulSoup(content, "html.parser")
-    hrefs = [_["href"] for _ in soup.find_all('a', href=True)]
+    hrefs = _hrefs(content)
     
     code_dept = dept.zfill(3)
     pattern = f"D{code_dept}_{year}"
@@ -75,27 +147,41 @@ def parse_html(content, dept: str, year: int, format="SHP") -> str:
     return href[0]
 
 
+def parse_md5(content, href: str) -> Optional[str]:
+    """ somme md5 publiée à côté de l'archive dans l'index (<archive>.md5), si elle existe """
+    md5_href = [_ for _ in _hrefs(content) if _ in (href + ".md5", os.path.splitext(href)[0] + ".md5")]
+    if not md5_href:
+        return None
+    return download_html(md5_href[0]).decode().split()[0]
+
+
 def download_bdtopo(out_dir:str,
                     dept: str, 
                     year: int, 
                     url:str, 
                     format="SHP") -> str:
     
-    content = download_html(url)
+    content = fetch_index(url)
     
     href = parse_html(content, dept, year)
     
     out_path = os.path.join(out_dir, os.path.basename(href))
     
     if not os.path.exists(out_path):
-        out_path = download_7z(href, out_dir)
+        out_path = download_7z(href, out_dir, md5=parse_md5(content, href))
     else:
         logger.info(f"skip download for {dept} on {year}")
     return out_path
 
 
+def extract_7z(arch_path, out_dir, selective: bool = True) -> str: 
+    """ décompresse une archive BDTOPO.
 
-def extract_7z(arch_path, out_dir) -> str: 
+    selective : seules les couches lues par le pipeline (BDTOPO_LAYERS) sont extraites, 
+    dans un répertoire compact <out_dir>/layers/<archive> ; sinon l'archive complète est dépaquetée.
+    """
+    if selective:
+        return extract_7z_layers(arch_path, check_dir(out_dir, "layers"))
     
     fname = Path(arch_path).stem
     out_path = os.path.join(out_dir, fname)
@@ -111,6 +197,48 @@ def extract_7z(arch_path, out_dir) -> str:
     return out_path
 
 
+def select_members(names: List[str],
+                   layers: List[str] = BDTOPO_LAYERS,
+                   extensions: List[str] = SHP_EXTENSIONS) -> List[str]:
+    """ membres de l'archive appartenant aux jeux de fichiers shapefile des couches voulues """
+    layers = {l.upper() for l in layers}
+    extensions = {e.lower() for e in extensions}
+    return [
+        n for n in names
+        if Path(n).stem.upper() in layers and Path(n).suffix.lower() in extensions
+    ]
+
+
+def extract_7z_layers(arch_path, out_dir) -> str:
+    """ liste l'archive et n'écrit que les membres des couches utiles.
+
+    Les archives BDTOPO sont solides (un bloc compressé pour tous les membres) : py7zr décompresse quand même
+    le bloc jusqu'au dernier membre demandé, le gain porte sur l'écriture et la place disque, pas sur le temps
+    de décompression.
+    """
+    fname = Path(arch_path).stem
+    out_path = os.path.join(out_dir, fname)
+    done_flag = os.path.join(out_path, ".extracted")
+
+    if not os.path.exists(done_flag):
+
+        logger.info(f"selective extraction process... {arch_path}")
+        with py7zr.SevenZipFile(arch_path, mode="r") as archive:
+            targets = select_members(archive.getnames())
+            if not targets:
+                raise ValueError(f"no {BDTOPO_LAYERS} layers in {arch_path}")
+            archive.extract(path=out_dir, targets=targets)
+
+        if not os.path.isdir(out_path):
+            # archive sans répertoire racine à son nom
+            check_dir(out_path)
+        open(done_flag, "w").close()
+        logger.info(f"extracted {len(targets)} members in {out_path}")
+    else:
+        logger.info(f"Archive already extracted : {out_path}")
+    return out_path
+
+
 def extract_bati_path(dir_path) -> str:
     
     target_bati_dir = ["E_BATI", "BATI"]
@@ -125,20 +253,33 @@ def extract_bati_path(dir_path) -> str:
     return target_dir_path
 
 
-def _extract_bati_new_bdtopo(list_path) -> List[gpd.GeoDataFrame]: 
+def _with_crs(df: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """ couche sans projection déclarée (.prj absent) : CRS du projet """
+    return df if df.crs is not None else df.set_crs(CRS, allow_override=True)
+
+
+def _extract_bati_new_bdtopo(list_path, bbox=None) -> List[gpd.GeoDataFrame]: 
     """
     for nomenclature >= bdtopo 2023
+    filtre attributaire, colonnes et emprise poussés au moteur de lecture (pyogrio)
     """
     
-    nature = "Industriel, agricole ou commercial"
-    usage = "Industriel"
-    usage1b = "Commercial et services"
+    nature = BDTOPO_NATURE_INDUS
+    usage = BDTOPO_USAGE_INDUS
+    usage1b = BDTOPO_USAGE_COMMERCE
     logger.info("new nomenclature")
     list_df = []
     columns = ["ID", "NATURE", "geometry"]
     columns_extend = columns + ["USAGE1", "USAGE2"]
-
-    gen_df = (gpd.read_file(path, crs=CRS)[columns_extend] for path in list_path) 
+    where = (
+        f"NATURE = '{nature}' AND "
+        f"(USAGE1 = '{usage}' OR (USAGE1 = '{usage1b}' AND USAGE2 = '{usage}'))"
+    )
+
+    gen_df = (
+        _with_crs(gpd.read_file(path, bbox=bbox, columns=["ID", "NATURE", "USAGE1", "USAGE2"], where=where))[columns_extend] 
+        for path in list_path
+    ) 
     
     for df in gen_df:
         list_df.append(
@@ -150,21 +291,21 @@ def _extract_bati_new_bdtopo(list_path) -> List[gpd.GeoDataFrame]:
     return list_df
  
 
-def _extract_bati_old_bdtopo(list_path: List[str]) -> List[gpd.GeoDataFrame]: 
+def _extract_bati_old_bdtopo(list_path: List[str], bbox=None) -> List[gpd.GeoDataFrame]: 
     logger.info(list_path)
     columns = ["ID", "NATURE", "geometry"]
-    list_df = [gpd.read_file(path, crs=CRS)[columns] for path in list_path]
+    list_df = [_with_crs(gpd.read_file(path, bbox=bbox, columns=["ID", "NATURE"]))[columns] for path in list_path]
     return list_df
     
     
-def extract_bati_indus(list_path: List[str], year: str) -> List[gpd.GeoDataFrame]: 
+def extract_bati_indus(list_path: List[str], year: str, bbox=None) -> List[gpd.GeoDataFrame]: 
     
     years_new_nomenclature = ["2023"]
     
     if year in years_new_nomenclature:
-        return _extract_bati_new_bdtopo(list_path)
+        return _extract_bati_new_bdtopo(list_path, bbox=bbox)
     else:
-        return _extract_bati_old_bdtopo(list_path)
+        return _extract_bati_old_bdtopo(list_path, bbox=bbox)
 
     
 
@@ -176,7 +317,8 @@ def extract_bati_on_roi(path: str, roi: gpd.GeoDataFrame, year: str) -> gpd.GeoD
     
     target_f_path = [os.path.join(path, f) for f in os.listdir(path) if (Path(f).stem in target_prefix_f) and f.lower().endswith(target_suffix_f)]
     
-    list_df = extract_bati_indus(target_f_path, year)
+    # seuls les bâtiments de l'emprise de la zone d'étude sont lus
+    list_df = extract_bati_indus(target_f_path, year, bbox=tuple(roi.total_bounds))
     
     list_df = [gpd.sjoin(df, roi, how="inner", predicate="within").drop("index_right", axis=1) for df in list_df]
     df_y = pd.concat(list_df)
@@ -195,18 +337,112 @@ def extract_communes_on_roi(path: str, roi: gpd.GeoDataFrame) -> gpd.GeoDataFram
     """
     extracts communes which intersects roi buffer
     """
-    df = gpd.read_file(path, crs=CRS)
+    df = _with_crs(gpd.read_file(path, bbox=tuple(roi.total_bounds)))
     df = gpd.sjoin(df, roi, how="inner", predicate="intersects").drop("index_right", axis=1)
     return df
 
 
-@timeit
+def department_mask(communes: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """ emprise des communes d'un département dans la zone d'étude (vide si aucune commune) """
+    if communes.empty:
+        return communes[["geometry"]]
+    return communes[["geometry"]].dissolve()
+
+
+def extract_bati_on_department(path: str, mask: gpd.GeoDataFrame, year: str) -> gpd.GeoDataFrame:
+    """ bâtiments d'un département touchant ses communes de la zone d'étude.
+
+    Pré-filtre indépendant des autres départements : le filtre définitif (within de l'union de toutes
+    les communes, comme extract_bati_on_roi) est appliqué une fois tous les départements lus.
+    """
+    if mask.empty or mask.geometry.isna().all():
+        # département sans commune dans la zone d'étude : emprise vide, rien à lire
+        return gpd.GeoDataFrame(columns=["ID", "NATURE", "geometry"], geometry="geometry", crs=CRS)
+
+    target_prefix_f = ["BATI_INDUSTRIEL", "BATIMENT"]
+    target_f_path = [os.path.join(path, f) for f in os.listdir(path) if (Path(f).stem in target_prefix_f) and f.lower().endswith(".shp")]
+
+    list_df = extract_bati_indus(target_f_path, year, bbox=tuple(mask.total_bounds))
+    list_df = [gpd.sjoin(df, mask, how="inner", predicate="intersects").drop("index_right", axis=1) for df in list_df]
+    return pd.concat(list_df)
+
+
+class DepartmentPipeline:
+    """ Téléchargement, décompression et lecture des départements en flux.
+
+    Chaque étape a son pool (réseau, décompression, lecture) : le département suivant se télécharge
+    pendant que le précédent se décompresse et qu'un troisième est lu et filtré.
+    Au plus max_pending archives sont en cours (téléchargées ou décompressées mais pas encore lues).
+
+    Args:
+        out_dir (str): répertoire des archives.
+        year (str): millésime BDTOPO.
+        roi (gpd.GeoDataFrame): zone d'étude (buffer du centre).
+        url (str, optional): index des archives. Defaults to URL_BDTOPO.
+    """
+    def __init__(self,
+                 out_dir: str,
+                 year: str,
+                 roi: gpd.GeoDataFrame,
+                 url: str = URL_BDTOPO,
+                 format: str = "SHP",
+                 download_workers: int = DOWNLOAD_WORKERS,
+                 extract_workers: int = EXTRACT_WORKERS,
+                 read_workers: int = READ_WORKERS,
+                 max_pending: int = MAX_PENDING_ARCHIVES):
+        self.out_dir = out_dir
+        self.year = year
+        self.roi = roi
+        self.url = url
+        self.format = format
+        # workaround for 2023 new nomenclature - flr
+        self.ext_file = ".SHP" if year != "2023" else ".shp"
+        self.workers = (download_workers, extract_workers, read_workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+
+    @staticmethod
+    def _step(pool, name: str, dept: str, func, *args):
+        """ étape d'un département exécutée (et mesurée) dans le thread du pool, avec les étiquettes de l'appelant """
+        def run():
+            with metrics.stage(f"DepartmentPipeline.{name}", dept=dept):
+                return func(*args)
+        return pool.submit(metrics.bind(run)).result()
+
+    def _department(self, dept: str, download_pool, extract_pool, read_pool) -> Dict[str, Any]:
+        with self.pending:
+            arch_path = self._step(download_pool, "download", dept, download_bdtopo, self.out_dir, dept, self.year, self.url, self.format)
+            bd_path = self._step(extract_pool, "extract", dept, extract_7z, arch_path, self.out_dir)
+            logger.info(f"work on {bd_path}")
+
+            communes_path = extract_communes_path(bd_path, self.ext_file)
+            communes = self._step(read_pool, "communes", dept, extract_communes_on_roi, communes_path, self.roi)
+            bati = self._step(read_pool, "bati", dept, extract_bati_on_department, extract_bati_path(bd_path), department_mask(communes), self.year)
+        logger.info(f"department {dept} : {len(communes)} communes, {len(bati)} buildings")
+        return {"dept": dept, "path": bd_path, "communes": communes, "bati": bati}
+
+    def run(self, dept_list: List[str]) -> List[Dict[str, Any]]:
+        if not dept_list:
+            return []
+        # index lu une seule fois avant les téléchargements concurrents
+        fetch_index(self.url)
+        n_download, n_extract, n_read = self.workers
+        with ThreadPoolExecutor(max_workers=n_download) as download_pool, \
+             ThreadPoolExecutor(max_workers=n_extract) as extract_pool, \
+             ThreadPoolExecutor(max_workers=n_read) as read_pool, \
+             ThreadPoolExecutor(max_workers=len(dept_list)) as dept_pool:
+            # étiquettes du thread appelant (roi, année) transmises aux tâches du pool
+            department = metrics.bind(self._department)
+            futures = [dept_pool.submit(department, dept, download_pool, extract_pool, read_pool) for dept in dept_list]
+            return [future.result() for future in futures]
+
+
+@instrument
 def pipeline_bdtopo_year(dept_list: List[str],
                     name_roi: str,
                     year: str, 
                     centroid: tuple,
                     format="SHP", 
-                    clean_dir=True) -> None:
+                    clean_dir=False) -> None:
     
     """download industrial building from bdtopo
 
@@ -216,52 +452,42 @@ def pipeline_bdtopo_year(dept_list: List[str],
         year (str): list years
         centroid (tuple): point of interest
         format (str, optional): files format for bdtopo. Defaults to "SHP".
-        clean_dir (bool, optional): clean bdtopo full directories. Defaults to True.
+        clean_dir (bool, optional): clean bdtopo extracted directories (only needed layers are extracted). Defaults to False.
     """
 
+    if not dept_list:
+        raise ValueError(f"no department for {name_roi} ({year})")
+
     out_dir_raw = check_dir(raw_data_path, name_roi, year, "BDTOPO")
     out_dir_processed = check_dir(bati_indus_roi_dir.format(name_roi, year))
 
-    # workaround for 2023 new nomenclature - flr
-    ext_file = ".SHP" if year !="2023" else ".shp"
-
     # define roi
     roi = gpd.GeoDataFrame(geometry=[Point(centroid)], crs=CRS).buffer(DIST_RADIUS).to_frame()
 
-    paths_bati = []
-    paths_communes = []
-    
-    for dept in dept_list:
-
-        # download bdtopo
-        arch_path = download_bdtopo(out_dir_raw, dept, year, URL_BDTOPO, format=format)
-        bd_path = extract_7z(arch_path, out_dir_raw)
-        logger.info(f"work on {bd_path}")
-        # extract building on roi
-        paths_bati.append(extract_bati_path(bd_path))
-        # extract communes on roi
-        paths_communes.append(extract_communes_path(bd_path, ext_file))
+    # téléchargement, décompression et lecture des départements en flux
+    departments = DepartmentPipeline(out_dir_raw, year, roi, URL_BDTOPO, format=format).run(dept_list)
 
     logger.info("-- Process buildings and communes --")
-
-    # extract building and communes
-    communes = [extract_communes_on_roi(path, roi) for path in paths_communes]
-    communes = pd.concat(communes)
+    communes = pd.concat([d["communes"] for d in departments])
 
     # define unary_union roi based on communes
     rio_com_union = gpd.sjoin(communes[["geometry"]], roi, how="inner", predicate="intersects").drop("index_right", axis=1).dissolve()
-    
-    # extract building on communes
-    bati =[extract_bati_on_roi(path, rio_com_union[["geometry"]], year) for path in paths_bati]
-    bati = pd.concat(bati)
+
+    # filtre définitif des bâtiments pré-filtrés par département
+    bati = pd.concat([d["bati"] for d in departments])
+    bati = gpd.sjoin(bati, rio_com_union[["geometry"]], how="inner", predicate="within").drop("index_right", axis=1)
 
     # Save
-    bati.to_crs(CRS).to_file(os.path.join(out_dir_processed, bati_indus_file_name.format(name_roi, year)))
-    communes.to_crs(CRS).to_file(os.path.join(out_dir_processed, communes_roi_file_name.format(name_roi, year)))
+    bati_path = write_layer(bati.to_crs(CRS), os.path.join(out_dir_processed, bati_indus_file_name.format(name_roi, year)))
+    write_layer(communes.to_crs(CRS), os.path.join(out_dir_processed, communes_roi_file_name.format(name_roi, year)))
+
+    # index spatial persistant des bâtiments, ouvert par les étapes d'appariement
+    building_index(bati_path)
 
     logger.info(f"year {year} done")
     if clean_dir: 
-        shutil.rmtree(bd_path)
+        for d in departments:
+            shutil.rmtree(d["path"])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,294 @@
+"""
+Conversion unique des csv SIREN et GeoSIREN en jeux Parquet partitionnés
+
+- SIREN : partitions hive nomenclature / prefixe (2 premiers caractères du code d'activité)
+- GeoSIREN : points Lambert 93 uniquement, partitions hive tile_x / tile_y (GEOSIREN_TILE_SIZE)
+
+Les lectures ne chargent que les partitions et colonnes utiles (voir read_siren_parquet, read_geosiren_parquet).
+
+Schéma compact SIREN (SIREN_SCHEMA), conservé de l'ingestion jusqu'à la jointure avec GeoSIREN :
+siret entier, codes d'activité et nomenclature catégoriels (dictionnaire), dates datetime64.
+"""
+import argparse
+import csv
+import os
+import shutil
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from src.config import *
+from src.metrics import instrument
+import logging
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+# taille des blocs lus dans les csv (octets)
+CSV_BLOCK_SIZE = 64 << 20
+
+# colonnes SIREN lues par le pipeline et leur type compact
+SIREN_SCHEMA = pa.schema([
+    ("siret", pa.int64()),
+    ("activitePrincipaleEtablissement", pa.dictionary(pa.int32(), pa.string())),
+    ("nomenclatureActivitePrincipaleEtablissement", pa.dictionary(pa.int32(), pa.string())),
+    ("dateDebut", pa.timestamp("s")),
+    ("dateFin", pa.timestamp("s")),
+])
+SIREN_CODE_COLUMNS = ["activitePrincipaleEtablissement", "nomenclatureActivitePrincipaleEtablissement"]
+SIREN_DATE_COLUMNS = ["dateDebut", "dateFin"]
+# lecture pandas des csv SIREN : les dates sont converties ensuite avec un format fixe
+SIREN_CSV_DTYPES = {"siret": "int64", **{c: "category" for c in SIREN_CODE_COLUMNS}, **{c: str for c in SIREN_DATE_COLUMNS}}
+
+
+def typed_siren(siren: pd.DataFrame) -> pd.DataFrame:
+    """ SIREN au schéma compact, quelle que soit la source (csv texte, Parquet typé ou non).
+
+    Les colonnes déjà typées ne sont pas converties ; les dates invalides deviennent NaT.
+    """
+    siren = siren.copy(deep=False)
+    if "siret" in siren and siren["siret"].dtype != "int64":
+        siren["siret"] = siren["siret"].astype("int64")
+    for c in SIREN_CODE_COLUMNS:
+        if c in siren and not isinstance(siren[c].dtype, pd.CategoricalDtype):
+            siren[c] = siren[c].astype("category")
+    for c in SIREN_DATE_COLUMNS:
+        if c in siren and not pd.api.types.is_datetime64_any_dtype(siren[c]):
+            siren[c] = pd.to_datetime(siren[c], errors="coerce", format="%Y-%m-%d")
+    return siren
+
+
+def read_siren_table(path: str, columns: Sequence[str] = None) -> pd.DataFrame:
+    """ table SIREN intermédiaire (périodes, entrepôts à une date) écrite par write_siren_table """
+    return typed_siren(pd.read_parquet(path, columns=None if columns is None else list(columns)))
+
+
+def siren_arrow_table(siren: pd.DataFrame) -> pa.Table:
+    """ table arrow au schéma SIREN_SCHEMA (blocs successifs d'un même fichier Parquet compris) """
+    return pa.Table.from_pandas(typed_siren(siren)[SIREN_SCHEMA.names], schema=SIREN_SCHEMA, preserve_index=False)
+
+
+def write_siren_table(siren: pd.DataFrame, path: str) -> str:
+    """ écrit une table SIREN au schéma compact (Parquet, types conservés) """
+    pq.write_table(siren_arrow_table(siren), path)
+    return path
+
+
+def _csv_header(path: str, sep: str) -> List[str]:
+    with open(path, newline="", encoding="utf-8") as f:
+        return next(csv.reader(f, delimiter=sep))
+
+
+def _hive_values(path: str, root: str) -> Dict[str, str]:
+    """ clés/valeurs hive d'un fichier du jeu partitionné """
+    parts = os.path.relpath(os.path.dirname(path), root).split(os.sep)
+    return dict(p.split("=", 1) for p in parts if "=" in p)
+
+
+def _select_files(root: str, predicate: Callable[[Dict[str, str]], bool]) -> List[str]:
+    """ élagage des partitions sur les valeurs de chemin, avant toute lecture """
+    dataset = ds.dataset(root, format="parquet", partitioning="hive")
+    return [f for f in dataset.files if predicate(_hive_values(f, root))]
+
+
+def _write_partitioned(batches: Iterator[pa.RecordBatch],
+                       schema: pa.Schema,
+                       out_dir: str,
+                       partition_schema: pa.Schema) -> str:
+    tmp_dir = out_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    ds.write_dataset(
+        batches,
+        tmp_dir,
+        schema=schema,
+        format="parquet",
+        partitioning=ds.partitioning(partition_schema, flavor="hive"),
+        max_partitions=4096,
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+@instrument
+def ingest_siren(csv_path: str = SirenFPath, out_dir: str = SirenParquetPath) -> str:
+    """ Convertit le stock SIREN en Parquet partitionné par nomenclature et préfixe d'activité.
+
+    siret est stocké en entier, les dates en timestamp (dates invalides à null), les autres colonnes
+    en texte (les codes sont relus en dictionnaire, voir read_siren_parquet). La lecture se fait par blocs.
+
+    Args:
+        csv_path (str, optional): csv du stock établissements. Defaults to SirenFPath.
+        out_dir (str, optional): répertoire du jeu Parquet. Defaults to SirenParquetPath.
+
+    Returns:
+        str: répertoire du jeu Parquet.
+    """
+    logger.info(f"Ingest Siren file {csv_path}")
+    columns = _csv_header(csv_path, ",")
+
+    reader = pv.open_csv(
+        csv_path,
+        read_options=pv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        convert_options=pv.ConvertOptions(column_types={c: pa.int64() if c == "siret" else pa.string() for c in columns}),
+    )
+    schema = reader.schema
+    for c in SIREN_DATE_COLUMNS:
+        schema = schema.set(schema.get_field_index(c), pa.field(c, SIREN_SCHEMA.field(c).type))
+    schema = schema.append(pa.field("nomenclature", pa.string())).append(pa.field("prefixe", pa.string()))
+
+    def batches():
+        for batch in reader:
+            activity = batch.column("activitePrincipaleEtablissement")
+            arrays = [
+                pc.strptime(col, format="%Y-%m-%d", unit="s", error_is_null=True) if name in SIREN_DATE_COLUMNS else col
+                for name, col in zip(batch.schema.names, batch.columns)
+            ]
+            yield pa.RecordBatch.from_arrays(
+                arrays + [
+                    batch.column("nomenclatureActivitePrincipaleEtablissement"),
+                    pc.utf8_slice_codeunits(activity, start=0, stop=2),
+                ],
+                schema=schema,
+            )
+
+    partition_schema = pa.schema([("nomenclature", pa.string()), ("prefixe", pa.string())])
+    out_dir = _write_partitioned(batches(), schema, out_dir, partition_schema)
+    logger.info(f"Siren parquet : {out_dir}")
+    return out_dir
+
+
+@instrument
+def ingest_geosiren(csv_path: str = GeosirenFPath,
+                    out_dir: str = GeosirenParquetPath,
+                    tile_size: int = GEOSIREN_TILE_SIZE) -> str:
+    """ Convertit GeoSIREN en Parquet partitionné par tuile Lambert 93.
+
+    Seules les lignes en EPSG:2154 sont conservées, comme dans TraitementGeoSiren ; siret est entier comme dans SIREN.
+
+    Args:
+        csv_path (str, optional): csv de géolocalisation. Defaults to GeosirenFPath.
+        out_dir (str, optional): répertoire du jeu Parquet. Defaults to GeosirenParquetPath.
+        tile_size (int, optional): côté d'une tuile en mètres. Defaults to GEOSIREN_TILE_SIZE.
+
+    Returns:
+        str: répertoire du jeu Parquet.
+    """
+    logger.info(f"Ingest GeoSiren file {csv_path}")
+
+    reader = pv.open_csv(
+        csv_path,
+        read_options=pv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        parse_options=pv.ParseOptions(delimiter=";"),
+        convert_options=pv.ConvertOptions(
+            include_columns=["siret", "x", "y", "epsg"],
+            column_types={"siret": pa.int64(), "x": pa.float64(), "y": pa.float64(), "epsg": pa.int32()},
+        ),
+    )
+    schema = reader.schema.append(pa.field("tile_x", pa.int32())).append(pa.field("tile_y", pa.int32()))
+
+    def batches():
+        for batch in reader:
+            mask = pc.and_(
+                pc.equal(batch.column("epsg"), CRS),
+                pc.and_(pc.is_valid(batch.column("x")), pc.is_valid(batch.column("y"))),
+            )
+            batch = batch.filter(mask)
+            yield pa.RecordBatch.from_arrays(
+                batch.columns + [
+                    pc.cast(pc.floor(pc.divide(batch.column("x"), float(tile_size))), pa.int32()),
+                    pc.cast(pc.floor(pc.divide(batch.column("y"), float(tile_size))), pa.int32()),
+                ],
+                schema=schema,
+            )
+
+    partition_schema = pa.schema([("tile_x", pa.int32()), ("tile_y", pa.int32())])
+    out_dir = _write_partitioned(batches(), schema, out_dir, partition_schema)
+    logger.info(f"GeoSiren parquet : {out_dir}")
+    return out_dir
+
+
+def read_siren_parquet(columns: Sequence[str],
+                       codes: dict = WAREHOUSE_CODES,
+                       root: str = SirenParquetPath) -> pd.DataFrame:
+    """ Lit uniquement les partitions SIREN pouvant contenir des codes d'entrepôts, au schéma compact.
+
+    Le filtre fin sur les codes reste à appliquer (voir traitements.filter_warehouses).
+    """
+    def keep(values: Dict[str, str]) -> bool:
+        nomenclature, prefixe = values.get("nomenclature", ""), values.get("prefixe", "")
+        return any(
+            nomenclature.startswith(nom) and any(code[:2] == prefixe for code in prefixes)
+            for nom, prefixes in codes.items()
+        )
+
+    files = _select_files(root, keep)
+    logger.info(f"Siren parquet : {len(files)} files selected")
+    if not files:
+        return typed_siren(pd.DataFrame(columns=list(columns)))
+    parquet_format = ds.ParquetFileFormat(read_options=ds.ParquetReadOptions(dictionary_columns=SIREN_CODE_COLUMNS))
+    dataset = ds.dataset(files, format=parquet_format, partitioning="hive", partition_base_dir=root)
+    return typed_siren(dataset.to_table(columns=list(columns)).to_pandas(date_as_object=False))
+
+
+def geosiren_parquet_files(bounds: Sequence[float],
+                           tile_size: int = GEOSIREN_TILE_SIZE,
+                           root: str = GeosirenParquetPath) -> List[str]:
+    """ fichiers des tuiles GeoSIREN intersectant bounds (minx, miny, maxx, maxy) """
+    minx, miny, maxx, maxy = bounds
+    tiles_x = range(int(np.floor(minx / tile_size)), int(np.floor(maxx / tile_size)) + 1)
+    tiles_y = range(int(np.floor(miny / tile_size)), int(np.floor(maxy / tile_size)) + 1)
+
+    def keep(values: Dict[str, str]) -> bool:
+        return int(values["tile_x"]) in tiles_x and int(values["tile_y"]) in tiles_y
+
+    files = _select_files(root, keep)
+    logger.info(f"GeoSiren parquet : {len(files)} files selected")
+    return files
+
+
+def read_geosiren_parquet(bounds: Optional[Sequence[float]] = None,
+                          columns: Sequence[str] = ("siret", "x", "y", "epsg"),
+                          tile_size: int = GEOSIREN_TILE_SIZE,
+                          root: str = GeosirenParquetPath) -> pd.DataFrame:
+    """ Lit les points GeoSIREN des tuiles intersectant bounds (minx, miny, maxx, maxy).
+
+    Les tuiles hors emprise ne sont pas ouvertes, le filtre x/y est poussé aux row groups.
+    """
+    if bounds is None:
+        dataset = ds.dataset(root, format="parquet", partitioning="hive")
+        return dataset.to_table(columns=list(columns)).to_pandas()
+
+    minx, miny, maxx, maxy = bounds
+    files = geosiren_parquet_files(bounds, tile_size, root)
+    if not files:
+        return pd.DataFrame(columns=list(columns))
+    dataset = ds.dataset(files, format="parquet", partitioning="hive", partition_base_dir=root)
+    row_filter = (
+        (ds.field("x") >= minx) & (ds.field("x") <= maxx)
+        & (ds.field("y") >= miny) & (ds.field("y") <= maxy)
+    )
+    return dataset.to_table(columns=list(columns), filter=row_filter).to_pandas()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="ingest SIREN / GeoSIREN csv to partitioned parquet")
+    parser.add_argument("--siren", action="store_true", help="convert SIREN stock")
+    parser.add_argument("--geosiren", action="store_true", help="convert GeoSIREN")
+    args = parser.parse_args()
+
+    run_all = not (args.siren or args.geosiren)
+    if args.siren or run_all:
+        ingest_siren()
+    if args.geosiren or run_all:
+        ingest_geosiren()
@@ -0,0 +1,242 @@
+"""
+Liens entre bâtiments d'entrepôt de deux millésimes BDTOPO
+
+Les entrepôts de chaque année sont appariés indépendamment (NestedRadiusEngine / AppSirenBDTopo) ;
+ce module relie les bâtiments d'une année à l'autre :
+- candidats : bâtiments de l'autre millésime intersectant chaque entrepôt (index persistant, voir src/spatial_index.py)
+- lien par ID BDTOPO lorsque l'ID est conservé entre les millésimes (pas à travers le changement de nomenclature 2023)
+  et que les bâtiments se recouvrent d'au moins LINK_MIN_ID_IOU
+- sinon lien par recouvrement (IoU) au-delà de LINK_MIN_IOU
+- appariement un à un glouton : liens par ID d'abord, puis par IoU décroissant, chaque couple retenu
+  retire ses deux bâtiments des candidats restants (voir greedy_links)
+
+Statut de chaque entrepôt : persistent (IoU >= LINK_PERSISTENT_IOU), modified (relié, emprise modifiée),
+new (sans bâtiment relié l'année précédente), demolished (sans bâtiment relié l'année suivante).
+warehouse_before / warehouse_after indiquent si le bâtiment relié est aussi un entrepôt l'autre année.
+"""
+import argparse
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from src.config import *
+from src import metrics
+from src.cache import CacheEntry, evict_run
+from src.radius import NestedRadiusEngine
+from src.spatial_index import BuildingIndex, building_index
+from src.traitements import bati_indus_file
+from src.utils import check_dir, make_path
+from src.metrics import instrument
+import logging
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+LINK_STATUS = ["persistent", "modified", "new", "demolished"]
+
+
+def _candidates(warehouses: gpd.GeoDataFrame, other: BuildingIndex) -> Tuple[np.ndarray, np.ndarray]:
+    """ couples (position de l'entrepôt dans sa couche, position du bâtiment de l'autre couche) qui s'intersectent """
+    q, positions = other.query(warehouses.geometry.values, predicate="intersects")
+    return warehouses.index.values[q], positions
+
+
+def greedy_links(candidates: pd.DataFrame) -> pd.DataFrame:
+    """ appariement un à un glouton : liens par ID puis IoU décroissant ; un couple n'est retenu que si
+    ses deux bâtiments sont encore libres, un bâtiment dont le meilleur candidat est pris garde les suivants.
+
+    Un seul tri, puis des passes vectorisées : chaque passe retient les couples qui sont le premier candidat
+    restant de leurs deux bâtiments (ils le seraient aussi dans la boucle gloutonne) et retire leurs bâtiments.
+    L'ordre étant total, le résultat est celui de la boucle gloutonne ; chaque passe retient au moins le
+    premier couple restant, le nombre de passes est celui des chaînes de candidats (quelques unités).
+    """
+    ordered = (
+        candidates.assign(priority=(candidates["link"] == "id").astype(int))
+        .sort_values(["priority", "iou"], ascending=False, kind="stable")
+        .drop(columns="priority")
+    )
+    code_before, uniques_before = pd.factorize(ordered["bati_before"].values)
+    code_after, uniques_after = pd.factorize(ordered["bati_after"].values)
+    n = len(ordered)
+    alive = np.ones(n, dtype=bool)
+    keep = []
+    while alive.any():
+        rows = np.flatnonzero(alive)
+        first_before = np.full(len(uniques_before), n)
+        first_after = np.full(len(uniques_after), n)
+        np.minimum.at(first_before, code_before[rows], rows)
+        np.minimum.at(first_after, code_after[rows], rows)
+        dominant = rows[(first_before[code_before[rows]] == rows) & (first_after[code_after[rows]] == rows)]
+        keep.append(dominant)
+
+        used_before = np.zeros(len(uniques_before), dtype=bool)
+        used_after = np.zeros(len(uniques_after), dtype=bool)
+        used_before[code_before[dominant]] = True
+        used_after[code_after[dominant]] = True
+        alive &= ~used_before[code_before] & ~used_after[code_after]
+    return ordered.iloc[np.sort(np.concatenate(keep)) if keep else []]
+
+
+@instrument
+def link_buildings(before: gpd.GeoDataFrame,
+                   after: gpd.GeoDataFrame,
+                   index_before: BuildingIndex,
+                   index_after: BuildingIndex,
+                   min_iou: float = LINK_MIN_IOU,
+                   persistent_iou: float = LINK_PERSISTENT_IOU,
+                   min_id_iou: float = LINK_MIN_ID_IOU) -> pd.DataFrame:
+    """ Relie les entrepôts de deux millésimes et les classe.
+
+    Args:
+        before (gpd.GeoDataFrame): entrepôts de la première année, index : position dans sa couche bati_indus.
+        after (gpd.GeoDataFrame): entrepôts de la seconde année, idem.
+        index_before (BuildingIndex): index des bâtiments de la première année.
+        index_after (BuildingIndex): index des bâtiments de la seconde année.
+        min_iou (float, optional): recouvrement minimal d'un lien géométrique. Defaults to LINK_MIN_IOU.
+        persistent_iou (float, optional): recouvrement d'un bâtiment inchangé. Defaults to LINK_PERSISTENT_IOU.
+        min_id_iou (float, optional): recouvrement minimal d'un lien par ID. Defaults to LINK_MIN_ID_IOU.
+
+    Returns:
+        pandas.DataFrame: une ligne par entrepôt ou couple relié : bati_before, bati_after (positions),
+        ID_before, ID_after, warehouse_before, warehouse_after, link (id / iou), iou, area_before, area_after, status.
+    """
+    # couples candidats dans les deux sens, sans doublon
+    b_pos, a_pos = _candidates(before, index_after)
+    a_pos2, b_pos2 = _candidates(after, index_before)
+    pairs = pd.DataFrame({
+        "bati_before": np.concatenate([b_pos, b_pos2]),
+        "bati_after": np.concatenate([a_pos, a_pos2]),
+    }).drop_duplicates().reset_index(drop=True)
+    metrics.rows(rows_in=len(before) + len(after))
+
+    geom_before = index_before.geometries(pairs["bati_before"].values)
+    geom_after = index_after.geometries(pairs["bati_after"].values)
+    inter = shapely.area(shapely.intersection(geom_before, geom_after))
+    area_before, area_after = shapely.area(geom_before), shapely.area(geom_after)
+    pairs["iou"] = inter / (area_before + area_after - inter)
+
+    ids_before = index_before.attributes(["ID"])["ID"].values if "ID" in before else None
+    ids_after = index_after.attributes(["ID"])["ID"].values if "ID" in after else None
+    same_id = np.zeros(len(pairs), dtype=bool)
+    if ids_before is not None and ids_after is not None:
+        same_id = ids_before[pairs["bati_before"].values] == ids_after[pairs["bati_after"].values]
+    iou = pairs["iou"].values
+    pairs["link"] = np.where(same_id & (iou >= min_id_iou), "id", np.where(iou >= min_iou, "iou", ""))
+
+    # un lien par bâtiment : ID d'abord, puis meilleur recouvrement
+    links = greedy_links(pairs[pairs["link"] != ""])
+    links = links[links["bati_before"].isin(before.index) | links["bati_after"].isin(after.index)]
+
+    demolished = pd.DataFrame({"bati_before": before.index.difference(links["bati_before"]).values})
+    new = pd.DataFrame({"bati_after": after.index.difference(links["bati_after"]).values})
+    table = pd.concat([links, demolished, new], ignore_index=True)
+    table["bati_before"] = table["bati_before"].astype("Int64")
+    table["bati_after"] = table["bati_after"].astype("Int64")
+
+    table["status"] = pd.Categorical(
+        np.select(
+            [table["bati_after"].isna(), table["bati_before"].isna(), table["iou"] >= persistent_iou],
+            ["demolished", "new", "persistent"],
+            "modified",
+        ),
+        categories=LINK_STATUS,
+    )
+    table["warehouse_before"] = table["bati_before"].isin(before.index)
+    table["warehouse_after"] = table["bati_after"].isin(after.index)
+
+    has_before, has_after = table["bati_before"].notna().values, table["bati_after"].notna().values
+    pos_before = table["bati_before"].fillna(0).astype(np.int64).values
+    pos_after = table["bati_after"].fillna(0).astype(np.int64).values
+    table["area_before"] = np.where(has_before, shapely.area(index_before.geometries(pos_before)), np.nan)
+    table["area_after"] = np.where(has_after, shapely.area(index_after.geometries(pos_after)), np.nan)
+    if ids_before is not None:
+        table["ID_before"] = np.where(has_before, ids_before[pos_before], None)
+    if ids_after is not None:
+        table["ID_after"] = np.where(has_after, ids_after[pos_after], None)
+
+    logger.info(f"Building links : {table['status'].value_counts().to_dict()}")
+    metrics.rows(rows_out=len(table))
+    return table
+
+
+def link_summary(links: pd.DataFrame) -> pd.DataFrame:
+    """ nombre et surfaces des entrepôts par statut """
+    area = links["area_after"].where(links["status"] != "demolished", links["area_before"])
+    return (
+        links.assign(area=area)
+        .groupby("status", observed=False)
+        .agg(number_ware=("status", "size"), area=("area", "sum"))
+        .reset_index()
+    )
+
+
+@instrument
+def LinkWarehouses(roi_name: str,
+                   centroid: Tuple[float],
+                   year_before: str,
+                   year_after: str,
+                   r: int = DIST_RADIUS,
+                   **engine_kwargs) -> pd.DataFrame:
+    """ Liens des entrepôts de la zone d'étude de rayon r entre deux millésimes (mis en cache).
+
+    Returns:
+        pandas.DataFrame: table de link_buildings.
+    """
+    engines = [
+        NestedRadiusEngine(date_analysis=f"{year}-01-01", centroid=centroid, roi_name=roi_name, **engine_kwargs)
+        for year in (year_before, year_after)
+    ]
+    name = engines[0].roi_name
+    bati_paths = [bati_indus_file(name, year) for year in (year_before, year_after)]
+    out_dir = check_dir(processed_data_path, name, "Liens")
+    cache = CacheEntry("building_links", building_links_name.format(name, year_before, year_after, int(r/1000)), out_dir,
+                       params={"r": r, "min_iou": LINK_MIN_IOU, "persistent_iou": LINK_PERSISTENT_IOU, "min_id_iou": LINK_MIN_ID_IOU,
+                               "dist_siren_bdtopo": engines[0].dist_siren_bdtopo, "seuil_surf_ent": engines[0].seuil_surf_ent},
+                       inputs=[engines[0].merged_siren_path(), engines[1].merged_siren_path(), *bati_paths])
+
+    if not cache.hit():
+        warehouses = [engine.warehouses(r) for engine in engines]
+        indexes = [building_index(path) for path in bati_paths]
+        links = link_buildings(warehouses[0], warehouses[1], indexes[0], indexes[1])
+        links.to_parquet(cache.path, index=False)
+        cache.commit()
+        return links
+
+    logger.info("Load building links")
+    return pd.read_parquet(cache.path)
+
+
+def link_years(roi_name: str,
+               years: List[str] = SELECTED_YEARS,
+               r: int = DIST_RADIUS,
+               centroid: Tuple[float] = None) -> pd.DataFrame:
+    """ résumé des liens entre millésimes successifs, enregistré dans reports/<roi> """
+    centroid = ENTRY_ROI[roi_name]["CENTER"] if centroid is None else centroid
+    summaries = []
+    with metrics.tags(roi=roi_name):
+        for year_before, year_after in zip(years[:-1], years[1:]):
+            logger.info(f"===== Building links {roi_name} {year_before} -> {year_after} ========")
+            links = LinkWarehouses(roi_name, centroid, year_before, year_after, r=r)
+            summaries.append(link_summary(links).assign(year_before=year_before, year_after=year_after, radius=int(r/1000)))
+
+    df = pd.concat(summaries, ignore_index=True)
+    out_dir = check_dir(project_path, "reports", roi_name)
+    df.to_csv(make_path(f"building_links_{roi_name}_{years[0]}_{years[-1]}_{int(r/1000)}km.csv", out_dir), index=False)
+    metrics.write_report(roi_name)
+    evict_run()
+    return df
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="link warehouse buildings across BDTOPO vintages")
+    parser.add_argument("--roi", nargs="+", default=[ROI_NAME], choices=list(ENTRY_ROI), help="regions of interest")
+    parser.add_argument("--years", nargs="+", default=SELECTED_YEARS, help="BDTOPO vintages, linked in sequence")
+    parser.add_argument("--radius", type=int, default=DIST_RADIUS, help="study area radius (m)")
+    args = parser.parse_args()
+
+    for roi in args.roi:
+        link_years(roi, years=args.years, r=args.radius)
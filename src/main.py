@@ -1,118 +1,246 @@
 """
 - run analysis for town
 - run analysis with different buffer radius
+- run years of several towns in a process pool (--workers)
+- sweep statistics over a fine radius grid (--sweep)
+- bootstrap confidence intervals of gravity, density and sprawl (--bootstrap)
 """
+import argparse
 import itertools
 import os
-from typing import Tuple 
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple, Union
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 from src.config import *
-from src.stats import compute_statistics
-from src.traitements import AppariementRunner, get_communes_from_radius
+from src import metrics
+from src.cache import evict_run
+from src.radius import NestedRadiusEngine
+from src.stats import compute_statistics, radius_statistics, year_profile
+from src.traitements import AppariementRunner, TraitementSiren, get_communes_from_radius
 from src.utils import *
 import logging
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level = logging.INFO)
 logger = logging.getLogger(__name__)
 
-def main(roi_name):
-    
+# résultats d'une année : rayon -> (entrepôts, communes)
+YearResults = Dict[int, Tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]]
+
+
+def main(roi_name: Union[str, List[str]], nested: bool = False, workers: int = 1, streaming: bool = False):
+
     # workaround
     date_list = ['-'.join([_, "01-01"]) for _ in SELECTED_YEARS]
-    
-    centroid = ENTRY_ROI[roi_name]["CENTER"]
+    roi_names = [roi_name] if isinstance(roi_name, str) else list(roi_name)
 
     epochs = list(itertools.combinations(date_list, 2))
-    
-    logger.info(f"===== Start analysis for {roi_name} ========")
-    
+
+    # chaque (ville, année) n'est calculée qu'une fois, les époques combinent ces résultats
+    year_results = compute_years(roi_names, date_list, nested=nested, workers=workers, streaming=streaming)
+
     log_sprawl_path = []
-    
-    for date_start, date_end in epochs:
-        logger.info(f"---- Analysis over {get_year_from_datestring(date_start)}-{get_year_from_datestring(date_end)} ----")
-
-        log_sprawl_path.append(logistic_sprawl_analysis(centroid, 
-                                                       roi_name, 
-                                                       date_start, 
-                                                       date_end))
-            
+
+    for roi in roi_names:
+        logger.info(f"===== Start analysis for {roi} ========")
+
+        for date_start, date_end in epochs:
+            logger.info(f"---- Analysis over {get_year_from_datestring(date_start)}-{get_year_from_datestring(date_end)} ----")
+
+            log_sprawl_path.append(epoch_statistics(roi,
+                                                    date_start,
+                                                    date_end,
+                                                    year_results[(roi, date_start)],
+                                                    year_results[(roi, date_end)]))
+
     logger.info("=== EPOCHS LOG SPRAWL DONE ====")
+    for roi in roi_names:
+        metrics.write_report(roi)
+    evict_run()
     #logger.info(log_sprawl_path)
     return log_sprawl_path
 
 
+def compute_year(roi_name: str,
+                 date_analysis: str,
+                 nested: bool = False,
+                 centroid: Tuple[float] = None,
+                 **runner_kwargs) -> YearResults:
+    """ entrepôts et communes de chaque rayon de RADIUS_LIST pour une ville et une date
+
+    runner_kwargs : options de AppariementRunner (streaming, join_order, geosiren_ent...)
+    """
+
+    centroid = ENTRY_ROI[roi_name]["CENTER"] if centroid is None else centroid
+    year = get_year_from_datestring(date_analysis)
+    results = {}
+
+    with metrics.tags(roi=roi_name, year=year):
+        if nested:
+            # une passe de distances par année, chaque rayon est un filtre à seuil
+            engine = NestedRadiusEngine(date_analysis=date_analysis, centroid=centroid, roi_name=roi_name, **runner_kwargs)
+            warehouses = engine.run(RADIUS_LIST)
+            for r in RADIUS_LIST:
+                results[r] = (warehouses[r], engine.communes(r))
+            return results
+
+        wh_builder = AppariementRunner(
+            date_analysis=date_analysis,
+            centroid=centroid,
+            roi_name=roi_name,
+            **runner_kwargs)
+
+        for r in RADIUS_LIST:
+            logger.info(f"-- {year} {int(r/1000)}km --")
+            with metrics.tags(radius=r):
+                results[r] = (wh_builder.run(radius=r),
+                              get_communes_from_radius(centroid, r, roi_name, year, columns=True))
+    return results
+
+
+def compute_year_task(*args, **kwargs) -> Tuple[YearResults, List[dict]]:
+    """ compute_year dans un processus du pool : renvoie aussi les métriques du processus """
+    results = compute_year(*args, **kwargs)
+    return results, metrics.drain()
+
+
+def collect_task(future) -> YearResults:
+    """ résultat d'un compute_year_task, ses métriques rejoignent celles du processus principal """
+    results, records = future.result()
+    metrics.extend(records)
+    return results
+
+
+def compute_years(roi_names: List[str],
+                  date_list: List[str],
+                  nested: bool = False,
+                  workers: int = 1,
+                  streaming: bool = False) -> Dict[Tuple[str, str], YearResults]:
+    """ calcule chaque (ville, date) une seule fois, en série ou dans un pool de processus
+
+    streaming : chaque date est extraite de la table des périodes (une seule lecture du stock SIREN)
+    """
+
+    tasks = [(roi, date) for roi in roi_names for date in date_list]
+
+    if workers <= 1:
+        return {task: compute_year(*task, nested=nested, streaming=streaming) for task in tasks}
+
+    # SIREN est commun à toutes les villes : calculé avant le pool pour éviter des écritures concurrentes
+    # de la sortie (les tâches du pool ne font ensuite que des cache hits, voir cache._write_meta)
+    for date in date_list:
+        TraitementSiren(date, streaming=streaming)
+
+    logger.info(f"Process pool : {len(tasks)} tasks on {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {task: pool.submit(compute_year_task, *task, nested=nested, streaming=streaming) for task in tasks}
+        return {task: collect_task(future) for task, future in futures.items()}
+
 
 def save_results(df, fname, roi_name):
     out_dir = check_dir(project_path, "reports", roi_name)
     df.to_csv(make_path(fname, out_dir))
     return make_path(fname, out_dir)
-    
-    
-def logistic_sprawl_analysis(centroid: Tuple[float], 
-                            roi_name: str, 
-                            date_start: str, 
-                            date_end: str) -> pd.DataFrame:
-    
-    log_sprawl_yr = []
-    year_start, year_end = get_year_from_datestring(date_start), get_year_from_datestring(date_end)
-    
-    wh_builder_t0 = AppariementRunner(
-        date_analysis=date_start,
-        centroid=centroid,
-        roi_name=roi_name)
-
-    wh_builder_t1 = AppariementRunner(
-        date_analysis=date_end,
-        centroid=centroid,
-        roi_name=roi_name)
-        
-    for r in RADIUS_LIST:
-            
-        logger.info(f"-- {date_start[:4]} {int(r/1000)}km --")
-        
-        warehouses_t0 = wh_builder_t0.run(radius=r)
-        warehouses_t1 = wh_builder_t1.run(radius=r)
 
 
-        print(f"WH {year_start} : {warehouses_t0.shape}")
-        print(f"WH {year_end} : {warehouses_t1.shape}")
+def epoch_statistics(roi_name: str,
+                     date_start: str,
+                     date_end: str,
+                     results_t0: YearResults,
+                     results_t1: YearResults) -> pd.DataFrame:
+    """ statistiques d'une époque à partir des résultats déjà calculés de ses deux années """
+
+    log_sprawl_yr = []
+    year_start, year_end = get_year_from_datestring(date_start), get_year_from_datestring(date_end)
 
+    for r in RADIUS_LIST:
 
-        communes_t0 = get_communes_from_radius(centroid, r, roi_name, year_start, columns=True)
-        communes_t1 = get_communes_from_radius(centroid, r, roi_name, year_end, columns=True)
+        warehouses_t0, communes_t0 = results_t0[r]
+        warehouses_t1, communes_t1 = results_t1[r]
 
+        logger.info(f"WH {year_start} {int(r/1000)}km : {warehouses_t0.shape}")
+        logger.info(f"WH {year_end} {int(r/1000)}km : {warehouses_t1.shape}")
 
-        
-        result = compute_statistics(wh_t0=warehouses_t0, 
-                    wh_t1=warehouses_t1, 
-                    communes_t0=communes_t0, 
-                    communes_t1=communes_t1, 
-                    name=roi_name, 
+        result = compute_statistics(wh_t0=warehouses_t0,
+                    wh_t1=warehouses_t1,
+                    communes_t0=communes_t0,
+                    communes_t1=communes_t1,
+                    name=roi_name,
                     period=(year_start, year_end))
 
         df = pd.DataFrame(result, index=[int(r/1000)])
         df.index = df.index.rename("radius")
-        
+
         log_sprawl_yr.append(df)
-        
+
     log_sprawl_yr = pd.concat(log_sprawl_yr, axis=0)
-    
+
     save_results(log_sprawl_yr,
                  f"statistics_{roi_name}_{year_start}_{year_end}.csv",
-                 roi_name)    
+                 roi_name)
 
-        
     return log_sprawl_yr
-    
-    
-if __name__ == "__main__":
-    
-    roi_name = ROI_NAME[:]
 
-    main(roi_name)
 
+def sweep_statistics(roi_name: str,
+                     radius_list: List[float],
+                     centroid: Tuple[float] = None,
+                     n_boot: int = 0,
+                     streaming: bool = False) -> List[pd.DataFrame]:
+    """ statistiques de chaque époque pour une grille fine de rayons (ex. tous les 500 m).
+
+    Les profils annuels (seuils d'entrée des communes et entrepôts) sont calculés une fois par année
+    et mémorisés ; chaque époque ne fait que les combiner. n_boot > 0 ajoute les intervalles de confiance.
+    streaming : voir compute_years.
+    """
+    date_list = ['-'.join([_, "01-01"]) for _ in SELECTED_YEARS]
+    centroid = ENTRY_ROI[roi_name]["CENTER"] if centroid is None else tuple(centroid)
+
+    results = []
+    for date_start, date_end in itertools.combinations(date_list, 2):
+        year_start, year_end = get_year_from_datestring(date_start), get_year_from_datestring(date_end)
+        df = radius_statistics(year_profile(roi_name, date_start, centroid, streaming=streaming),
+                               year_profile(roi_name, date_end, centroid, streaming=streaming),
+                               name=roi_name,
+                               period=(year_start, year_end),
+                               radius_list=radius_list,
+                               n_boot=n_boot)
+        save_results(df, f"statistics_{roi_name}_{year_start}_{year_end}_sweep.csv", roi_name)
+        results.append(df)
+    metrics.write_report(roi_name)
+    evict_run()
+    return results
+
+
+def logistic_sprawl_analysis(centroid: Tuple[float],
+                            roi_name: str,
+                            date_start: str,
+                            date_end: str,
+                            nested: bool = False) -> pd.DataFrame:
+
+    return epoch_statistics(roi_name,
+                            date_start,
+                            date_end,
+                            compute_year(roi_name, date_start, nested=nested, centroid=centroid),
+                            compute_year(roi_name, date_end, nested=nested, centroid=centroid))
 
-    
-    
 
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="logistics sprawl analysis")
+    parser.add_argument("--roi", nargs="+", default=[ROI_NAME], choices=list(ENTRY_ROI), help="regions of interest")
+    parser.add_argument("--nested", action="store_true", help="compute every radius from one distance pass")
+    parser.add_argument("--workers", type=int, default=1, help="process pool size for (roi, year) tasks")
+    parser.add_argument("--sweep", type=float, default=None, help="radius step (m) of a statistics sweep up to DIST_RADIUS")
+    parser.add_argument("--bootstrap", type=int, nargs="?", const=BOOTSTRAP_SAMPLES, default=0,
+                        help="bootstrap resamples for confidence intervals (sweep mode, RADIUS_LIST without --sweep)")
+    parser.add_argument("--streaming", action="store_true", help="read the SIREN stock once for every date (periods table)")
+    args = parser.parse_args()
+
+    if args.sweep or args.bootstrap:
+        radius_list = list(np.arange(args.sweep, DIST_RADIUS + 1, args.sweep)) if args.sweep else RADIUS_LIST
+        for roi in args.roi:
+            sweep_statistics(roi, radius_list, n_boot=args.bootstrap, streaming=args.streaming)
+    else:
+        main(args.roi, nested=args.nested, workers=args.workers, streaming=args.streaming)
@@ -0,0 +1,234 @@
+"""
+Métriques des étapes du pipeline
+
+Chaque appel d'étape (décorateur instrument ou context manager stage) enregistre :
+temps réel et CPU, pic de mémoire (RSS) de l'étape, lignes en entrée / sortie, cache hit ou miss,
+octets lus et écrits. Les enregistrements portent les étiquettes courantes (tags : métropole,
+année...) et sont écrits en json / csv dans reports/<roi> (write_report).
+
+Portée des mesures :
+- cpu_s, bytes_read, bytes_written : thread de l'étape (thread_time, /proc/thread-self/io) ;
+  le travail délégué à un pool est compté dans les étapes du pool, process_cpu_s couvre le processus
+- peak_rss_mb : pic de l'étape (VmHWM remis à zéro à son début via /proc/self/clear_refs, sous linux),
+  rss_delta_mb : pic moins RSS au début de l'étape. Sans remise à zéro possible, pic du processus.
+  La mémoire est commune au processus : concurrent = True signale une étape exécutée en même temps
+  qu'une autre dans un autre thread (pools de DepartmentPipeline...), dont la mémoire est alors partagée.
+- les étiquettes sont propres au thread : bind transmet celles du thread appelant aux tâches d'un pool
+
+Désactivé (METRICS_ENABLED), instrument ne fait que journaliser la durée.
+"""
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from typing import Any, Dict, Iterator, List, Optional
+
+import pandas as pd
+
+from src.config import METRICS_ENABLED, project_path
+import logging
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+_RECORDS: List[Dict[str, Any]] = []
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+# étapes en cours dans tous les threads (détection des étapes concurrentes)
+_ACTIVE: Dict[int, Dict[str, Any]] = {}
+
+
+def _stack() -> List[Dict[str, Any]]:
+    if not hasattr(_LOCAL, "stack"):
+        _LOCAL.stack = []
+    return _LOCAL.stack
+
+
+def _tags() -> Dict[str, Any]:
+    if not hasattr(_LOCAL, "tags"):
+        _LOCAL.tags = {}
+    return _LOCAL.tags
+
+
+def _io_bytes() -> Dict[str, Optional[int]]:
+    """ octets lus / écrits par le thread (linux : /proc/thread-self/io), None ailleurs """
+    try:
+        with open("/proc/thread-self/io") as f:
+            io = dict(line.split(":") for line in f.read().splitlines())
+        return {"read": int(io["rchar"]), "write": int(io["wchar"])}
+    except (OSError, KeyError, ValueError):
+        return {"read": None, "write": None}
+
+
+def _status_mb() -> Dict[str, float]:
+    """ RSS courant et pic (VmRSS, VmHWM) en Mo ; pic du processus (ru_maxrss) hors linux """
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f.read().splitlines() if ":" in line)
+        return {"rss": int(status["VmRSS"].split()[0]) / 1024, "hwm": int(status["VmHWM"].split()[0]) / 1024}
+    except (OSError, KeyError, ValueError):
+        # ru_maxrss en Ko sous linux, en octets sous macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak / (1024**2 if os.uname().sysname == "Darwin" else 1024)
+        return {"rss": peak, "hwm": peak}
+
+
+def _reset_peak() -> bool:
+    """ remet le pic (VmHWM) au RSS courant ; False si impossible (hors linux, droits) """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+@contextmanager
+def tags(**values) -> Iterator[None]:
+    """ étiquettes (roi, year, radius...) ajoutées aux étapes exécutées dans le bloc """
+    previous = dict(_tags())
+    _tags().update(values)
+    try:
+        yield
+    finally:
+        _LOCAL.tags = previous
+
+
+@contextmanager
+def stage(name: str, **values) -> Iterator[Dict[str, Any]]:
+    """ mesure d'une étape ; l'enregistrement produit peut être complété (voir rows, cache_event) """
+    if not METRICS_ENABLED:
+        start = time.perf_counter()
+        yield {}
+        logger.info(f"{name} took {time.perf_counter() - start:.4f} s")
+        return
+
+    record = {"stage": name, **_tags(), **values,
+              "start": datetime.now().isoformat(timespec="seconds"),
+              "rows_in": None, "rows_out": None, "cache": None, "pid": os.getpid(), "concurrent": False}
+    thread = threading.get_ident()
+    parent = _stack()[-1] if _stack() else None
+
+    with _LOCK:
+        others = [r for t, r in _ACTIVE.items() if t != thread]
+        for other in others:
+            other["concurrent"] = True
+        record["concurrent"] = bool(others)
+        memory = _status_mb()
+        if parent is not None:
+            # pic du parent atteint avant cette étape, perdu à la remise à zéro
+            parent["_peak"] = max(parent["_peak"], memory["hwm"])
+        # pas de remise à zéro pendant une étape d'un autre thread : son pic serait perdu
+        if not others and _reset_peak():
+            memory["hwm"] = memory["rss"]
+        record["_peak"] = memory["hwm"]
+        record["_outer"] = _ACTIVE.get(thread)
+        _ACTIVE[thread] = record
+
+    rss_start = memory["rss"]
+    io_start = _io_bytes()
+    wall, cpu, process_cpu = time.perf_counter(), time.thread_time(), time.process_time()
+    _stack().append(record)
+    try:
+        yield record
+    finally:
+        _stack().pop()
+        io_end = _io_bytes()
+        with _LOCK:
+            peak = max(record.pop("_peak"), _status_mb()["hwm"])
+            if parent is not None:
+                parent["_peak"] = max(parent["_peak"], peak)
+            outer = record.pop("_outer")
+            if outer is None:
+                _ACTIVE.pop(thread, None)
+            else:
+                _ACTIVE[thread] = outer
+        record.update({
+            "wall_s": round(time.perf_counter() - wall, 4),
+            "cpu_s": round(time.thread_time() - cpu, 4),
+            "process_cpu_s": round(time.process_time() - process_cpu, 4),
+            "peak_rss_mb": round(peak, 1),
+            "rss_delta_mb": round(peak - rss_start, 1),
+            "bytes_read": None if io_start["read"] is None else io_end["read"] - io_start["read"],
+            "bytes_written": None if io_start["write"] is None else io_end["write"] - io_start["write"],
+        })
+        with _LOCK:
+            _RECORDS.append(record)
+        logger.info(f"{name} took {record['wall_s']:.4f} s (cpu {record['cpu_s']:.2f} s, rows {record['rows_in']} -> {record['rows_out']}, cache {record['cache']})")
+
+
+def bind(func):
+    """ func exécutée avec les étiquettes du thread appelant (tâches soumises à un pool de threads) """
+    values = dict(_tags())
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with tags(**values):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def instrument(func):
+    """ décorateur : chaque appel de func est une étape mesurée (remplace utils.timeit) """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with stage(func.__qualname__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def rows(rows_in: Optional[int] = None, rows_out: Optional[int] = None) -> None:
+    """ lignes en entrée / sortie de l'étape en cours """
+    if _stack():
+        if rows_in is not None:
+            _stack()[-1]["rows_in"] = int(rows_in)
+        if rows_out is not None:
+            _stack()[-1]["rows_out"] = int(rows_out)
+
+
+def cache_event(hit: bool) -> None:
+    """ cache hit ou miss de l'étape en cours (appelé par CacheEntry.hit) """
+    if _stack():
+        _stack()[-1]["cache"] = "hit" if hit else "miss"
+
+
+def drain() -> List[Dict[str, Any]]:
+    """ enregistrements du processus, vidés (à renvoyer au processus principal depuis un pool) """
+    with _LOCK:
+        records = list(_RECORDS)
+        _RECORDS.clear()
+    return records
+
+
+def extend(records: List[Dict[str, Any]]) -> None:
+    """ ajoute des enregistrements venant d'un processus du pool """
+    with _LOCK:
+        _RECORDS.extend(records)
+
+
+def records() -> pd.DataFrame:
+    with _LOCK:
+        return pd.DataFrame(list(_RECORDS))
+
+
+def write_report(roi_name: str, run_name: str = None) -> Optional[str]:
+    """ rapport de l'exécution (json et csv) dans reports/<roi>, restreint à la métropole s'il y a une colonne roi """
+    df = records()
+    if df.empty:
+        return None
+    if "roi" in df:
+        df = df[df["roi"].isna() | (df["roi"] == roi_name)]
+
+    run_name = run_name or datetime.now().strftime("%Y%m%d_%H%M%S")
+    out_dir = os.path.join(project_path, "reports", roi_name)
+    os.makedirs(out_dir, exist_ok=True)
+    json_path = os.path.join(out_dir, f"run_metrics_{run_name}.json")
+    with open(json_path, "w") as f:
+        json.dump(json.loads(df.to_json(orient="records")), f, indent=2)
+    df.to_csv(os.path.join(out_dir, f"run_metrics_{run_name}.csv"), index=False)
+    logger.info(f"Run metrics : {json_path}")
+    return json_path
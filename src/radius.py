@@ -0,0 +1,282 @@
+"""
+Moteur de rayons emboîtés
+
+Les rayons de RADIUS_LIST sont emboîtés : la zone d'étude d'un rayon contient celles des rayons inférieurs.
+Les distances communes / centre, l'appartenance des points SIREN aux communes et l'appariement
+points / bâtiments sont calculés une seule fois pour le rayon maximal ; chaque rayon n'est plus
+qu'un filtre à seuil sur ces tables.
+
+Auteurs: C.Colliard, M.Dizier, T.Hillairet
+"""
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely import Point
+
+from src.config import *
+from src.traitements import (
+    AppariementRunner,
+    JoinSirenGeosiren,
+    bati_indus_file,
+    building_associations,
+    communes_file,
+    get_ze_from_radius,
+    load_bati_indus_near,
+    nearest_bati_matching,
+)
+from src.cache import CacheEntry
+from src.utils import check_dir, get_year_from_datestring, read_layer, write_layer
+from src import metrics
+from src.metrics import instrument
+import logging
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+# nombre de segments par quart de cercle des buffers geopandas (défaut shapely)
+BUFFER_QUAD_SEGS = 16
+# itérations de la dichotomie sur le rayon d'entrée des communes (bande de largeur ~ r / 800)
+THRESHOLD_STEPS = 30
+# pas (m) des valeurs rondes essayées comme seuil en fin de dichotomie (voir _snap_thresholds)
+SNAP_STEPS = [1_000, 100, 10, 1, 0.1, 0.01, 0.001]
+
+
+class NestedRadiusEngine:
+    """ Entrepôts et communes pour toute liste de rayons, à partir d'une seule passe de distances.
+
+    Args:
+        date_analysis (str): date de l'étude YYYY-MM-DD.
+        centroid (Tuple[float]): centre de la zone d'étude.
+        roi_name (str): nom de la zone d'étude.
+        max_radius (int, optional): rayon maximal, borne de tous les rayons demandés. Defaults to DIST_RADIUS.
+        dist_siren_bdtopo (float, optional): distance maximale entre SIREN et BDTOPO. Defaults to 50.0.
+        seuil_surf_ent (float, optional): surface minimale d'un entrepot. Defaults to 1000.0.
+        **runner_kwargs: options de AppariementRunner (streaming, join_order...).
+    """
+    def __init__(self,
+                 date_analysis: str,
+                 centroid: Tuple[float],
+                 roi_name: str,
+                 max_radius: int = DIST_RADIUS,
+                 dist_siren_bdtopo: float = 50.0,
+                 seuil_surf_ent: float = 1000.0,
+                 **runner_kwargs):
+
+        self.centroid = centroid
+        self.roi_name = '_'.join(roi_name.lower().split(" "))
+        self.date_analysis = date_analysis
+        self.year = get_year_from_datestring(date_analysis)
+        self.max_radius = max_radius
+        self.dist_siren_bdtopo = dist_siren_bdtopo
+        self.seuil_surf_ent = seuil_surf_ent
+        self.runner_kwargs = runner_kwargs
+
+        self._communes = None
+        self._communes_seuil = None
+        self._merged_siren_path = None
+        self._points = None
+        self._bati = None
+        self._assoc = None
+
+    # --- communes ---
+
+    @property
+    def communes_table(self) -> gpd.GeoDataFrame:
+        """ communes de la zone d'étude avec leur distance au centre (dist_centre) """
+        if self._communes is None:
+            communes = read_layer(communes_file(self.roi_name, self.year)).to_crs(CRS).reset_index(drop=True)
+            communes["dist_centre"] = shapely.distance(communes.geometry.values, Point(self.centroid))
+            self._communes = communes
+        return self._communes
+
+    def communes_mask(self, r: float) -> np.ndarray:
+        """ communes intersectant le buffer de rayon r, comme get_communes_from_radius.
+
+        Le buffer est un polygone inscrit au cercle : en deçà de r.cos(pi / 4n) l'intersection est certaine,
+        au-delà de r elle est impossible, seule la bande intermédiaire est testée géométriquement.
+        """
+        dist = self.communes_table["dist_centre"].values
+        inner = r * np.cos(np.pi / (4 * BUFFER_QUAD_SEGS)) * (1 - 1e-9)
+        mask = dist <= inner
+        band = np.flatnonzero((dist > inner) & (dist <= r))
+        if band.size:
+            buffer = Point(self.centroid).buffer(r, quad_segs=BUFFER_QUAD_SEGS)
+            mask[band] = shapely.intersects(self.communes_table.geometry.values[band], buffer)
+        return mask
+
+    def communes_thresholds(self) -> np.ndarray:
+        """ rayon d'entrée de chaque commune : plus petit rayon dont le buffer l'intersecte.
+
+        communes_mask(r) équivaut à r >= seuil ; le buffer étant un polygone inscrit, le seuil est
+        entre la distance au centre d et d / cos(pi / 4n), il est obtenu par dichotomie vectorisée.
+        """
+        if self._communes_seuil is None:
+            dist = self.communes_table["dist_centre"].values
+            lo = dist * (1 - 1e-9)
+            hi = dist / np.cos(np.pi / (4 * BUFFER_QUAD_SEGS)) * (1 + 1e-9) + 1e-6
+            geoms = self.communes_table.geometry.values
+            todo = np.flatnonzero(dist > 0)
+            for _ in range(THRESHOLD_STEPS):
+                mid = (lo[todo] + hi[todo]) / 2
+                ok = shapely.intersects(geoms[todo], shapely.buffer(Point(self.centroid), mid, quad_segs=BUFFER_QUAD_SEGS))
+                hi[todo] = np.where(ok, mid, hi[todo])
+                lo[todo] = np.where(ok, lo[todo], mid)
+            hi[todo] = self._snap_thresholds(geoms[todo], lo[todo], hi[todo])
+            hi[dist == 0] = 0.0
+            self._communes_seuil = hi
+        return self._communes_seuil
+
+    def _snap_thresholds(self, geoms: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+        """ seuil ramené au nombre le plus rond de ]lo, hi] dont le buffer intersecte encore la commune.
+
+        La dichotomie laisse le seuil exact dans ]lo, hi] : une commune qui touche le buffer exactement
+        au rayon r (bord ou sommet sur le cercle) aurait un seuil hi > r alors que communes_mask(r) la retient.
+        """
+        snap = hi.copy()
+        found = np.zeros(len(hi), dtype=bool)
+        for step in SNAP_STEPS:
+            candidate = np.floor(lo / step) * step + step
+            new = ~found & (candidate <= hi)
+            snap[new], found[new] = candidate[new], True
+        check = np.flatnonzero(found & (snap < hi))
+        if check.size:
+            ok = shapely.intersects(geoms[check], shapely.buffer(Point(self.centroid), snap[check], quad_segs=BUFFER_QUAD_SEGS))
+            hi = hi.copy()
+            hi[check[ok]] = snap[check[ok]]
+        return hi
+
+    def communes(self, r: float) -> gpd.GeoDataFrame:
+        """ communes de la zone d'étude de rayon r (toutes colonnes), équivalent de get_communes_from_radius(columns=True) """
+        communes = self.communes_table.loc[self.communes_mask(r)].drop("dist_centre", axis=1)
+        return communes.rename({"POPULATION":"POPUL"}, axis=1)
+
+    # --- points SIREN et appariement, calculés une fois pour le rayon maximal ---
+
+    def merged_siren_path(self) -> str:
+        """ entrepôts SIREN géolocalisés du rayon maximal (étapes 1 à 3, en cache) """
+        if self._merged_siren_path is None:
+            runner = AppariementRunner(date_analysis=self.date_analysis,
+                                       centroid=self.centroid,
+                                       roi_name=self.roi_name,
+                                       **self.runner_kwargs)
+            self._merged_siren_path = JoinSirenGeosiren(siren_date_path=runner.siren_ent_path,
+                                                        geosiren_zone_path=runner._geosiren(self.max_radius),
+                                                        year=self.year,
+                                                        name=self.roi_name,
+                                                        r=self.max_radius)
+        return self._merged_siren_path
+
+    def _prepare(self):
+        if self._assoc is not None:
+            return
+
+        points = read_layer(self.merged_siren_path()).reset_index(drop=True)
+        logger.info(f"Nested radius - points {self.year} : {points.shape}")
+
+        # commune contenant chaque point ; les points sur une limite de communes sont testés sur l'union
+        within = gpd.sjoin(points[["geometry"]], self.communes_table[["geometry"]], predicate="within", how="left")
+        within = within[~within.index.duplicated(keep="first")]
+        points["commune"] = within["index_right"].reindex(points.index).fillna(-1).astype(int).values
+        self._points = points
+
+        # appariement une seule fois pour tous les points du rayon maximal
+        bati = load_bati_indus_near(self.roi_name, self.year, points.geometry.values, self.dist_siren_bdtopo)
+        matches = nearest_bati_matching(points, bati, max_distance=self.dist_siren_bdtopo)
+        # bâtiments touchés par une ligne d'appariement ou contenant un point, comme AppSirenBDTopo
+        # (bati_index : position dans la couche complète, index de bati)
+        assoc = building_associations(points, bati, matches)
+        assoc["bati_index"] = bati.index.values[assoc["bati_index"].values]
+
+        self._bati = bati
+        self._assoc = assoc
+        logger.info(f"Nested radius - associations {self.year} : {assoc.shape}")
+
+    def points_mask(self, r: float) -> np.ndarray:
+        """ points SIREN dans la zone d'étude de rayon r """
+        self._prepare()
+        commune = self._points["commune"].values
+        mask = np.zeros(len(commune), dtype=bool)
+        inside = commune >= 0
+        mask[inside] = self.communes_mask(r)[commune[inside]]
+
+        boundary = np.flatnonzero(~inside)
+        if boundary.size:
+            ze = get_ze_from_radius(self.centroid, r, self.roi_name, self.year)
+            mask[boundary] = shapely.within(self._points.geometry.values[boundary], ze.geometry.values[0])
+        return mask
+
+    def points_thresholds(self) -> np.ndarray:
+        """ rayon d'entrée de chaque point SIREN : celui de sa commune, ou pour un point sur une limite
+        le plus grand des seuils des communes qui le touchent (il est dans l'union quand elles y sont toutes)
+        """
+        self._prepare()
+        seuil_communes = self.communes_thresholds()
+        commune = self._points["commune"].values
+        seuil = np.full(len(commune), np.inf)
+        inside = commune >= 0
+        seuil[inside] = seuil_communes[commune[inside]]
+
+        boundary = np.flatnonzero(~inside)
+        if boundary.size:
+            touch = gpd.sjoin(self._points.iloc[boundary][["geometry"]], self.communes_table[["geometry"]],
+                              predicate="intersects", how="inner")
+            seuil_touch = pd.Series(seuil_communes[touch["index_right"].values], index=touch.index).groupby(level=0).max()
+            seuil[boundary] = seuil_touch.reindex(self._points.index[boundary]).fillna(np.inf).values
+        return seuil
+
+    def warehouses_table(self) -> gpd.GeoDataFrame:
+        """ bâtiments d'entrepôt du rayon maximal avec leur rayon d'entrée (colonne seuil).
+
+        warehouses(r) correspond aux lignes de seuil <= r.
+        """
+        self._prepare()
+        seuil_points = self.points_thresholds()
+        seuil = pd.Series(seuil_points[self._assoc["point_index"].values],
+                          index=self._assoc["bati_index"].values).groupby(level=0).min()
+        seuil = seuil[seuil <= self.max_radius]
+        bati_indus_ent = self._bati.loc[seuil.index]
+        keep = (bati_indus_ent["geometry"].area > self.seuil_surf_ent) & ~bati_indus_ent.duplicated(keep="first")
+        return bati_indus_ent[keep].assign(seuil=seuil[keep.values].values)
+
+    def warehouses(self, r: float) -> gpd.GeoDataFrame:
+        """ bâtiments d'entrepôt de la zone d'étude de rayon r, identiques à AppSirenBDTopo """
+        if r > self.max_radius:
+            raise ValueError(f"radius {r} greater than max radius {self.max_radius}")
+        self._prepare()
+        points_in = self.points_mask(r)
+        bati_idx = np.unique(self._assoc.loc[points_in[self._assoc["point_index"].values], "bati_index"].values)
+        bati_indus_ent = self._bati.loc[bati_idx]
+        bati_indus_ent = bati_indus_ent[bati_indus_ent["geometry"].area > self.seuil_surf_ent]
+        return bati_indus_ent.drop_duplicates(keep="first")
+
+    @instrument
+    def run(self, radius_list: List[int] = RADIUS_LIST, save: bool = True) -> Dict[int, gpd.GeoDataFrame]:
+        """ entrepôts pour chaque rayon, enregistrés (en cache) comme les sorties de AppSirenBDTopo """
+        app_out_dir = check_dir(processed_data_path, self.roi_name, self.year, "Appariement")
+        results = {}
+        for r in radius_list:
+            cache = CacheEntry("appariement_nested",
+                               appariement_name.format(self.roi_name.upper(), self.year, int(r/1000)),
+                               app_out_dir,
+                               params={"r": r,
+                                       "centroid": list(self.centroid),
+                                       "dist_siren_bdtopo": self.dist_siren_bdtopo,
+                                       "seuil_surf_ent": self.seuil_surf_ent},
+                               inputs=[self.merged_siren_path(),
+                                       bati_indus_file(self.roi_name, self.year),
+                                       communes_file(self.roi_name, self.year)])
+            with metrics.stage("NestedRadiusEngine.warehouses", radius=r):
+                if save and cache.hit():
+                    results[r] = read_layer(cache.path)
+                    continue
+                results[r] = self.warehouses(r)
+                logger.info(f"Nested radius {self.year} {int(r/1000)}km : {results[r].shape}")
+                metrics.rows(rows_out=len(results[r]))
+                if save:
+                    write_layer(results[r], cache.path)
+                    cache.commit()
+        return results
@@ -0,0 +1,228 @@
+"""
+Rafraîchissement incrémental après une nouvelle livraison du stock SIREN
+
+1. table des périodes d'entrepôts de la nouvelle livraison (TraitementSirenPeriodes, une lecture du stock)
+2. comparaison avec la table précédente par seau de siret (hash des lignes par seau) : seules les lignes des
+   seaux modifiés sont comparées, d'où les périodes insérées, modifiées (dates de fin, codes) ou supprimées
+3. snapshots SIREN : une date non touchée par le delta est reprise telle quelle, les autres sont recalculées
+   depuis la table des périodes (lecture rapide)
+4. étapes par métropole : reprises (nouvelle clé, même contenu - voir cache.rekey) sauf si un siret du delta
+   actif à la date est géolocalisé dans l'emprise des communes de la métropole ; elles sont alors
+   recalculées au prochain passage du pipeline
+
+Usage : remplacer le csv du stock (ou relancer src/ingest.py --siren) puis python -m src.refresh
+"""
+import argparse
+import json
+import os
+from typing import Any, Dict, List, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.config import *
+from src import metrics
+from src.cache import cache_entries, evict_run, fingerprint, rekey
+from src.ingest import read_siren_table
+from src.traitements import (
+    SIREN_COLUMNS,
+    TraitementSiren,
+    TraitementSirenPeriodes,
+    communes_file,
+    load_geosiren_sirets,
+    siren_source,
+)
+from src.utils import read_layer
+from src.metrics import instrument
+import logging
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+# nombre de seaux de siret pour la comparaison des tables de périodes
+REFRESH_BUCKETS = 4096
+
+
+def _fp_id(fp: Dict[str, Any]) -> str:
+    return json.dumps(fp, sort_keys=True, default=str)
+
+
+def row_hashes(periods: pd.DataFrame) -> pd.Series:
+    """ hash de chaque période (siret, codes, dates) """
+    rows = periods[SIREN_COLUMNS].astype({c: str for c in SIREN_COLUMNS if c != "siret"})
+    return pd.util.hash_pandas_object(rows, index=False)
+
+
+def bucket_hashes(periods: pd.DataFrame, n_buckets: int = REFRESH_BUCKETS) -> pd.Series:
+    """ hash par seau de siret, indépendant de l'ordre des lignes """
+    buckets = periods["siret"].values % n_buckets
+    return pd.Series(row_hashes(periods).values, index=buckets).groupby(level=0).sum()
+
+
+def periods_delta(old: pd.DataFrame,
+                  new: pd.DataFrame,
+                  n_buckets: int = REFRESH_BUCKETS) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """ périodes insérées et supprimées entre deux tables (une période modifiée apparaît dans les deux) """
+    old_b, new_b = bucket_hashes(old, n_buckets), bucket_hashes(new, n_buckets)
+    # reindex plutôt que concat + fillna : les hash restent en uint64 (un float64 confond des hash voisins)
+    all_buckets = old_b.index.union(new_b.index)
+    old_b, new_b = old_b.reindex(all_buckets, fill_value=0), new_b.reindex(all_buckets, fill_value=0)
+    changed = all_buckets[old_b.values != new_b.values].values
+    logger.info(f"Refresh : {changed.size} / {n_buckets} siret buckets changed")
+
+    old_c = old[np.isin(old["siret"].values % n_buckets, changed)]
+    new_c = new[np.isin(new["siret"].values % n_buckets, changed)]
+    old_h, new_h = row_hashes(old_c), row_hashes(new_c)
+    inserted = new_c[~new_h.isin(old_h).values]
+    removed = old_c[~old_h.isin(new_h).values]
+    return inserted, removed
+
+
+def _roi_year(path: str) -> Tuple[str, str]:
+    """ (métropole, année) d'une sortie sous processed/<roi>/<year>/..., (None, None) pour SIREN """
+    parts = os.path.relpath(path, processed_data_path).split(os.sep)
+    if parts[0] == "SIREN" or len(parts) < 3:
+        return None, None
+    return parts[0], parts[1]
+
+
+def affected_rois(delta: pd.DataFrame, dates: List[str]) -> Dict[str, Set[str]]:
+    """ métropoles touchées à chaque date : un siret du delta actif à la date est dans l'emprise de leurs communes """
+    rois = [d for d in os.listdir(processed_data_path) if d != "SIREN" and os.path.isdir(os.path.join(processed_data_path, d))]
+
+    # emprises des communes de chaque (métropole, année), None si inconnue
+    zones = {}
+    for year in {str(pd.Timestamp(date).year) for date in dates}:
+        for roi in rois:
+            path = communes_file(roi, year)
+            zones[(roi, year)] = read_layer(path).total_bounds if os.path.exists(path) else None
+
+    # GeoSIREN lu dans l'union des emprises connues seulement (comme batch.scan_warehouse_points)
+    known = np.array([b for b in zones.values() if b is not None])
+    points = pd.DataFrame(columns=["siret", "x", "y"])
+    if len(delta) and len(known):
+        bounds = (known[:, 0].min(), known[:, 1].min(), known[:, 2].max(), known[:, 3].max())
+        points = load_geosiren_sirets(np.unique(delta["siret"].values), bounds)
+
+    affected = {}
+    for date in dates:
+        day = pd.Timestamp(date)
+        sirets = delta.loc[(delta["dateDebut"] < day) & (delta["dateFin"] > day), "siret"].values
+        pts = points[points["siret"].isin(sirets)]
+        affected[date] = set()
+        for roi in rois:
+            bounds = zones[(roi, str(day.year))]
+            if bounds is None:
+                # emprise inconnue : la métropole est considérée touchée
+                affected[date].add(roi)
+                continue
+            minx, miny, maxx, maxy = bounds
+            if ((pts["x"] >= minx) & (pts["x"] <= maxx) & (pts["y"] >= miny) & (pts["y"] <= maxy)).any():
+                affected[date].add(roi)
+        logger.info(f"Refresh {date} : {len(sirets)} changed warehouse sirets, affected rois {sorted(affected[date])}")
+    return affected
+
+
+@instrument
+def refresh_siren(n_buckets: int = REFRESH_BUCKETS) -> Dict[str, Any]:
+    """ Met à jour les sorties en cache après le remplacement du stock SIREN.
+
+    Returns:
+        dict: nombre de périodes insérées / supprimées, dates recalculées, sorties reprises et laissées à recalculer.
+    """
+    entries = cache_entries()
+    new_source_fp = fingerprint(siren_source())
+    previous = sorted(
+        (e for e in entries if e["stage"] == "siren_periods" and _fp_id(e["inputs"][0]) != _fp_id(new_source_fp)),
+        key=lambda e: e.get("created", 0),
+    )
+    if not previous or not os.path.exists(previous[-1]["path"]):
+        logger.warning("Refresh : no previous SIREN periods table in cache, full recompute on next run")
+        TraitementSirenPeriodes()
+        return {}
+    old_entry = previous[-1]
+    old_source_fp = old_entry["inputs"][0]
+
+    # 1-2. nouvelle table des périodes et delta par seaux
+    old_periods = read_siren_table(old_entry["path"])
+    new_periods = read_siren_table(TraitementSirenPeriodes())
+    inserted, removed = periods_delta(old_periods, new_periods, n_buckets)
+    delta = pd.concat([inserted, removed], ignore_index=True)
+    metrics.rows(rows_in=len(new_periods), rows_out=len(delta))
+    logger.info(f"Refresh : {len(inserted)} periods inserted or changed, {len(removed)} removed or changed")
+
+    # 3. snapshots SIREN de la livraison précédente
+    snapshots = [e for e in entries if e["stage"] == "siren" and _fp_id(e["inputs"][0]) == _fp_id(old_source_fp)]
+    dates = sorted({e["params"]["date"] for e in snapshots})
+    touched = {
+        date: bool(((delta["dateDebut"] < pd.Timestamp(date)) & (delta["dateFin"] > pd.Timestamp(date))).any())
+        for date in dates
+    }
+    rois_by_date = affected_rois(delta, [d for d in dates if touched[d]])
+
+    # ancienne empreinte -> (nouvelle empreinte, métropoles dont les sorties dépendantes sont à recalculer)
+    # (None : sorties dépendantes laissées à recalculer, ex. fenêtres des séries temporelles)
+    new_periods_fp = fingerprint(TraitementSirenPeriodes())
+    replaced = {
+        _fp_id(old_source_fp): (new_source_fp, None),
+        _fp_id({"path": os.path.basename(old_entry["path"]), "key": old_entry["key"]}): (new_periods_fp, None),
+    }
+    for entry in snapshots:
+        date = entry["params"]["date"]
+        old_fp = {"path": os.path.basename(entry["path"]), "key": entry["key"]}
+        if touched[date]:
+            new_path = TraitementSiren(date, streaming=True)
+            replaced[_fp_id(old_fp)] = (fingerprint(new_path), rois_by_date[date])
+        else:
+            new_path = rekey(entry["path"], [new_source_fp])
+            replaced[_fp_id(old_fp)] = (fingerprint(new_path), set())
+
+    # 4. étapes en aval, de proche en proche
+    done = {e["path"] for e in snapshots} | {old_entry["path"]}
+    rekeyed, stale = [], []
+    progress = True
+    while progress:
+        progress = False
+        for entry in entries:
+            if entry["path"] in done or not os.path.exists(entry["path"]):
+                continue
+            ids = [_fp_id(fp) for fp in entry["inputs"]]
+            if not any(i in replaced for i in ids):
+                continue
+            if any(i in replaced and replaced[i][1] is None for i in ids):
+                # dépend du stock ou de la table des périodes : recalculé à la demande
+                done.add(entry["path"])
+                stale.append(entry["path"])
+                continue
+
+            done.add(entry["path"])
+            progress = True
+            roi, _ = _roi_year(entry["path"])
+            if any(i in replaced and roi in replaced[i][1] for i in ids):
+                stale.append(entry["path"])
+                continue
+            inputs = [replaced[i][0] if i in replaced else fp for i, fp in zip(ids, entry["inputs"])]
+            new_path = rekey(entry["path"], inputs)
+            replaced[_fp_id({"path": os.path.basename(entry["path"]), "key": entry["key"]})] = (fingerprint(new_path), set())
+            rekeyed.append(new_path)
+
+    summary = {
+        "inserted": len(inserted),
+        "removed": len(removed),
+        "dates_recomputed": [d for d in dates if touched[d]],
+        "dates_reused": [d for d in dates if not touched[d]],
+        "rekeyed": len(rekeyed),
+        "stale": len(stale),
+    }
+    logger.info(f"Refresh summary : {summary}")
+    evict_run()
+    return summary
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="incremental refresh after a new SIREN stock release")
+    parser.add_argument("--buckets", type=int, default=REFRESH_BUCKETS, help="siret buckets of the periods comparison")
+    args = parser.parse_args()
+
+    refresh_siren(n_buckets=args.buckets)
@@ -0,0 +1,237 @@
+"""
+Index spatial persistant des bâtiments BDTOPO d'une zone d'étude (par métropole et année)
+
+Arbre R empaqueté (Sort-Tile-Recursive) écrit une fois à côté de la couche bati_indus :
+- bounds.npy : emprises des bâtiments dans l'ordre de l'arbre (n x 4)
+- order.npy / rank.npy : position dans la couche de chaque feuille et inverse
+- nodes.npy, levels.npy : emprises des noeuds de chaque niveau et leur décalage dans nodes.npy
+- wkb.bin, offsets.npy : géométries WKB concaténées dans l'ordre de l'arbre
+- attributes.parquet : colonnes de la couche hors géométrie, ordre de la couche
+
+Les tableaux sont ouverts en mémoire projetée (np.load mmap_mode) : l'ouverture ne lit que meta.json,
+seules les pages des noeuds et géométries parcourus par une requête sont lues.
+"""
+import json
+import os
+import shutil
+from functools import lru_cache
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from src.config import *
+from src.cache import CacheEntry
+from src.utils import read_layer
+from src.metrics import instrument
+import logging
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _str_order(bounds: np.ndarray, node_size: int) -> np.ndarray:
+    """ ordre Sort-Tile-Recursive : tranches verticales par x du centre, puis tri par y dans chaque tranche """
+    n = len(bounds)
+    cx = (bounds[:, 0] + bounds[:, 2]) / 2
+    cy = (bounds[:, 1] + bounds[:, 3]) / 2
+    n_slices = int(np.ceil(np.sqrt(np.ceil(n / node_size)))) or 1
+    slice_size = n_slices * node_size
+    by_x = np.argsort(cx, kind="stable")
+    slice_id = np.empty(n, dtype=np.int64)
+    slice_id[by_x] = np.arange(n) // slice_size
+    return np.lexsort((cy, slice_id))
+
+
+def _parent_bounds(bounds: np.ndarray, node_size: int) -> np.ndarray:
+    starts = np.arange(0, len(bounds), node_size)
+    return np.column_stack([
+        np.minimum.reduceat(bounds[:, 0], starts),
+        np.minimum.reduceat(bounds[:, 1], starts),
+        np.maximum.reduceat(bounds[:, 2], starts),
+        np.maximum.reduceat(bounds[:, 3], starts),
+    ])
+
+
+@instrument
+def build_building_index(bati: gpd.GeoDataFrame, out_dir: str, node_size: int = BUILDING_INDEX_NODE_SIZE) -> str:
+    """ écrit l'index des bâtiments de bati (ordre de la couche) dans out_dir """
+    tmp_dir = out_dir + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    geoms = bati.geometry.values
+    bounds = shapely.bounds(np.asarray(geoms))
+    order = _str_order(bounds, node_size) if len(bounds) else np.zeros(0, dtype=np.int64)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    leaves = bounds[order]
+
+    # niveaux de l'arbre, des parents des feuilles jusqu'à la racine
+    levels, nodes = [0], []
+    level = leaves
+    while len(level) > 1:
+        level = _parent_bounds(level, node_size)
+        nodes.append(level)
+        levels.append(levels[-1] + len(level))
+    nodes = np.concatenate(nodes) if nodes else np.zeros((0, 4))
+
+    wkb = shapely.to_wkb(np.asarray(geoms)[order])
+    offsets = np.concatenate([[0], np.cumsum([len(w) for w in wkb])]).astype(np.int64)
+    with open(os.path.join(tmp_dir, "wkb.bin"), "wb") as f:
+        f.write(b"".join(wkb))
+
+    np.save(os.path.join(tmp_dir, "bounds.npy"), leaves)
+    np.save(os.path.join(tmp_dir, "order.npy"), order.astype(np.int64))
+    np.save(os.path.join(tmp_dir, "rank.npy"), rank.astype(np.int64))
+    np.save(os.path.join(tmp_dir, "nodes.npy"), nodes)
+    np.save(os.path.join(tmp_dir, "levels.npy"), np.asarray(levels, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+    pd.DataFrame(bati.drop(columns=bati.geometry.name)).reset_index(drop=True).to_parquet(
+        os.path.join(tmp_dir, "attributes.parquet"), index=False
+    )
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump({"n": len(order), "node_size": node_size, "crs": str(bati.crs), "geometry": bati.geometry.name}, f)
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    logger.info(f"Building index : {len(order)} buildings, {len(levels)} levels in {out_dir}")
+    return out_dir
+
+
+def _load(path: str) -> np.ndarray:
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:
+        # tableau vide : pas de projection possible
+        return np.load(path)
+
+
+class BuildingIndex:
+    """ index des bâtiments ouvert en mémoire projetée.
+
+    Les positions renvoyées sont celles des bâtiments dans la couche indexée (load_bati_indus).
+
+    Args:
+        path (str): répertoire écrit par build_building_index.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.node_size = self.meta["node_size"]
+        load = lambda name: _load(os.path.join(path, name))
+        self.bounds = load("bounds.npy")
+        self.order = load("order.npy")
+        self.rank = load("rank.npy")
+        self.nodes = load("nodes.npy")
+        self.levels = load("levels.npy")
+        self.offsets = load("offsets.npy")
+        self.wkb = np.memmap(os.path.join(path, "wkb.bin"), dtype=np.uint8, mode="r") if self.offsets[-1] else np.zeros(0, np.uint8)
+        # colonnes lues -> table des attributs, lue une fois par jeu de colonnes
+        self._attributes = {}
+
+    def __len__(self) -> int:
+        return self.meta["n"]
+
+    def _level(self, k: int) -> np.ndarray:
+        """ emprises du niveau k (0 : feuilles) """
+        if k == 0:
+            return self.bounds
+        return self.nodes[self.levels[k - 1]:self.levels[k]]
+
+    @staticmethod
+    def _intersects(boxes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        return (
+            (boxes[:, 0] <= query[:, 2]) & (boxes[:, 2] >= query[:, 0])
+            & (boxes[:, 1] <= query[:, 3]) & (boxes[:, 3] >= query[:, 1])
+        )
+
+    def query_bounds(self, boxes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """ couples (requête, bâtiment) dont les emprises s'intersectent, descente de l'arbre en masse """
+        boxes = np.atleast_2d(np.asarray(boxes, dtype=float))
+        if not len(self) or not len(boxes):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        top = len(self.levels) - 1
+        n_top = len(self._level(top))
+        q = np.repeat(np.arange(len(boxes)), n_top)
+        node = np.tile(np.arange(n_top), len(boxes))
+        keep = self._intersects(self._level(top)[node], boxes[q])
+        q, node = q[keep], node[keep]
+
+        for k in range(top, 0, -1):
+            size = len(self._level(k - 1))
+            child = (node[:, None] * self.node_size + np.arange(self.node_size)).ravel()
+            q = np.repeat(q, self.node_size)
+            valid = child < size
+            q, child = q[valid], child[valid]
+            keep = self._intersects(self._level(k - 1)[child], boxes[q])
+            q, node = q[keep], child[keep]
+
+        return q, np.asarray(self.order[node])
+
+    def geometries(self, positions: Sequence[int]) -> np.ndarray:
+        """ géométries des bâtiments aux positions données (lecture des seuls WKB utiles) """
+        leaves = np.asarray(self.rank[np.asarray(positions, dtype=np.int64)])
+        starts, ends = self.offsets[leaves], self.offsets[leaves + 1]
+        return shapely.from_wkb(np.array([self.wkb[s:e].tobytes() for s, e in zip(starts, ends)], dtype=object))
+
+    def query(self,
+              geoms: np.ndarray,
+              predicate: Optional[str] = None,
+              distance: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
+        """ couples (géométrie, bâtiment) : emprises à moins de distance, puis predicate exact (shapely) si fourni """
+        geoms = np.asarray(geoms)
+        boxes = shapely.bounds(geoms) + np.array([-distance, -distance, distance, distance])
+        q, positions = self.query_bounds(boxes)
+        if predicate is not None and len(q):
+            if predicate == "dwithin":
+                ok = shapely.dwithin(geoms[q], self.geometries(positions), distance)
+            else:
+                ok = getattr(shapely, predicate)(geoms[q], self.geometries(positions))
+            q, positions = q[ok], positions[ok]
+        return q, positions
+
+    def attributes(self, columns: Sequence[str] = None) -> pd.DataFrame:
+        """ colonnes de la couche hors géométrie, ordre de la couche (mémorisées : ne pas modifier en place) """
+        key = None if columns is None else tuple(columns)
+        if key not in self._attributes:
+            self._attributes[key] = pd.read_parquet(os.path.join(self.path, "attributes.parquet"),
+                                                    columns=None if key is None else list(key))
+        return self._attributes[key]
+
+    def subset(self, positions: Sequence[int], columns: Sequence[str] = None) -> gpd.GeoDataFrame:
+        """ bâtiments aux positions données, indexés par leur position dans la couche """
+        positions = np.unique(np.asarray(positions, dtype=np.int64))
+        attributes = self.attributes(columns).take(positions).set_index(pd.Index(positions))
+        attributes[self.meta["geometry"]] = self.geometries(positions)
+        return gpd.GeoDataFrame(attributes, geometry=self.meta["geometry"], crs=self.meta["crs"])
+
+    def around(self, geoms: np.ndarray, distance: float) -> gpd.GeoDataFrame:
+        """ bâtiments dont l'emprise est à moins de distance de l'emprise d'une géométrie (sur-ensemble exact
+        des bâtiments à moins de distance), dans l'ordre de la couche """
+        _, positions = self.query(geoms, distance=distance)
+        return self.subset(positions)
+
+
+@lru_cache(maxsize=None)
+def _open(path: str) -> BuildingIndex:
+    return BuildingIndex(path)
+
+
+@instrument
+def building_index(layer_path: str, node_size: int = BUILDING_INDEX_NODE_SIZE) -> BuildingIndex:
+    """ index de la couche de bâtiments layer_path, construit au premier appel puis ouvert depuis le cache """
+    name = os.path.splitext(os.path.basename(layer_path))[0]
+    cache = CacheEntry("building_index", building_index_name.format(name), os.path.dirname(layer_path),
+                       params={"node_size": node_size},
+                       inputs=[layer_path])
+    if not cache.hit():
+        build_building_index(read_layer(layer_path).reset_index(drop=True), cache.path, node_size=node_size)
+        cache.commit()
+    return _open(cache.path)
@@ -7,8 +7,13 @@ from src.config import *
 from src.utils import make_path, check_dir
 from src.traitements import AppariementRunner
 from src.traitements import get_communes_from_radius
+from src.radius import NestedRadiusEngine
+import shapely
+import warnings
 from shapely import Point
-from typing import Tuple
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Sequence, Tuple
 
 
 def compute_statistics(wh_t0, wh_t1, communes_t0, communes_t1, name, period: Tuple[str]):
@@ -30,7 +35,7 @@ def temporal_based_statistics(wh_df,
                        suffix): 
 
     pop = communes["POPUL"].sum()
-    area = communes.unary_union.area
+    area = COMMUNE_UNIONS.union_area(communes)
     n_wh = wh_df.ID.nunique()
     unitpop = 1e6
 
@@ -88,13 +93,295 @@ def global_statistics(name, period=Tuple[int]):
 def area_statistics(communes): 
 
     stats = {
-        "area": np.round(communes.unary_union.area / 1e6, 1),
+        "area": np.round(COMMUNE_UNIONS.union_area(communes) / 1e6, 1),
         "number_mun":communes.ID.nunique(),
     }
     
     return stats
 
 
+# --- géométrie des communes ---
+
+def commune_geometry_table(communes: gpd.GeoDataFrame,
+                           centroid: Tuple[float] = None,
+                           order: np.ndarray = None) -> gpd.GeoDataFrame:
+    """ table des communes dédoublonnées par ID : aire, distance au centre et aire cumulée de l'union.
+
+    Les communes sont triées selon order (défaut distance au centre) ; l'union des n premières a pour aire
+    union_area[n-1]. Les communes forment un pavage : la part d'une commune dans l'union est son aire moins
+    ses recouvrements avec les communes précédentes, et seuls les couples qui se recouvrent (et ne font
+    pas que se toucher) sont intersectés.
+    """
+    table = communes.copy()
+    if "dist_centre" not in table:
+        table["dist_centre"] = shapely.distance(table.geometry.values, Point(centroid))
+    table["ordre"] = table["dist_centre"].values if order is None else np.asarray(order)
+    table = table.sort_values("ordre", kind="stable").drop_duplicates("ID", keep="first").reset_index(drop=True)
+
+    geoms = np.asarray(table.geometry.values)
+    table["area"] = shapely.area(geoms)
+
+    query, tree = table.sindex.query(geoms, predicate="intersects")
+    earlier = tree < query
+    query, tree = query[earlier], tree[earlier]
+    overlap = ~shapely.touches(geoms[query], geoms[tree])
+    part = table["area"].values.copy()
+    for k, previous in pd.Series(tree[overlap]).groupby(query[overlap]):
+        part[k] -= shapely.area(shapely.intersection(geoms[k], shapely.union_all(geoms[previous.values])))
+    table["union_area"] = np.cumsum(part)
+    return table
+
+
+class CommuneUnions:
+    """ unions de communes mémorisées par ensemble (ID et aire, pour distinguer les millésimes).
+
+    Un ensemble nouveau part de la plus grande union en cache qu'il contient et n'y ajoute que les
+    communes manquantes : pour des rayons croissants, seul l'anneau ajouté est fusionné.
+    """
+    def __init__(self, max_entries: int = 64):
+        self.max_entries = max_entries
+        self._unions = OrderedDict()
+
+    def union_area(self, communes: gpd.GeoDataFrame) -> float:
+        communes = communes.drop_duplicates("ID")
+        geoms = np.asarray(communes.geometry.values)
+        keys = list(zip(communes["ID"].values, np.round(shapely.area(geoms), 3)))
+        query = frozenset(keys)
+        if query in self._unions:
+            self._unions.move_to_end(query)
+            return self._unions[query].area
+
+        base_keys, base = frozenset(), None
+        for cached, union in self._unions.items():
+            if len(cached) > len(base_keys) and cached <= query:
+                base_keys, base = cached, union
+        ring = [g for k, g in zip(keys, geoms) if k not in base_keys]
+        union = shapely.union_all(ring) if base is None else shapely.union(base, shapely.union_all(ring))
+
+        self._unions[query] = union
+        if len(self._unions) > self.max_entries:
+            self._unions.popitem(last=False)
+        return union.area
+
+
+COMMUNE_UNIONS = CommuneUnions()
+
+
+# --- statistiques continues en rayon ---
+
+class YearProfile:
+    """ Statistiques d'une année pour toute liste de rayons.
+
+    Communes et entrepôts portent leur rayon d'entrée (voir NestedRadiusEngine.communes_thresholds,
+    NestedRadiusEngine.warehouses_table) : triés par seuil, la zone d'un rayon est un préfixe et
+    les sommes (population, surfaces, centroïdes) des lectures de tableaux cumulés.
+    Les résultats par rayon sont mémorisés.
+
+    Args:
+        communes (gpd.GeoDataFrame): communes du rayon maximal (colonnes ID, POPUL, dist_centre).
+        communes_seuil (np.ndarray): rayon d'entrée de chaque commune.
+        warehouses (gpd.GeoDataFrame): entrepôts du rayon maximal avec colonne seuil.
+    """
+    def __init__(self,
+                 communes: gpd.GeoDataFrame,
+                 communes_seuil: np.ndarray,
+                 warehouses: gpd.GeoDataFrame):
+
+        self.communes = commune_geometry_table(communes, order=communes_seuil)
+        self.communes_seuil = self.communes["ordre"].values
+        self._pop_cum = np.concatenate([[0.0], np.cumsum(self.communes["POPUL"].fillna(0).values)])
+        self._area_union = np.concatenate([[0.0], self.communes["union_area"].values])
+
+        warehouses = warehouses.sort_values("seuil", kind="stable")
+        self.wh_seuil = warehouses["seuil"].values
+        self.wh_geometry = np.asarray(warehouses.geometry.values)
+        centroids = shapely.centroid(self.wh_geometry)
+        self.wh_x, self.wh_y = shapely.get_x(centroids), shapely.get_y(centroids)
+        self._area_cum = np.concatenate([[0.0], np.cumsum(shapely.area(self.wh_geometry))])
+        self._cx_cum = np.concatenate([[0.0], np.cumsum(self.wh_x)])
+        self._cy_cum = np.concatenate([[0.0], np.cumsum(self.wh_y)])
+        # unité du bootstrap : le bâtiment (ID), ses lignes partagent le même poids ; codes triés par seuil d'entrée
+        id_seuil = pd.Series(self.wh_seuil).groupby(warehouses["ID"].values).min().sort_values(kind="stable")
+        self._wh_id_seuil = id_seuil.values
+        self.wh_id_code = pd.Index(id_seuil.index).get_indexer(warehouses["ID"].values)
+
+        self._rows = {}
+        self._boot = {}
+
+    def _distances(self, n_rows: np.ndarray) -> np.ndarray:
+        """ distances (rayon x entrepôt) des polygones au barycentre des centroïdes de chaque rayon, 0 hors préfixe """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            center_x = self._cx_cum[n_rows] / n_rows
+            center_y = self._cy_cum[n_rows] / n_rows
+        width = n_rows.max() if len(n_rows) else 0
+        dist = shapely.distance(self.wh_geometry[None, :width], shapely.points(center_x, center_y)[:, None])
+        return np.where(np.arange(width)[None, :] < n_rows[:, None], dist, 0.0)
+
+    def _compute(self, radii: np.ndarray) -> pd.DataFrame:
+        n_com = np.searchsorted(self.communes_seuil, radii, side="right")
+        n_rows = np.searchsorted(self.wh_seuil, radii, side="right")
+        n_wh = np.searchsorted(self._wh_id_seuil, radii, side="right")
+
+        pop = self._pop_cum[n_com]
+        area = self._area_union[n_com]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            avg_size = self._area_cum[n_rows] / n_rows
+            gravity = self._distances(n_rows).sum(axis=1) / n_rows
+
+            pop_m = np.round(pop / 1e6, 2)
+            return pd.DataFrame({
+                "population": pop_m,
+                "density_pop_km2": np.round(pop / (area / 1e6), 2),
+                "number_ware": n_wh,
+                "number_ware_per_popM": np.round(n_wh / pop_m),
+                "number_ware_per_1000km2": n_wh / (area / 1000),
+                "avg_size_ware": np.round(avg_size, 2),
+                "gravity": np.round(gravity / 1000, 2),
+                "area": np.round(area / 1e6, 1),
+                "number_mun": n_com,
+            }, index=radii)
+
+    def statistics(self, radius_list: Sequence[float]) -> pd.DataFrame:
+        """ équivalent de temporal_based_statistics et area_statistics pour chaque rayon (index) """
+        radii = np.asarray(radius_list, dtype=float)
+        missing = np.array([r for r in np.unique(radii) if r not in self._rows])
+        if missing.size:
+            for r, row in self._compute(missing).iterrows():
+                self._rows[r] = row
+        stats = pd.DataFrame([self._rows[r] for r in radii], index=radii)
+        return stats.astype({"number_ware": int, "number_mun": int})
+
+    def bootstrap(self,
+                  radius_list: Sequence[float],
+                  n_boot: int = BOOTSTRAP_SAMPLES,
+                  seed: int = 0,
+                  batch_size: int = 256) -> Dict[str, np.ndarray]:
+        """ Bootstrap de Poisson des entrepôts de chaque rayon : gravité (km) et entrepôts / 1000 km² (R x B).
+
+        Chaque bâtiment (ID) reçoit un poids Poisson(1) par rééchantillon, commun à ses lignes et à tous les
+        rayons (préfixes). La gravité rééchantillonne les distances des polygones au barycentre utilisées par
+        statistics (barycentre de l'échantillon complet) ; la densité somme les poids des ID, comme nunique(ID).
+        Mémorisé par (rayons, n_boot, seed).
+        """
+        radii = np.asarray(radius_list, dtype=float)
+        key = (tuple(radii), n_boot, seed)
+        if key in self._boot:
+            return self._boot[key]
+
+        n_rows = np.searchsorted(self.wh_seuil, radii, side="right")
+        n_wh = np.searchsorted(self._wh_id_seuil, radii, side="right")
+        area = self._area_union[np.searchsorted(self.communes_seuil, radii, side="right")]
+        dist = self._distances(n_rows) / 1000
+        width = dist.shape[1]
+        codes = self.wh_id_code[:width]
+        rng = np.random.default_rng(seed)
+
+        gravity = np.full((len(radii), n_boot), np.nan)
+        count = np.zeros((len(radii), n_boot))
+        for start in range(0, n_boot, batch_size):
+            stop = min(start + batch_size, n_boot)
+            weights_id = rng.poisson(1.0, (stop - start, len(self._wh_id_seuil))).astype(np.float64)
+            id_cum = np.concatenate([np.zeros((stop - start, 1)), np.cumsum(weights_id, axis=1)], axis=1)
+            weights = weights_id[:, codes]
+            w_cum = np.concatenate([np.zeros((stop - start, 1)), np.cumsum(weights, axis=1)], axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                # (B x entrepôts) @ (entrepôts x rayons) : distances hors préfixe nulles
+                gravity[:, start:stop] = ((weights @ dist.T) / w_cum[:, n_rows]).T
+            count[:, start:stop] = id_cum[:, n_wh].T
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            density = count / (area[:, None] / 1000)
+
+        self._boot[key] = {"gravity": gravity, "number_ware_per_1000km2": density}
+        return self._boot[key]
+
+
+@lru_cache(maxsize=None)
+def year_profile(roi_name: str, date_analysis: str, centroid: Tuple[float] = None, **engine_kwargs) -> YearProfile:
+    """ profil d'une année, mémorisé : chaque époque ne fait que combiner deux profils """
+    centroid = ENTRY_ROI[roi_name]["CENTER"] if centroid is None else centroid
+    engine = NestedRadiusEngine(date_analysis=date_analysis, centroid=centroid, roi_name=roi_name, **engine_kwargs)
+    communes = engine.communes_table.rename({"POPULATION":"POPUL"}, axis=1)
+    return YearProfile(communes, engine.communes_thresholds(), engine.warehouses_table())
+
+
+def radius_statistics(profile_t0: YearProfile,
+                      profile_t1: YearProfile,
+                      name: str,
+                      period: Tuple[str],
+                      radius_list: Sequence[float],
+                      n_boot: int = 0) -> pd.DataFrame:
+    """ compute_statistics pour toute une liste de rayons : mêmes colonnes, une ligne par rayon.
+
+    n_boot > 0 : ajoute les intervalles de confiance par bootstrap (voir bootstrap_intervals).
+    """
+
+    period = list(map(int, period))
+    t0 = profile_t0.statistics(radius_list)
+    t1 = profile_t1.statistics(radius_list)
+    temporal = ["population", "density_pop_km2", "number_ware", "number_ware_per_popM",
+                "number_ware_per_1000km2", "avg_size_ware", "gravity"]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        evolution = pd.DataFrame({
+            "pop_change": t1["population"] - t0["population"],
+            "gravity_change": t1["gravity"] - t0["gravity"],
+            "number_ware_change": t1["number_ware"] - t0["number_ware"],
+            "perc_ware_change": ((t1["number_ware"] - t0["number_ware"]) / t0["number_ware"])*100,
+            "number_ware_per_popM_change": t1["number_ware_per_popM"] - t0["number_ware_per_popM"],
+            "log_sprawl_measure": (t1["gravity"] - t0["gravity"]) / (period[1] - period[0]),
+        })
+
+    global_stats = pd.DataFrame([global_statistics(name, period)] * len(t1), index=t1.index)
+    df = pd.concat([global_stats,
+                    t1[["area", "number_mun"]],
+                    t0[temporal].add_suffix("_t0"),
+                    t1[temporal].add_suffix("_t1"),
+                    evolution], axis=1)
+    df.index = (df.index / 1000).rename("radius")
+    if n_boot:
+        df = pd.concat([df, bootstrap_intervals(profile_t0, profile_t1, period, radius_list, n_boot=n_boot)], axis=1)
+    return df
+
+
+def bootstrap_intervals(profile_t0: YearProfile,
+                        profile_t1: YearProfile,
+                        period: Tuple[str],
+                        radius_list: Sequence[float],
+                        n_boot: int = BOOTSTRAP_SAMPLES,
+                        alpha: float = BOOTSTRAP_ALPHA,
+                        seed: int = 0) -> pd.DataFrame:
+    """ intervalles de confiance (percentiles) de la gravité, de la densité d'entrepôts et de l'étalement.
+
+    Les deux années sont rééchantillonnées indépendamment ; colonnes <stat>_ci_low / <stat>_ci_high,
+    index radius en km comme radius_statistics.
+    """
+    period = list(map(int, period))
+    boot_t0 = profile_t0.bootstrap(radius_list, n_boot=n_boot, seed=seed)
+    boot_t1 = profile_t1.bootstrap(radius_list, n_boot=n_boot, seed=seed + 1)
+
+    samples = {
+        "gravity_t0": boot_t0["gravity"],
+        "gravity_t1": boot_t1["gravity"],
+        "number_ware_per_1000km2_t0": boot_t0["number_ware_per_1000km2"],
+        "number_ware_per_1000km2_t1": boot_t1["number_ware_per_1000km2"],
+        "gravity_change": boot_t1["gravity"] - boot_t0["gravity"],
+        "log_sprawl_measure": (boot_t1["gravity"] - boot_t0["gravity"]) / (period[1] - period[0]),
+    }
+    intervals = {}
+    with warnings.catch_warnings():
+        # rayons sans entrepôt : intervalles indéfinis
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for stat, values in samples.items():
+            low, high = np.nanpercentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=1)
+            intervals[f"{stat}_ci_low"] = np.round(low, 2)
+            intervals[f"{stat}_ci_high"] = np.round(high, 2)
+
+    df = pd.DataFrame(intervals, index=np.asarray(radius_list, dtype=float) / 1000)
+    df.index = df.index.rename("radius")
+    return df
+
 
 if __name__ == "__main__": 
     pass
\ No newline at end of file
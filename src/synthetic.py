@@ -0,0 +1,245 @@
+"""
+Données synthétiques aux formats des entrées du pipeline
+
+- stock SIREN (csv ',') : établissements avec une à trois périodes, nomenclature selon la date de début,
+  une petite part de codes d'entrepôts (WAREHOUSE_CODES)
+- GeoSIREN (csv ';') : un point par siret, concentré autour du centre de la zone d'étude, le reste
+  réparti sur la métropole, quelques points hors Lambert 93
+- BDTOPO : communes en pavage de Voronoï (population décroissante avec la distance au centre) et
+  bâtiments industriels, dont une partie à quelques mètres des points d'entrepôts
+
+Les csv sont écrits par blocs : de 10k à plus de 30M lignes en mémoire bornée.
+Les fichiers sont écrits aux chemins de src.config ; le répertoire des données doit être redirigé
+par la variable d'environnement LOGISTICS_SPRAWL_DATA pour ne pas écraser les données réelles.
+"""
+import argparse
+import os
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely import MultiPoint, box
+
+from src.config import *
+from src.traitements import bati_indus_file, communes_file, warehouse_codes_pattern
+from src.utils import check_dir, write_layer
+from src.metrics import instrument
+import logging
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+SYNTHETIC_ROI = "synthetic"
+SYNTHETIC_CENTER = ENTRY_ROI["lyon"]["CENTER"]
+# emprise Lambert 93 de la métropole
+FRANCE_BOUNDS = (100_000.0, 6_050_000.0, 1_200_000.0, 7_100_000.0)
+# rayon des points et communes générés autour du centre (au-delà du rayon maximal)
+ROI_EXTENT = DIST_RADIUS + 15_000
+
+# nomenclature en vigueur selon l'année de début de la période
+NOMENCLATURE_YEARS = [(1993, "NAP"), (2003, "NAF1993"), (2008, "NAFRev1"), (9999, "NAFRev2")]
+# préfixes à 2 chiffres qui ne peuvent pas former un code d'entrepôt
+OTHER_PREFIXES = np.array([p for p in range(10, 100) if p not in (52, 63, 73)])
+
+
+def _radial_points(rng: np.random.Generator, n: int, center: Tuple[float], extent: float) -> Tuple[np.ndarray, np.ndarray]:
+    """ points plus denses au centre (distance ~ extent * u^1.5) """
+    dist = extent * rng.uniform(0, 1, n) ** 1.5
+    angle = rng.uniform(0, 2 * np.pi, n)
+    return center[0] + dist * np.cos(angle), center[1] + dist * np.sin(angle)
+
+
+def _siren_chunk(rng: np.random.Generator,
+                 first_siret: int,
+                 n_rows: int,
+                 warehouse_share: float) -> pd.DataFrame:
+    """ un bloc du stock SIREN : n_rows périodes d'environ n_rows / 1.5 établissements """
+    n_etab = max(1, int(n_rows / 1.5))
+    siret = 10**13 + first_siret + np.sort(rng.integers(0, n_etab, n_rows))
+
+    start = pd.Timestamp("1973-01-01") + pd.to_timedelta(rng.integers(0, 51 * 365, n_rows), unit="D")
+    end = start + pd.to_timedelta(rng.exponential(8 * 365, n_rows).astype(int) + 1, unit="D")
+    opened = rng.uniform(0, 1, n_rows) < 0.4
+
+    nomenclature = np.empty(n_rows, dtype=object)
+    for limit, name in reversed(NOMENCLATURE_YEARS):
+        nomenclature[start.year.values < limit] = name
+
+    activity = pd.Series(rng.choice(OTHER_PREFIXES, n_rows)).astype(str) + "." + pd.Series(rng.integers(10, 99, n_rows)).astype(str) + "Z"
+    warehouse = np.flatnonzero(rng.uniform(0, 1, n_rows) < warehouse_share)
+    for name, codes in WAREHOUSE_CODES.items():
+        idx = warehouse[nomenclature[warehouse] == name]
+        suffix = "0B" if name == "NAFRev2" else ""
+        activity.iloc[idx] = [c + suffix for c in rng.choice(codes, idx.size)]
+
+    return pd.DataFrame({
+        "siren": (siret // 10**5).astype(str),
+        "siret": siret.astype(str),
+        "dateDebut": start.strftime("%Y-%m-%d"),
+        "dateFin": np.where(opened, "", end.strftime("%Y-%m-%d")),
+        "etatAdministratifEtablissement": np.where(opened, "A", "F"),
+        "activitePrincipaleEtablissement": activity.values,
+        "nomenclatureActivitePrincipaleEtablissement": nomenclature,
+    })
+
+
+def _geosiren_chunk(rng: np.random.Generator,
+                    sirets: np.ndarray,
+                    center: Tuple[float],
+                    roi_share: float) -> pd.DataFrame:
+    """ un point par siret : part roi_share autour du centre, le reste sur la métropole """
+    n = sirets.size
+    in_roi = rng.uniform(0, 1, n) < roi_share
+    x = rng.uniform(FRANCE_BOUNDS[0], FRANCE_BOUNDS[2], n)
+    y = rng.uniform(FRANCE_BOUNDS[1], FRANCE_BOUNDS[3], n)
+    x[in_roi], y[in_roi] = _radial_points(rng, int(in_roi.sum()), center, ROI_EXTENT)
+
+    epsg = np.where(rng.uniform(0, 1, n) < 0.97, CRS, 4326)
+    other = epsg != CRS
+    x[other], y[other] = rng.uniform(-5, 9, other.sum()), rng.uniform(41, 51, other.sum())
+    return pd.DataFrame({
+        "siret": sirets.astype(str),
+        "x": np.round(x, 2),
+        "y": np.round(y, 2),
+        "qualite_xy": rng.choice(["11", "12", "21", "22", "33"], n),
+        "epsg": epsg,
+    })
+
+
+@instrument
+def generate_siren_geosiren(n_rows: int,
+                            center: Tuple[float] = SYNTHETIC_CENTER,
+                            warehouse_share: float = 0.005,
+                            roi_share: float = 0.05,
+                            chunksize: int = SIREN_CHUNKSIZE,
+                            seed: int = 0) -> np.ndarray:
+    """ Ecrit les csv SIREN et GeoSIREN par blocs.
+
+    Args:
+        n_rows (int): nombre de lignes du stock SIREN.
+        center (Tuple[float], optional): centre de la zone d'étude. Defaults to SYNTHETIC_CENTER.
+        warehouse_share (float, optional): part des périodes avec un code d'entrepôt. Defaults to 0.005.
+        roi_share (float, optional): part des points autour du centre. Defaults to 0.05.
+        chunksize (int, optional): lignes par bloc. Defaults to SIREN_CHUNKSIZE.
+        seed (int, optional): graine. Defaults to 0.
+
+    Returns:
+        np.ndarray: coordonnées (n, 2) des points d'entrepôts Lambert 93 autour du centre.
+    """
+    rng = np.random.default_rng(seed)
+    check_dir(os.path.dirname(SirenFPath))
+    warehouse_xy = []
+
+    for i, first in enumerate(range(0, n_rows, chunksize)):
+        siren = _siren_chunk(rng, first, min(chunksize, n_rows - first), warehouse_share)
+        siren.to_csv(SirenFPath, mode="w" if i == 0 else "a", header=(i == 0), index=False)
+
+        sirets = siren["siret"].astype("int64").unique()
+        geosiren = _geosiren_chunk(rng, sirets, center, roi_share)
+        geosiren.to_csv(GeosirenFPath, sep=";", mode="w" if i == 0 else "a", header=(i == 0), index=False)
+
+        key = siren["nomenclatureActivitePrincipaleEtablissement"].str.cat(siren["activitePrincipaleEtablissement"], sep="|")
+        is_warehouse = geosiren["siret"].isin(siren.loc[key.str.match(warehouse_codes_pattern()), "siret"])
+        near = is_warehouse & (geosiren["epsg"] == CRS) & (np.hypot(geosiren["x"] - center[0], geosiren["y"] - center[1]) < ROI_EXTENT)
+        warehouse_xy.append(geosiren.loc[near, ["x", "y"]].to_numpy())
+
+    logger.info(f"Synthetic SIREN / GeoSIREN : {n_rows} rows")
+    return np.concatenate(warehouse_xy) if warehouse_xy else np.empty((0, 2))
+
+
+def synthetic_communes(rng: np.random.Generator,
+                       n_communes: int = 300,
+                       center: Tuple[float] = SYNTHETIC_CENTER) -> gpd.GeoDataFrame:
+    """ pavage de Voronoï autour du centre, communes plus petites et plus peuplées au centre """
+    x, y = _radial_points(rng, n_communes, center, ROI_EXTENT)
+    extent = box(center[0] - ROI_EXTENT, center[1] - ROI_EXTENT, center[0] + ROI_EXTENT, center[1] + ROI_EXTENT)
+    cells = shapely.get_parts(shapely.voronoi_polygons(MultiPoint(np.column_stack([x, y])), extend_to=extent))
+    cells = shapely.intersection(cells, extent)
+
+    dist = shapely.distance(cells, shapely.Point(center))
+    population = np.round(rng.lognormal(8, 1, cells.size) * np.exp(-dist / 10_000) * 10).astype(int) + 50
+    return gpd.GeoDataFrame(
+        {"ID": [f"COMMUNE_{i:08d}" for i in range(cells.size)],
+         "NOM": [f"Commune {i}" for i in range(cells.size)],
+         "POPULATION": population},
+        geometry=cells,
+        crs=CRS,
+    )
+
+
+def synthetic_bati_indus(rng: np.random.Generator,
+                         warehouse_xy: np.ndarray,
+                         n_background: int,
+                         center: Tuple[float] = SYNTHETIC_CENTER,
+                         matched_share: float = 0.8) -> gpd.GeoDataFrame:
+    """ bâtiments rectangulaires : grands bâtiments près des points d'entrepôts, petits au hasard """
+    matched = warehouse_xy[rng.uniform(0, 1, len(warehouse_xy)) < matched_share]
+    # surfaces log-normales : médiane ~ 2500 m² pour les entrepôts, ~ 400 m² sinon
+    side_wh = np.sqrt(rng.lognormal(np.log(2500), 0.8, len(matched)))
+    bx, by = _radial_points(rng, n_background, center, ROI_EXTENT)
+    side_bg = np.sqrt(rng.lognormal(np.log(400), 0.9, n_background))
+
+    x = np.concatenate([matched[:, 0] + rng.normal(0, 20, len(matched)), bx])
+    y = np.concatenate([matched[:, 1] + rng.normal(0, 20, len(matched)), by])
+    side = np.concatenate([side_wh, side_bg])
+    ratio = rng.uniform(0.5, 2, side.size)
+    w, h = side * np.sqrt(ratio), side / np.sqrt(ratio)
+    return gpd.GeoDataFrame(
+        {"ID": [f"BATIMENT{i:016d}" for i in range(side.size)],
+         "NATURE": BDTOPO_NATURE_INDUS},
+        geometry=box(x - w / 2, y - h / 2, x + w / 2, y + h / 2),
+        crs=CRS,
+    )
+
+
+@instrument
+def generate_dataset(n_rows: int,
+                     name: str = SYNTHETIC_ROI,
+                     center: Tuple[float] = SYNTHETIC_CENTER,
+                     years: Sequence[str] = SELECTED_YEARS,
+                     seed: int = 0,
+                     force: bool = False) -> List[str]:
+    """ Jeu de données synthétique complet : csv SIREN / GeoSIREN et couches BDTOPO de chaque année.
+
+    Args:
+        n_rows (int): nombre de lignes du stock SIREN (10k à 30M+).
+        name (str, optional): nom de la zone d'étude. Defaults to SYNTHETIC_ROI.
+        center (Tuple[float], optional): centre de la zone d'étude. Defaults to SYNTHETIC_CENTER.
+        years (Sequence[str], optional): années des couches BDTOPO. Defaults to SELECTED_YEARS.
+        seed (int, optional): graine. Defaults to 0.
+        force (bool, optional): écrit même sans redirection du répertoire des données. Defaults to False.
+
+    Returns:
+        List[str]: fichiers écrits.
+    """
+    if DATA_DIR_ENV not in os.environ and not force:
+        raise RuntimeError(f"set {DATA_DIR_ENV} to a scratch directory before generating synthetic data")
+
+    rng = np.random.default_rng(seed)
+    warehouse_xy = generate_siren_geosiren(n_rows, center=center, seed=seed)
+    communes = synthetic_communes(rng, center=center)
+    bati_indus = synthetic_bati_indus(rng, warehouse_xy, n_background=max(1_000, 2 * len(warehouse_xy)), center=center)
+
+    paths = [SirenFPath, GeosirenFPath]
+    for year in years:
+        # quelques bâtiments disparaissent d'un millésime à l'autre
+        kept = bati_indus[rng.uniform(0, 1, len(bati_indus)) < 0.98]
+        check_dir(os.path.dirname(communes_file(name, year)))
+        paths.append(write_layer(communes, communes_file(name, year), index=False))
+        paths.append(write_layer(kept, bati_indus_file(name, year), index=False))
+
+    logger.info(f"Synthetic dataset {name} : {n_rows} rows, {len(communes)} communes, {len(bati_indus)} buildings")
+    return paths
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="generate a synthetic SIREN / GeoSIREN / BDTOPO dataset")
+    parser.add_argument("--rows", type=int, default=10_000, help="rows of the SIREN stock")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--force", action="store_true", help=f"write even if {DATA_DIR_ENV} is not set")
+    args = parser.parse_args()
+
+    generate_dataset(args.rows, seed=args.seed, force=args.force)
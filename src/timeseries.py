@@ -0,0 +1,238 @@
+"""
+Séries temporelles annuelles (ou mensuelles) de l'étalement logistique
+
+Au lieu d'un traitement complet par date (filtre SIREN, jointure GeoSIREN, appariement BDTOPO),
+l'ensemble des entrepôts est construit une seule fois :
+- toutes les périodes d'entrepôts chevauchant la fenêtre d'étude, géolocalisées dans la zone du rayon maximal
+- appariement de chaque période (point) avec les bâtiments d'un millésime BDTOPO (NestedRadiusEngine) ;
+  la série est découpée par millésime le plus proche de chaque pas (un moteur par millésime, voir nearest_vintages)
+puis la série avance dans le temps en appliquant les ouvertures (dateDebut) et fermetures (dateFin) :
+un bâtiment est actif tant qu'au moins une période associée l'est, effectifs, surfaces et barycentre
+sont mis à jour par différences, la gravité est recalculée sur les seuls bâtiments actifs.
+number_ware compte les identifiants de bâtiments distincts, comme temporal_based_statistics.
+"""
+import argparse
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely import Point
+
+from src.config import *
+from src import metrics
+from src.cache import CacheEntry, evict_run
+from src.ingest import read_siren_table, write_siren_table
+from src.radius import NestedRadiusEngine
+from src.stats import commune_geometry_table
+from src.traitements import JoinSirenGeosiren, SemiJoinGeoSiren, TraitementSirenPeriodes
+from src.utils import check_dir, make_path
+from src.metrics import instrument
+import logging
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level = logging.INFO)
+logger = logging.getLogger(__name__)
+
+# pas de temps des séries : début d'année ou de mois
+FREQUENCIES = {"year": "YS", "month": "MS"}
+
+
+def nearest_vintages(dates: pd.DatetimeIndex, years: List[str] = SELECTED_YEARS) -> np.ndarray:
+    """ millésime BDTOPO le plus proche (1er janvier) de chaque date, le plus ancien en cas d'égalité """
+    vintages = pd.DatetimeIndex([f"{y}-01-01" for y in years])
+    gap = np.abs(pd.DatetimeIndex(dates).values[:, None] - vintages.values[None, :])
+    return np.asarray(years)[np.argmin(gap, axis=1)]
+
+
+def log_sprawl_measure(df: pd.DataFrame) -> pd.DataFrame:
+    """ variation annualisée de la gravité entre deux pas consécutifs, par rayon """
+    df = df.sort_values(["radius", "date"]).reset_index(drop=True)
+    years = pd.to_datetime(df["date"]).dt.year + (pd.to_datetime(df["date"]).dt.dayofyear - 1) / 365.25
+    df["log_sprawl_measure"] = df.groupby("radius")["gravity"].diff() / years.groupby(df["radius"]).diff()
+    return df
+
+
+class TimeSeriesEngine(NestedRadiusEngine):
+    """ Entrepôts actifs à chaque pas de temps entre date_start et date_end, pour toute liste de rayons.
+
+    Les bâtiments et communes sont ceux d'un seul millésime (bdtopo_year) : timeseries découpe la série
+    par millésime le plus proche et lance un moteur par millésime.
+
+    Args:
+        centroid (Tuple[float]): centre de la zone d'étude.
+        roi_name (str): nom de la zone d'étude.
+        date_start (str): début de la série YYYY-MM-DD.
+        date_end (str): fin de la série YYYY-MM-DD.
+        bdtopo_year (str, optional): millésime BDTOPO (communes, bâtiments) de référence. Defaults to SELECTED_YEARS[-1].
+        **kwargs: options de NestedRadiusEngine (max_radius, dist_siren_bdtopo, seuil_surf_ent).
+    """
+    def __init__(self,
+                 centroid: Tuple[float],
+                 roi_name: str,
+                 date_start: str,
+                 date_end: str,
+                 bdtopo_year: str = SELECTED_YEARS[-1],
+                 **kwargs):
+        super().__init__(date_analysis=f"{bdtopo_year}-01-01", centroid=centroid, roi_name=roi_name, **kwargs)
+        self.date_start = pd.Timestamp(date_start)
+        self.date_end = pd.Timestamp(date_end)
+
+    def window_periods_path(self) -> str:
+        """ périodes d'entrepôts chevauchant la fenêtre (une lecture de la table des périodes) """
+        periods_path = TraitementSirenPeriodes()
+        window = f"{self.date_start.date()}_{self.date_end.date()}"
+        cache = CacheEntry("siren_window", siren_name.format(window), check_dir(processed_data_path, "SIREN"),
+                           params={"start": str(self.date_start.date()), "end": str(self.date_end.date())},
+                           inputs=[periods_path])
+        if not cache.hit():
+            periods = read_siren_table(periods_path)
+            periods = periods[(periods["dateDebut"] < self.date_end) & (periods["dateFin"] > self.date_start)]
+            logger.info(f"Time series periods {window} : {periods.shape}")
+            write_siren_table(periods, cache.path)
+            cache.commit()
+        return cache.path
+
+    def merged_siren_path(self) -> str:
+        """ périodes géolocalisées dans la zone du rayon maximal : un point par période """
+        if self._merged_siren_path is None:
+            window_path = self.window_periods_path()
+            geosiren = SemiJoinGeoSiren(siren_date_path=window_path,
+                                        centroid=self.centroid,
+                                        name=self.roi_name,
+                                        year=self.year,
+                                        r=self.max_radius)
+            self._merged_siren_path = JoinSirenGeosiren(siren_date_path=window_path,
+                                                        geosiren_zone_path=geosiren,
+                                                        year=self.year,
+                                                        name=self.roi_name,
+                                                        r=self.max_radius)
+        return self._merged_siren_path
+
+    @instrument
+    def sweep(self, dates: pd.DatetimeIndex, radius_list: List[int] = RADIUS_LIST) -> pd.DataFrame:
+        """ statistiques à chaque date et rayon, par application des ouvertures / fermetures.
+
+        Returns:
+            pandas.DataFrame: une ligne par (date, radius) : number_ware, avg_size_ware, gravity,
+            number_ware_per_1000km2, number_ware_per_popM, log_sprawl_measure (variation annualisée).
+        """
+        self._prepare()
+        seuil_points = self.points_thresholds()
+        dates = pd.DatetimeIndex(dates)
+
+        # bâtiments d'entrepôt candidats (surface, doublons) comme AppSirenBDTopo
+        bati = self._bati
+        keep = (bati["geometry"].area > self.seuil_surf_ent) & ~bati.duplicated(keep="first")
+        bati_pos = np.full(len(bati), -1)
+        bati_pos[np.flatnonzero(keep.values)] = np.arange(int(keep.sum()))
+        geoms = np.asarray(bati.geometry.values[keep.values])
+        # un même ID peut porter plusieurs géométries : number_ware compte les ID distincts
+        id_code, ids = pd.factorize(bati["ID"].values[keep.values])
+        area = shapely.area(geoms)
+        centroids = shapely.centroid(geoms)
+        cx, cy = shapely.get_x(centroids), shapely.get_y(centroids)
+
+        assoc = self._assoc.assign(pos=bati_pos[bati.index.get_indexer(self._assoc["bati_index"].values)])
+        assoc = assoc[assoc["pos"] >= 0]
+        point_index = assoc["point_index"].values
+        # pas d'ouverture : première date > dateDebut ; pas de fermeture : première date >= dateFin
+        steps = dates.values.astype("datetime64[ns]")
+        opens = np.searchsorted(steps, self._points["dateDebut"].values[point_index].astype("datetime64[ns]"), side="right")
+        closes = np.searchsorted(steps, self._points["dateFin"].values[point_index].astype("datetime64[ns]"), side="left")
+        # période active à aucune date de la série (dateFin <= date <= dateDebut) : jamais comptée, comme snapshot_siren ;
+        # sinon sa fermeture précéderait son ouverture et le compteur du bâtiment deviendrait négatif
+        counted = opens < closes
+
+        communes = commune_geometry_table(self.communes_table, order=self.communes_thresholds())
+        zone_area = np.concatenate([[0.0], communes["union_area"].values])
+        zone_pop = np.concatenate([[0.0], np.cumsum(communes["POPULATION" if "POPULATION" in communes else "POPUL"].fillna(0).values)])
+
+        rows = []
+        for r in radius_list:
+            in_zone = (seuil_points[point_index] <= r) & counted
+            pos, row_open, row_close = assoc["pos"].values[in_zone], opens[in_zone], closes[in_zone]
+            n_com = np.searchsorted(communes["ordre"].values, r, side="right")
+
+            counter = np.zeros(len(geoms), dtype=np.int64)
+            active = np.zeros(len(geoms), dtype=bool)
+            id_counter = np.zeros(len(ids), dtype=np.int64)
+            n, n_id, sum_area, sum_x, sum_y = 0, 0, 0.0, 0.0, 0.0
+            for k, date in enumerate(dates):
+                np.add.at(counter, pos[row_open == k], 1)
+                np.subtract.at(counter, pos[row_close == k], 1)
+                now = counter > 0
+                added, removed = np.flatnonzero(now & ~active), np.flatnonzero(active & ~now)
+                active = now
+
+                # mises à jour par différences
+                n += added.size - removed.size
+                np.subtract.at(id_counter, id_code[removed], 1)
+                n_id -= np.count_nonzero(id_counter[np.unique(id_code[removed])] == 0)
+                n_id += np.count_nonzero(id_counter[np.unique(id_code[added])] == 0)
+                np.add.at(id_counter, id_code[added], 1)
+                sum_area += area[added].sum() - area[removed].sum()
+                sum_x += cx[added].sum() - cx[removed].sum()
+                sum_y += cy[added].sum() - cy[removed].sum()
+
+                gravity = np.nan
+                if n:
+                    center = Point(sum_x / n, sum_y / n)
+                    gravity = np.round(shapely.distance(geoms[active], center).mean() / 1000, 2)
+                pop_m = np.round(zone_pop[n_com] / 1e6, 2)
+                rows.append({
+                    "date": date.date(),
+                    "radius": int(r / 1000),
+                    "number_ware": n_id,
+                    "avg_size_ware": np.round(sum_area / n, 2) if n else np.nan,
+                    "gravity": gravity,
+                    "number_ware_per_1000km2": n_id / (zone_area[n_com] / 1000) if zone_area[n_com] else np.nan,
+                    "number_ware_per_popM": np.round(n_id / pop_m) if pop_m else np.nan,
+                })
+            metrics.rows(rows_out=len(rows))
+
+        return log_sprawl_measure(pd.DataFrame(rows))
+
+
+def timeseries(roi_name: str,
+               date_start: str,
+               date_end: str,
+               freq: str = "year",
+               radius_list: List[int] = RADIUS_LIST,
+               bdtopo_year: str = None,
+               centroid: Tuple[float] = None) -> pd.DataFrame:
+    """ série temporelle d'une métropole, enregistrée dans reports/<roi>
+
+    Chaque pas est calculé avec le millésime BDTOPO le plus proche (bdtopo_year : un seul millésime imposé) ;
+    la colonne bdtopo_year indique le millésime utilisé.
+    """
+    centroid = ENTRY_ROI[roi_name]["CENTER"] if centroid is None else centroid
+    dates = pd.date_range(date_start, date_end, freq=FREQUENCIES[freq])
+    vintages = nearest_vintages(dates) if bdtopo_year is None else np.full(len(dates), bdtopo_year)
+
+    frames = []
+    with metrics.tags(roi=roi_name):
+        for vintage in pd.unique(vintages):
+            engine = TimeSeriesEngine(centroid, roi_name, date_start, date_end, bdtopo_year=vintage)
+            frames.append(engine.sweep(dates[vintages == vintage], radius_list).assign(bdtopo_year=vintage))
+    df = log_sprawl_measure(pd.concat(frames, ignore_index=True))
+
+    out_dir = check_dir(project_path, "reports", roi_name)
+    df.to_csv(make_path(f"timeseries_{roi_name}_{dates[0].date()}_{dates[-1].date()}_{freq}.csv", out_dir), index=False)
+    metrics.write_report(roi_name)
+    evict_run()
+    return df
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="annual / monthly logistics sprawl time series")
+    parser.add_argument("--roi", nargs="+", default=[ROI_NAME], choices=list(ENTRY_ROI), help="regions of interest")
+    parser.add_argument("--start", default=f"{SELECTED_YEARS[0]}-01-01")
+    parser.add_argument("--end", default=f"{SELECTED_YEARS[-1]}-01-01")
+    parser.add_argument("--freq", choices=list(FREQUENCIES), default="year")
+    parser.add_argument("--bdtopo-year", default=None, help="single BDTOPO vintage for communes and buildings (default: nearest to each step)")
+    args = parser.parse_args()
+
+    for roi in args.roi:
+        timeseries(roi, args.start, args.end, freq=args.freq, bdtopo_year=args.bdtopo_year)
@@ -6,27 +6,177 @@ Creation: février 2024
 """
 
 # Importations
-from typing import Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Union
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import os
+import re
 from datetime import datetime
+import shapely
+import pyarrow.parquet as pq
 from shapely import Point, LineString, Polygon
-from shapely.ops import nearest_points
 from src.config import *
-from src.utils import check_dir, get_year_from_datestring, make_path, timeit
+from src.utils import check_dir, get_year_from_datestring, make_path, read_layer, write_layer
+from src.ingest import (
+    SIREN_CSV_DTYPES,
+    SIREN_SCHEMA,
+    geosiren_parquet_files,
+    read_geosiren_parquet,
+    read_siren_parquet,
+    read_siren_table,
+    siren_arrow_table,
+    typed_siren,
+    write_siren_table,
+)
+from src.cache import CacheEntry
+from src.spatial_index import building_index
+from src import metrics
+from src.metrics import instrument
 import logging
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s ::  %(message)s', level = logging.INFO)
 logger = logging.getLogger(__name__)
 
+def siren_source() -> str:
+    """ stock SIREN lu par le pipeline : jeu Parquet s'il a été ingéré, sinon le csv """
+    return SirenParquetPath if os.path.isdir(SirenParquetPath) else SirenFPath
+
+
+def geosiren_source() -> str:
+    return GeosirenParquetPath if os.path.isdir(GeosirenParquetPath) else GeosirenFPath
+
+
+def communes_file(name: str, year: str) -> str:
+    """ communes de la zone d'étude extraites par download_bdtopo """
+    return os.path.join(communes_roi_dir.format(name, year), communes_roi_file_name.format(name, year))
+
+
+SIREN_COLUMNS = SIREN_SCHEMA.names
+
+
+def as_siret(siret: pd.Series) -> pd.Series:
+    """ siret en int64, sans conversion si la colonne l'est déjà (sorties antérieures au schéma compact) """
+    return siret if siret.dtype == "int64" else siret.astype("int64")
+
+
+def warehouse_codes_pattern(codes: dict = WAREHOUSE_CODES) -> str:
+    """ expression régulière unique 'nomenclature|code' couvrant toutes les nomenclatures d'entrepôts """
+    alternatives = [
+        f"{re.escape(nomenclature)}[^|]*\\|(?:{'|'.join(re.escape(c) for c in prefixes)})"
+        for nomenclature, prefixes in codes.items()
+    ]
+    return f"(?:{'|'.join(alternatives)})"
+
+
+def _match_code_pairs(nomenclature: pd.Series, activity: pd.Series, pattern: str) -> np.ndarray:
+    """ motif 'nomenclature|code' évalué une seule fois par couple distinct de catégories """
+    n_act = len(activity.cat.categories) + 1
+    pair = (nomenclature.cat.codes.values.astype(np.int64) + 1) * n_act + activity.cat.codes.values.astype(np.int64) + 1
+    inverse, uniques = pd.factorize(pair)
+    nom_idx, act_idx = uniques // n_act - 1, uniques % n_act - 1
+    valid = (nom_idx >= 0) & (act_idx >= 0)
+
+    keys = pd.Series(np.asarray(nomenclature.cat.categories, dtype=str)[nom_idx[valid]])
+    keys = keys.str.cat(pd.Series(np.asarray(activity.cat.categories, dtype=str)[act_idx[valid]]), sep="|")
+    match = np.zeros(len(uniques), dtype=bool)
+    match[valid] = keys.str.match(pattern).values
+    return match[inverse]
+
+
+def filter_warehouses(siren: pd.DataFrame) -> pd.DataFrame:
+    """ Filtre les établissements entrepôts (NAP, NAF1993, NAFRev1, NAFRev2) en une seule recherche vectorisée.
+
+    Args:
+        siren (pandas.DataFrame): bloc du stock SIREN (colonnes SIREN_COLUMNS, texte ou schéma compact).
+
+    Returns:
+        pandas.DataFrame: périodes d'entrepôts au schéma compact, dates de début et de fin renseignées.
+    """
+    siren = typed_siren(siren)
+    mask = _match_code_pairs(siren["nomenclatureActivitePrincipaleEtablissement"],
+                             siren["activitePrincipaleEtablissement"],
+                             warehouse_codes_pattern())
+    siren_ent = siren[mask].copy()
+
+    siren_ent["dateFin"] = siren_ent["dateFin"].fillna(datetime.strptime('2050-01-01','%Y-%m-%d'))
+    siren_ent["dateDebut"] = siren_ent["dateDebut"].fillna(datetime.strptime('1900-01-01','%Y-%m-%d'))
+    return siren_ent
+
+
+def snapshot_siren(siren_ent: pd.DataFrame, date: datetime) -> pd.DataFrame:
+    """ entrepôts actifs à la date voulue """
+    return siren_ent[(siren_ent["dateDebut"] < date) & (siren_ent["dateFin"] > date)]
+
+
+# Etape 1bis : table des périodes d'entrepôts, toutes dates confondues
+@instrument
+def TraitementSirenPeriodes(chunksize: int = SIREN_CHUNKSIZE):
+    """ Etape 1bis : lecture unique et par blocs du stock SIREN.
+
+    La mémoire reste bornée par la taille d'un bloc quelle que soit la taille du stock.
+
+    Args:
+        chunksize (int, optional): nombre de lignes par bloc. Defaults to SIREN_CHUNKSIZE.
+
+    Returns:
+        str: chemin de la table des périodes d'entrepôts (siret, codes, dateDebut, dateFin).
+    """
+    SirenEntrepotsFolder = check_dir(processed_data_path, "SIREN")
+    cache = CacheEntry("siren_periods", siren_periods_name, SirenEntrepotsFolder,
+                       params={"codes": WAREHOUSE_CODES},
+                       inputs=[siren_source()])
+    periods_path = cache.path
+
+    if cache.hit():
+        logger.info("Load Siren periods file")
+        return periods_path
+
+    # sortie absente ou sans fiche (ex. interruption entre os.replace et commit) : reconstruite puis enregistrée
+    if os.path.isdir(SirenParquetPath):
+
+        logger.info("Read Siren parquet partitions")
+        siren = read_siren_parquet(SIREN_COLUMNS)
+        siren_ent = filter_warehouses(siren)
+        write_siren_table(siren_ent, periods_path)
+        logger.info(f"SIREN periodes : {len(siren_ent)}")
+        metrics.rows(rows_in=len(siren), rows_out=len(siren_ent))
+
+        return cache.commit()
+
+    logger.info("Stream Siren file")
+    tmp_path = periods_path + ".tmp"
+    n_rows, n_read = 0, 0
+
+    reader = pd.read_csv(SirenFPath,
+                         usecols=SIREN_COLUMNS,
+                         dtype=SIREN_CSV_DTYPES,
+                         chunksize=chunksize,
+                         )
+    with pq.ParquetWriter(tmp_path, SIREN_SCHEMA) as writer:
+        for chunk in reader:
+            siren_ent = filter_warehouses(chunk)
+            writer.write_table(siren_arrow_table(siren_ent))
+            n_rows += len(siren_ent)
+            n_read += len(chunk)
+
+    os.replace(tmp_path, periods_path)
+    logger.info(f"SIREN periodes : {n_rows}")
+    metrics.rows(rows_in=n_read, rows_out=n_rows)
+
+    return cache.commit()
+
+
 # Etape 1 : traitement de SIREN
-@timeit
-def TraitementSiren(date):
+@instrument
+def TraitementSiren(date, streaming: bool = False):
     """ Etape 1 : traitement de SIREN
 
     Args:
         date (string): date de l'étude YYYY-MM-DD.
+        streaming (bool, optional): extrait la date de la table des périodes (lecture unique du stock). Defaults to False.
 
     Returns:
         pandas.DataFrame: tableau des entrepôts à la date voulue.
@@ -35,8 +185,11 @@ def TraitementSiren(date):
     # Chemins vers les dossiers de sortie du notebook
     SirenEntrepotsFolder = check_dir(processed_data_path, "SIREN")
     datestr = str(date)
+    cache = CacheEntry("siren", siren_name.format(datestr), SirenEntrepotsFolder,
+                       params={"date": datestr, "codes": WAREHOUSE_CODES},
+                       inputs=[siren_source()])
 
-    if not os.path.exists(make_path(siren_name.format(datestr), SirenEntrepotsFolder)):
+    if not cache.hit():
         
         logger.info("Process Siren file")
         
@@ -44,66 +197,45 @@ def TraitementSiren(date):
 
         date = datetime.strptime(datestr, "%Y-%m-%d")
 
-        # Ouverture du csv SIREN
-        siren = pd.read_csv(SirenFPath, 
-                            usecols=["siret","activitePrincipaleEtablissement","nomenclatureActivitePrincipaleEtablissement", "dateDebut", "dateFin"], 
-                            dtype=str, 
-                            )
-
-        # Entités où la nomenclature est renseignée
-        siren_nom = siren.dropna(subset=["nomenclatureActivitePrincipaleEtablissement"])
-        siren_nap = siren_nom[siren_nom["nomenclatureActivitePrincipaleEtablissement"].str.startswith("NAP")]
-        siren_naf = siren_nom[siren_nom["nomenclatureActivitePrincipaleEtablissement"].str.startswith("NAF1993")]
-        siren_na1 = siren_nom[siren_nom["nomenclatureActivitePrincipaleEtablissement"].str.startswith("NAFRev1")]
-        siren_na2 = siren_nom[siren_nom["nomenclatureActivitePrincipaleEtablissement"].str.startswith("NAFRev2")]
-
-        # Entités correspondant à des entrepôts pour chaque nomenclatures
-        # Nomenclature NAP
-        siren_ent_nap_07 = siren_nap[siren_nap["activitePrincipaleEtablissement"].str.startswith("73.07")]
-        siren_ent_nap_08 = siren_nap[siren_nap["activitePrincipaleEtablissement"].str.startswith("73.08")]
-        siren_ent_nap = pd.concat([siren_ent_nap_07,siren_ent_nap_08],ignore_index=True)
-
-        # Nomenclature NAF 1993
-        siren_ent_naf_D = siren_naf[siren_naf["activitePrincipaleEtablissement"].str.startswith("63.1D")]
-        siren_ent_naf_E = siren_naf[siren_naf["activitePrincipaleEtablissement"].str.startswith("63.1E")]
-        siren_ent_naf = pd.concat([siren_ent_naf_D,siren_ent_naf_E],ignore_index=True)
-
-        # Nomenclature NAF rev1
-        siren_ent_na1_D = siren_na1[siren_na1["activitePrincipaleEtablissement"].str.startswith("63.1D")]
-        siren_ent_na1_E = siren_na1[siren_na1["activitePrincipaleEtablissement"].str.startswith("63.1E")]
-        siren_ent_na1 = pd.concat([siren_ent_na1_D,siren_ent_na1_E],ignore_index=True)
-
-        # Nomenclature NAF rev2
-        siren_ent_na2 = siren_na2[siren_na2["activitePrincipaleEtablissement"].str.startswith("52.1")]
+        if streaming:
+            siren_ent = read_siren_table(TraitementSirenPeriodes())
+        elif os.path.isdir(SirenParquetPath):
+            # partitions des codes d'entrepôts uniquement, voir src/ingest.py
+            siren_ent = filter_warehouses(read_siren_parquet(SIREN_COLUMNS))
+        else:
+            # Ouverture du csv SIREN
+            siren = pd.read_csv(SirenFPath, 
+                                usecols=SIREN_COLUMNS, 
+                                dtype=SIREN_CSV_DTYPES, 
+                                )
+            siren_ent = filter_warehouses(siren)
+            del siren
 
         # Contruction du panda des entrepots selon la date voulue
-        siren_ent = pd.concat([siren_ent_nap,siren_ent_naf,siren_ent_na1,siren_ent_na2],ignore_index=True)
-        siren_ent["dateFin"] = pd.to_datetime(siren_ent["dateFin"], errors='coerce', format="%Y-%m-%d")
-        siren_ent["dateFin"] = siren_ent["dateFin"].fillna(datetime.strptime('2050-01-01','%Y-%m-%d'))
-        siren_ent["dateDebut"] = pd.to_datetime(siren_ent["dateDebut"], errors='coerce', format="%Y-%m-%d")
-        siren_ent["dateDebut"] = siren_ent["dateDebut"].fillna(datetime.strptime('1900-01-01','%Y-%m-%d'))
-        siren_ent = siren_ent[siren_ent["dateDebut"] < date]
-        siren_ent = siren_ent[siren_ent["dateFin"] > date]
+        siren_ent = snapshot_siren(siren_ent, date)
         
         logger.info(f"SIREN : {siren_ent.shape}")
+        metrics.rows(rows_out=len(siren_ent))
 
         # Enregistrement de SIREN entrepôts
-        siren_ent.to_csv(make_path(siren_name.format(datestr), SirenEntrepotsFolder), index=False)
+        write_siren_table(siren_ent, cache.path)
         
         del siren_ent
         
-        return make_path(siren_name.format(datestr), SirenEntrepotsFolder)
+        return cache.commit()
 
     logger.info("Load Siren file")
 
-    return make_path(siren_name.format(datestr), SirenEntrepotsFolder)
+    return cache.path
 
 # Etape 2 : traitement de GeoSIREN
-@timeit
+@instrument
 def TraitementGeoSiren(centroid, 
                        name, 
                        year,
-                       r: int = None):
+                       r: int = None,
+                       tiled: bool = GEOSIREN_TILED,
+                       workers: int = GEOSIREN_WORKERS):
     
     """ Etape 2 : traitement de GeoSIREN
 
@@ -112,23 +244,28 @@ def TraitementGeoSiren(centroid,
         r (float): Rayon de la zone d'étude en mètre
         name (string): Nom de la zone d'étude.
         year (string): Année de l'étude.
+        tiled (bool, optional): jointure hors mémoire par tuiles (voir join_geosiren_tiled). Defaults to GEOSIREN_TILED.
+        workers (int, optional): processus de la jointure par tuiles. Defaults to GEOSIREN_WORKERS.
 
     Returns:
         pandas.DataFrame: tableau des entités dans la zone d'étude
     """
     
-    def load_raw():
+    def load_raw(bounds):
+        if os.path.isdir(GeosirenParquetPath):
+            # tuiles de l'emprise de la zone d'étude uniquement, voir src/ingest.py
+            return read_geosiren_parquet(bounds, columns=["siret", "x", "y", "epsg"])
         geosiren = pd.read_csv(GeosirenFPath, 
                                sep=';', 
                                usecols=["siret", "x", "y", "epsg"], 
-                               dtype={"siret":str}, 
+                               dtype={"siret": "int64"}, 
                                )
         # Récupère les données référencées en Lambert 93 (EPSG:2154)
         geosiren = geosiren.loc[geosiren["epsg"] == CRS, :]
         return geosiren
     
     def load_precompute(geosiren_zone_path: str):
-        return gpd.read_file(geosiren_zone_path)
+        return read_layer(geosiren_zone_path)
         
     precompute=True
 
@@ -140,40 +277,40 @@ def TraitementGeoSiren(centroid,
     root_out_dir = check_dir(processed_data_path, name, year)
     radius_name = int(r/1000)
     
-    # already done in download_bdtopo
-    ze_dir = check_dir(root_out_dir, "ZoneEtude")
-    ze_file_name = ze_name.format(name, radius_name)
-    
     out_dir_siren = check_dir(root_out_dir, "SIREN")
     siren_file_name = geosiren_name.format(name, radius_name)
     
-
+    # sortie du rayon maximal si précalculée, sinon GeoSIREN brut
+    source_path = TraitementGeoSiren(centroid, name, year, r=None) if precompute else geosiren_source()
+    cache = CacheEntry("geosiren", siren_file_name, out_dir_siren,
+                       params={"centroid": list(centroid), "r": r},
+                       inputs=[source_path, communes_file(name, year)])
     
-    if not os.path.exists(make_path(siren_file_name,  out_dir_siren)):
+    if not cache.hit():
         logger.info(f"Process GeoSiren file {year} - {radius_name}km")
         logger.info("Load GeoSiren file...")
 
+        # very fast not needed but ok
+        ze = load_ze(centroid, r, name, year)
+
+        if tiled and not precompute:
+            # GeoSIREN national lu par blocs / tuiles, jamais en entier en mémoire
+            geosiren = join_geosiren_tiled(ze, workers=workers)
+            write_layer(geosiren, cache.path, index=False)
+            del geosiren
+            return cache.commit()
+
         if not precompute:
-            # Ouverture du csv GEOSIREN see config - specify str to siret to prevent error for 0XXX codes (not int)
-            geosiren = load_raw()
+            # Ouverture du csv GEOSIREN see config - siret en int64 comme SIREN (schéma compact, voir src/ingest.py)
+            geosiren = load_raw(ze.total_bounds)
             logger.info(f"GeoSiren file loaded {year}!")
         else:
             # load pre-compute geosiren for DIST_RADIUS
-            geosiren = load_precompute(make_path(geosiren_name.format(name, int(DIST_RADIUS/1000)),  out_dir_siren))
+            geosiren = load_precompute(source_path)
             logger.info(f"FIX GeoSiren file precomputed loaded for {r} - geosiren : {geosiren.shape}!")
 
         
-        # very fast not needed but ok
-        if not os.path.exists(make_path(ze_file_name, ze_dir)):
-            logger.info("Communes on buffer...")
-
-            ze = get_ze_from_radius(centroid, r, name, year)
-            ze.to_file(make_path(ze_file_name, ze_dir))
-        
-        else :
-            logger.info("Load communes on buffer...")
-            ze = gpd.read_file(make_path(ze_file_name, ze_dir))
-
+        metrics.rows(rows_in=len(geosiren))
         geosiren = gpd.GeoDataFrame(
             geosiren, geometry=gpd.points_from_xy(x=geosiren.x, y=geosiren.y), crs=CRS
         )
@@ -190,20 +327,247 @@ def TraitementGeoSiren(centroid,
             .drop(["index_right"], axis=1)
         )
         logger.info(f"FIX JOIN GeoSiren  for {year} - geosiren : {geosiren.shape}!")
+        metrics.rows(rows_out=len(geosiren))
 
         logger.info(f"Save geosiren on roi..")
 
         # Enregistre le GeoSiren de la zone d'étude
-        out_dir_siren = check_dir(root_out_dir, "SIREN")
-        geosiren.to_file(make_path(siren_file_name,  out_dir_siren), index=False)
+        write_layer(geosiren, cache.path, index=False)
 
         del geosiren
         
-        return make_path(siren_file_name,  out_dir_siren)
+        return cache.commit()
     
     logger.info("Load GeoSiren file")
 
-    return make_path(siren_file_name,  out_dir_siren)
+    return cache.path
+
+def tile_keys(x: np.ndarray, y: np.ndarray, tile_size: int = GEOSIREN_JOIN_TILE_SIZE) -> np.ndarray:
+    """ identifiant de la tuile de la grille contenant chaque point (Lambert 93, coordonnées positives) """
+    return np.floor(np.asarray(x) / tile_size).astype(np.int64) * 1_000_000 + np.floor(np.asarray(y) / tile_size).astype(np.int64)
+
+
+def zone_tiles(ze: gpd.GeoDataFrame, tile_size: int = GEOSIREN_JOIN_TILE_SIZE) -> Tuple[np.ndarray, np.ndarray]:
+    """ tuiles de l'emprise de la zone d'étude : à tester (bord) et entièrement intérieures.
+
+    Les tuiles disjointes de la zone ne sont pas retenues, les points des tuiles intérieures
+    sont dans la zone sans test géométrique.
+    """
+    minx, miny, maxx, maxy = ze.total_bounds
+    tx, ty = np.meshgrid(np.arange(np.floor(minx / tile_size), np.floor(maxx / tile_size) + 1),
+                         np.arange(np.floor(miny / tile_size), np.floor(maxy / tile_size) + 1))
+    tx, ty = tx.ravel(), ty.ravel()
+    boxes = shapely.box(tx * tile_size, ty * tile_size, (tx + 1) * tile_size, (ty + 1) * tile_size)
+
+    zone = shapely.union_all(ze.geometry.values)
+    shapely.prepare(zone)
+    hit = shapely.intersects(zone, boxes)
+    inner = shapely.contains_properly(zone, boxes) if len(ze) == 1 else np.zeros(len(boxes), dtype=bool)
+    keys = tx.astype(np.int64) * 1_000_000 + ty.astype(np.int64)
+    logger.info(f"GeoSiren tiles : {hit.sum()} / {len(boxes)} intersect the zone, {inner.sum()} inside")
+    return keys[hit & ~inner], keys[inner]
+
+
+# zone d'étude des processus de la jointure par tuiles (voir _init_tile_worker)
+_TILE_ZONE = {}
+
+
+def _init_tile_worker(ze: gpd.GeoDataFrame, tile_size: int, boundary: np.ndarray, inner: np.ndarray) -> None:
+    _TILE_ZONE.update(ze=ze, tile_size=tile_size, boundary=boundary, inner=inner)
+
+
+def _join_tile_points(points: pd.DataFrame) -> pd.DataFrame:
+    """ points d'un bloc dans la zone d'étude : tuiles intérieures acceptées, tuiles de bord jointes """
+    ze = _TILE_ZONE["ze"]
+    keys = tile_keys(points["x"].values, points["y"].values, _TILE_ZONE["tile_size"])
+
+    inside = points[np.isin(keys, _TILE_ZONE["inner"])]
+    if len(inside):
+        inside = inside.assign(**ze.drop(columns="geometry").iloc[0].to_dict())
+
+    edge = points[np.isin(keys, _TILE_ZONE["boundary"])]
+    edge = gpd.GeoDataFrame(edge, geometry=gpd.points_from_xy(x=edge.x, y=edge.y), crs=CRS)
+    edge = gpd.sjoin(edge, ze, predicate="within", how="inner").drop(["index_right", "geometry"], axis=1)
+    return pd.concat([inside, pd.DataFrame(edge)], ignore_index=True)
+
+
+def _join_tile_file(path: str) -> Tuple[int, pd.DataFrame]:
+    points = pq.read_table(path, columns=["siret", "x", "y", "epsg"]).to_pandas()
+    return len(points), _join_tile_points(points)
+
+
+def _join_tile_chunk(points: pd.DataFrame) -> Tuple[int, pd.DataFrame]:
+    return len(points), _join_tile_points(points)
+
+
+@instrument
+def join_geosiren_tiled(ze: gpd.GeoDataFrame,
+                        tile_size: int = GEOSIREN_JOIN_TILE_SIZE,
+                        workers: int = GEOSIREN_WORKERS,
+                        chunksize: int = SIREN_CHUNKSIZE) -> gpd.GeoDataFrame:
+    """ Jointure GeoSIREN / zone d'étude hors mémoire.
+
+    Le GeoSIREN est lu par tuiles Parquet (voir src/ingest.py) ou par blocs du csv ; seules les lignes des
+    tuiles de la grille qui intersectent la zone sont envoyées aux processus. Au plus 2 * workers blocs
+    sont en cours : la mémoire reste bornée par la taille d'un bloc et par le résultat dans la zone.
+
+    Returns:
+        geopandas.GeoDataFrame: points GeoSIREN dans la zone (mêmes lignes que la jointure en mémoire).
+    """
+    boundary, inner = zone_tiles(ze, tile_size)
+    kept = np.concatenate([boundary, inner])
+    init_args = (ze, tile_size, boundary, inner)
+
+    if os.path.isdir(GeosirenParquetPath):
+        tasks = ((_join_tile_file, path) for path in geosiren_parquet_files(ze.total_bounds))
+    else:
+        def csv_tasks():
+            reader = pd.read_csv(GeosirenFPath,
+                                 sep=';',
+                                 usecols=["siret", "x", "y", "epsg"],
+                                 dtype={"siret": "int64"},
+                                 chunksize=chunksize,
+                                 )
+            for chunk in reader:
+                # Lambert 93 (EPSG:2154) et tuiles retenues, filtre vectoriel avant l'envoi au processus
+                chunk = chunk.loc[chunk["epsg"] == CRS, :]
+                yield _join_tile_chunk, chunk[np.isin(tile_keys(chunk["x"].values, chunk["y"].values, tile_size), kept)]
+        tasks = csv_tasks()
+
+    n_read, parts = 0, []
+    if workers <= 1:
+        _init_tile_worker(*init_args)
+        for func, arg in tasks:
+            n, part = func(arg)
+            n_read += n
+            parts.append(part)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_tile_worker, initargs=init_args) as pool:
+            pending = deque()
+            for func, arg in tasks:
+                pending.append(pool.submit(func, arg))
+                if len(pending) >= 2 * workers:
+                    n, part = pending.popleft().result()
+                    n_read += n
+                    parts.append(part)
+            for future in pending:
+                n, part = future.result()
+                n_read += n
+                parts.append(part)
+
+    geosiren = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=["siret", "x", "y", "epsg"])
+    logger.info(f"Tiled JOIN GeoSiren : {len(geosiren)} points in zone")
+    metrics.rows(rows_in=n_read, rows_out=len(geosiren))
+    return gpd.GeoDataFrame(geosiren, geometry=gpd.points_from_xy(x=geosiren.x, y=geosiren.y), crs=CRS)
+
+
+def load_ze(centroid, r, name, year) -> gpd.GeoDataFrame:
+    """ zone d'étude (union des communes intersectant le buffer r), calculée une fois puis relue """
+    ze_dir = check_dir(processed_data_path, name, year, "ZoneEtude")
+    cache = CacheEntry("ze", ze_name.format(name, int(r/1000)), ze_dir,
+                       params={"centroid": list(centroid), "r": r},
+                       inputs=[communes_file(name, year)])
+
+    if not cache.hit():
+        logger.info("Communes on buffer...")
+
+        ze = get_ze_from_radius(centroid, r, name, year)
+        write_layer(ze, cache.path)
+        cache.commit()
+        return ze
+
+    logger.info("Load communes on buffer...")
+    return read_layer(cache.path)
+
+
+def load_geosiren_sirets(sirets: np.ndarray, bounds) -> pd.DataFrame:
+    """ Semi-jointure par hachage : lignes GeoSIREN (Lambert 93) dont le siret entier est dans sirets.
+
+    Le csv est lu par blocs, seules les lignes retenues sont conservées en mémoire.
+    """
+    if os.path.isdir(GeosirenParquetPath):
+        geosiren = read_geosiren_parquet(bounds, columns=["siret", "x", "y", "epsg"])
+        geosiren["siret"] = as_siret(geosiren["siret"])
+        return geosiren[geosiren["siret"].isin(sirets)]
+
+    chunks = []
+    reader = pd.read_csv(GeosirenFPath,
+                         sep=';',
+                         usecols=["siret", "x", "y", "epsg"],
+                         dtype={"siret": "int64"},
+                         chunksize=SIREN_CHUNKSIZE,
+                         )
+    for chunk in reader:
+        chunks.append(chunk.loc[(chunk["epsg"] == CRS) & chunk["siret"].isin(sirets), :])
+    return pd.concat(chunks, ignore_index=True)
+
+
+# Etape 2bis : GeoSIREN restreint aux entrepôts avant la jointure spatiale
+@instrument
+def SemiJoinGeoSiren(siren_date_path: str,
+                     centroid,
+                     name,
+                     year,
+                     r: int = None,
+                     geosiren: gpd.GeoDataFrame = None,
+                     save: bool = False) -> gpd.GeoDataFrame:
+    """ Etape 2bis : GeoSIREN filtré sur les siret d'entrepôts puis joint à la zone d'étude.
+
+    Les géométries et le test d'inclusion ne portent que sur les quelques milliers d'entrepôts.
+
+    Args:
+        siren_date_path (str): entrepôts SIREN à la date voulue (étape 1).
+        centroid (float): Coordonnée X, Y du centre de la zone d'étude
+        name (string): Nom de la zone d'étude.
+        year (string): Année de l'étude.
+        r (float, optional): Rayon de la zone d'étude en mètre. Defaults to DIST_RADIUS.
+        geosiren (geopandas.GeoDataFrame, optional): points d'entrepôts déjà calculés pour un rayon supérieur.
+        save (bool, optional): enregistre le GeoSiren entrepôts de la zone d'étude. Defaults to False.
+
+    Returns:
+        geopandas.GeoDataFrame: points GeoSIREN des entrepôts dans la zone d'étude.
+    """
+    r = DIST_RADIUS if r is None else r
+    out_dir_siren = check_dir(processed_data_path, name, year, "SIREN")
+    cache = CacheEntry("geosiren_ent", geosiren_ent_name.format(name, int(r/1000)), out_dir_siren,
+                       params={"centroid": list(centroid), "r": r},
+                       inputs=[siren_date_path, geosiren_source(), communes_file(name, year)])
+
+    if save and cache.hit():
+        logger.info("Load GeoSiren warehouses file")
+        return read_layer(cache.path)
+
+    logger.info(f"Semi-join GeoSiren {year} - {int(r/1000)}km")
+
+    ze = load_ze(centroid, r, name, year)
+
+    if geosiren is None:
+        sirets = read_siren_table(siren_date_path, columns=["siret"])["siret"].unique()
+        geosiren = load_geosiren_sirets(sirets, ze.total_bounds)
+        logger.info(f"GeoSiren warehouses {year} : {geosiren.shape}")
+        metrics.rows(rows_in=len(geosiren))
+        geosiren = gpd.GeoDataFrame(
+            geosiren, geometry=gpd.points_from_xy(x=geosiren.x, y=geosiren.y), crs=CRS
+        )
+
+    geosiren = (
+        gpd.sjoin(
+            geosiren[["siret", "x", "y", "epsg", "geometry"]],
+            ze,
+            predicate="within",
+            how="inner"
+            )
+        .drop(["index_right"], axis=1)
+    )
+    logger.info(f"JOIN GeoSiren warehouses for {year} - geosiren : {geosiren.shape}!")
+    metrics.rows(rows_out=len(geosiren))
+
+    if save:
+        write_layer(geosiren, cache.path, index=False)
+        cache.commit()
+
+    return geosiren
+
 
 def get_communes_from_radius(centroid, r, name, year, columns=None):
     # Création du buffer
@@ -212,11 +576,7 @@ def get_communes_from_radius(centroid, r, name, year, columns=None):
 
     # Création de la zone d'étude avec les communes qui intersectes le buffer
     # load from download_topo output : warning communes limit max 25k (default value)
-    communes_path = os.path.join(
-        communes_roi_dir.format(name, year),
-        communes_roi_file_name.format(name, year)
-    )
-    communes = gpd.read_file(communes_path).to_crs(CRS)
+    communes = read_layer(communes_file(name, year)).to_crs(CRS)
     
     columns = list(communes.columns) if columns else ["geometry"]    
         
@@ -242,11 +602,7 @@ def get_ze_from_radius(centroid, r, name, year, columns=None):
 
     # Création de la zone d'étude avec les communes qui intersectes le buffer
     # load from download_topo output : warning communes limit max 25k (default value)
-    communes_path = os.path.join(
-        communes_roi_dir.format(name, year),
-        communes_roi_file_name.format(name, year)
-    )
-    communes = gpd.read_file(communes_path).to_crs(CRS)
+    communes = read_layer(communes_file(name, year)).to_crs(CRS)
     
     columns = list(communes.columns) if columns else ["geometry"]    
         
@@ -265,9 +621,9 @@ def get_ze_from_radius(centroid, r, name, year, columns=None):
     return ze
 
 # Etape 3 : jointure SIREN et GeoSIREN
-@timeit
+@instrument
 def JoinSirenGeosiren(siren_date_path: str, 
-                      geosiren_zone_path: str, 
+                      geosiren_zone_path: Union[str, gpd.GeoDataFrame], 
                       year: str, 
                       name: str, 
                       r: int):
@@ -275,7 +631,7 @@ def JoinSirenGeosiren(siren_date_path: str,
 
     Args:
         siren_date (pandas.DataFrame): tableau des entrepôts dans SIREN à la date voulue (étape 1).
-        geosiren_zone (pandas.DataFrame): tableau des bâtiments dans le buffer_max
+        geosiren_zone (str | geopandas.GeoDataFrame): tableau des bâtiments dans le buffer_max (chemin ou table en mémoire)
         year (string): annee de l'étude YYYY
         name (string): nom de la zone d'étude.
         r (float): rayon de la zone d'étude en km.
@@ -287,39 +643,165 @@ def JoinSirenGeosiren(siren_date_path: str,
     # check root_dir exist
     radius_name= int(r/1000)
     root_out_dir = check_dir(processed_data_path, name, year, "Entrepots")
-    wh_file_name = warehouse_name.format(name, year, radius_name)
+    cache = CacheEntry("warehouses", warehouse_name.format(name, year, radius_name), root_out_dir,
+                       params={"r": r},
+                       inputs=[siren_date_path, geosiren_zone_path])
     
-    if not os.path.exists(make_path(wh_file_name, root_out_dir)):
+    if not cache.hit():
         
-        siren_date = pd.read_csv(siren_date_path)
-        geosiren_zone = gpd.read_file(geosiren_zone_path)
+        siren_date = read_siren_table(siren_date_path)
+        if isinstance(geosiren_zone_path, str):
+            geosiren_zone = read_layer(geosiren_zone_path)
+        else:
+            geosiren_zone = geosiren_zone_path.copy()
         
         logger.info(f"Siren {siren_date.shape}")
         logger.info(f"Geosiren {geosiren_zone.shape}")
 
 
-        # Jointure sur le champ SIRET - we convert to int  - doesn't matter
-        siren_date["siret"] = siren_date["siret"].astype(int)
-        geosiren_zone["siret"] = geosiren_zone["siret"].astype(int)
+        # Jointure sur le champ SIRET entier (schéma compact), GeoSIREN est lu en int64 depuis le csv ou le Parquet
+        geosiren_zone["siret"] = as_siret(geosiren_zone["siret"])
 
         merged_siren = pd.merge(siren_date, geosiren_zone, on="siret")
         merged_siren = gpd.GeoDataFrame(merged_siren, geometry="geometry", crs=CRS)
         # Enregistre la jointure
-        merged_siren.to_file(make_path(wh_file_name, root_out_dir), index=False)
+        write_layer(merged_siren, cache.path, index=False)
         logger.info(f"MERGE SIREN : {merged_siren.shape}")
+        metrics.rows(rows_in=len(siren_date) + len(geosiren_zone), rows_out=len(merged_siren))
 
         del siren_date
         del geosiren_zone
         del merged_siren
         
-        return make_path(wh_file_name, root_out_dir)
+        return cache.commit()
 
     logger.info("Load merge Siren and GeoSiren")
 
-    return make_path(wh_file_name, root_out_dir)
+    return cache.path
+
+def nearest_bati_matching(entrepots_siren: gpd.GeoDataFrame,
+                          bati_indus: gpd.GeoDataFrame,
+                          max_distance: float) -> pd.DataFrame:
+    """ Appariement en masse de chaque point SIREN avec le bâtiment le plus proche.
+
+    Requête unique sur l'index spatial des bâtiments (sjoin_nearest) bornée par max_distance.
+    En cas d'égalité, le bâtiment de plus petit index est retenu, comme le idxmin de l'ancienne boucle.
+
+    Args:
+        entrepots_siren (geopandas.GeoDataFrame): points des entrepôts SIREN.
+        bati_indus (geopandas.GeoDataFrame): bâtiments industriels BDTOPO (index positionnel).
+        max_distance (float): distance maximale (exclue) entre un point et son bâtiment.
+
+    Returns:
+        pandas.DataFrame: table point_index, bati_index, distance (positions dans les deux tables).
+    """
+    points = entrepots_siren[["geometry"]].reset_index(drop=True)
+    batis = bati_indus[["geometry"]].reset_index(drop=True)
+
+    matches = (
+        gpd.sjoin_nearest(
+            points,
+            batis,
+            how="inner",
+            max_distance=max_distance,
+            distance_col="distance"
+            )
+        .rename_axis("point_index")
+        .reset_index()
+        .rename({"index_right": "bati_index"}, axis=1)
+    )
+    matches = (
+        matches.loc[matches["distance"] < max_distance, ["point_index", "bati_index", "distance"]]
+        .sort_values(["point_index", "bati_index"])
+        .drop_duplicates(subset="point_index", keep="first")
+        .reset_index(drop=True)
+    )
+    return matches
+
+def building_associations(entrepots_siren: gpd.GeoDataFrame,
+                          bati_indus: gpd.GeoDataFrame,
+                          matches: pd.DataFrame) -> pd.DataFrame:
+    """ Bâtiments touchés par une ligne d'appariement (point -> bâtiment le plus proche) ou contenant un point.
+
+    Deux requêtes en masse sur l'index spatial des bâtiments, au lieu de tester chaque bâtiment
+    contre l'union de toutes les lignes et de tous les points.
+
+    Returns:
+        pandas.DataFrame: couples point_index, bati_index (positions dans les deux tables), sans doublon.
+    """
+    points = entrepots_siren.geometry.values
+    lines = shapely.shortest_line(
+        points[matches["point_index"].values],
+        bati_indus.geometry.values[matches["bati_index"].values],
+    )
+    line_idx, by_line = bati_indus.sindex.query(lines, predicate="intersects")
+    point_idx, by_point = bati_indus.sindex.query(points, predicate="intersects")
+    return pd.DataFrame({
+        "point_index": np.concatenate([matches["point_index"].values[line_idx], point_idx]),
+        "bati_index": np.concatenate([by_line, by_point]),
+    }).drop_duplicates().reset_index(drop=True)
+
+
+def match_table(entrepots_siren: gpd.GeoDataFrame,
+                bati_indus: gpd.GeoDataFrame,
+                matches: pd.DataFrame) -> pd.DataFrame:
+    """ table siret -> bâtiment : ID BDTOPO, distance et type (inside : point dans le bâtiment, nearest : à moins du seuil) """
+    positions = matches["bati_index"].values
+    table = pd.DataFrame({
+        "siret": as_siret(entrepots_siren["siret"]).values[matches["point_index"].values],
+        "point_index": matches["point_index"].values,
+        "bati_index": bati_indus.index.values[positions],
+        "distance": matches["distance"].values,
+    })
+    if "ID" in bati_indus:
+        table.insert(1, "ID", bati_indus["ID"].values[positions])
+    table["match_type"] = pd.Categorical(np.where(table["distance"] == 0, "inside", "nearest"), categories=["inside", "nearest"])
+    return table
+
+
+def bati_indus_file(name: str, year: str) -> str:
+    """ bâtiments industriels BDTOPO de la zone d'étude extraits par download_bdtopo """
+    return make_path(bati_indus_file_name.format(name, year), bati_indus_roi_dir.format(name, year))
+
+
+def load_bati_indus(name: str, year: str) -> gpd.GeoDataFrame:
+    """ bâtiments industriels BDTOPO de la zone d'étude, index positionnel """
+    return read_layer(bati_indus_file(name, year)).reset_index(drop=True)
+
+
+def load_bati_indus_near(name: str, year: str, geoms: np.ndarray, distance: float) -> gpd.GeoDataFrame:
+    """ bâtiments dont l'emprise est à moins de distance d'une géométrie, lus dans l'index persistant.
+
+    Sur-ensemble exact des bâtiments à moins de distance ; l'index reste la position dans load_bati_indus.
+    """
+    return building_index(bati_indus_file(name, year)).around(geoms, distance)
+
+def _appariement_caches(name, entrepots_siren_path, year, r, dist_siren_bdtopo, seuil_surf_ent) -> Tuple[CacheEntry, CacheEntry]:
+    """ sorties de l'appariement : bâtiments d'entrepôts et table siret -> bâtiment """
+    app_our_dir = check_dir(processed_data_path, name, year, "Appariement")
+    params = {"r": r, "dist_siren_bdtopo": dist_siren_bdtopo, "seuil_surf_ent": seuil_surf_ent}
+    inputs = [entrepots_siren_path, bati_indus_file(name, year)]
+    return (
+        CacheEntry("appariement", appariement_name.format(name.upper(), year, int(r/1000)), app_our_dir, params=params, inputs=inputs),
+        CacheEntry("appariement_matches", appariement_matches_name.format(name.upper(), year, int(r/1000)), app_our_dir, params=params, inputs=inputs),
+    )
+
+
+def AppSirenMatches(name: str,
+                    entrepots_siren_path: str,
+                    year: str,
+                    r: int,
+                    dist_siren_bdtopo: float=50.0,
+                    seuil_surf_ent: float=1000.0) -> pd.DataFrame:
+    """ table siret -> bâtiment (siret, ID, point_index, bati_index, distance, match_type) de AppSirenBDTopo """
+    _, matches_cache = _appariement_caches(name, entrepots_siren_path, year, r, dist_siren_bdtopo, seuil_surf_ent)
+    if not os.path.exists(matches_cache.path):
+        AppSirenBDTopo(name, entrepots_siren_path, year, r, dist_siren_bdtopo, seuil_surf_ent)
+    return pd.read_parquet(matches_cache.path)
+
 
 # Etape 4 : Appariement SIREN entrepôts et BDTOPO bâti industriel
-@timeit
+@instrument
 def AppSirenBDTopo(name: str,
                    entrepots_siren_path: str,
                    year: str,
@@ -343,99 +825,118 @@ def AppSirenBDTopo(name: str,
     """
     logger.info("Appariement processing...")
     
-    # check root_dir exist
-    root_out_dir = check_dir(processed_data_path, name, year)
-    app_our_dir = check_dir(root_out_dir, "Appariement")
-    
-    appariement_file_name = appariement_name.format(name.upper(), year, int(r/1000))
-    
-    #ze_file_name = ze_name.format(name, int(r/1000))
-    #ze_dir = make_path(ze_file_name, root_out_dir, "ZoneEtude")
+    # la clé couvre les paramètres d'appariement : plus de résultat périmé si dist / seuil changent
+    cache, matches_cache = _appariement_caches(name, entrepots_siren_path, year, r, dist_siren_bdtopo, seuil_surf_ent)
     
-    if not os.path.exists(make_path(appariement_file_name, root_out_dir)):
+    if not (cache.hit() and matches_cache.hit()):
         
-        entrepots_siren = gpd.read_file(entrepots_siren_path)
+        entrepots_siren = read_layer(entrepots_siren_path)
         logger.info(f"Entrepot merge SIREN  {year}: {entrepots_siren.shape}")
         
-        # Ouvertur du shapefile des bâtiments industriels de la bdtopo
-        bati_indus = (
-            gpd.read_file(
-                make_path(
-                    bati_indus_file_name.format(name, year),
-                    bati_indus_roi_dir.format(name, year)
-                    )
-                ).reset_index(drop=True)
-        )
+        # Bâtiments industriels de la bdtopo à portée des points, lus dans l'index persistant
+        bati_indus = load_bati_indus_near(name, year, entrepots_siren.geometry.values, dist_siren_bdtopo)
         logger.info(f"Batis Indus BDTOPO : {bati_indus.shape}")
 
-        # Calcul des lignes la plus courtes entre un point d'entrepot siren et un batiment industriel de la bd topo (point à bord)
-        lines,id = [],0
-        for idx, point in entrepots_siren.iterrows():
-            nearest_bat = bati_indus.geometry.distance(point.geometry).idxmin()
-            bat_geom = bati_indus.loc[nearest_bat,'geometry']
-            nearest_point_bat = nearest_points(point.geometry,bat_geom)[1]
-            nearest_point_bat = Point(nearest_point_bat.x,nearest_point_bat.y)
-            line = LineString([point.geometry,nearest_point_bat])
-            item = ({'id':id, 'geometry':line})
-            lines.append(item)
-            id += 1
-        print(len(lines))
-        lines_gdf = gpd.GeoDataFrame(lines, geometry='geometry',crs=CRS)
-
-        # Calcul des lignes qui sont plus grande que la distance max voulue avec un batiment de la bdtopo
-        lines_app = lines_gdf[lines_gdf["geometry"].length < dist_siren_bdtopo]
-        logger.info(f"Lines dist_min : {lines_app.shape}")
-
-        # Calcul des bâtiment de la bdtopo correspondant à un point d'entrepôt siren et dont la surface est plus grande que le seuil voulu
-        bati_indus_ent = bati_indus[bati_indus["geometry"].intersects(lines_app.unary_union) | bati_indus["geometry"].intersects(entrepots_siren.unary_union)]
+        # Appariement de chaque point d'entrepot siren avec le batiment industriel de la bd topo le plus proche (requête sur index spatial)
+        matches = nearest_bati_matching(entrepots_siren, bati_indus, max_distance=dist_siren_bdtopo)
+        logger.info(f"Matches dist_min : {matches.shape}")
+
+        # Calcul des bâtiment de la bdtopo touchés par la ligne la plus courte point -> bâtiment apparié ou contenant un point (index spatial)
+        assoc = building_associations(entrepots_siren, bati_indus, matches)
+        logger.info(f"Lines / points associations : {assoc.shape}")
+
+        # ... dont la surface est plus grande que le seuil voulu
+        bati_indus_ent = bati_indus.iloc[np.unique(assoc["bati_index"].values)]
         bati_indus_ent = bati_indus_ent[bati_indus_ent["geometry"].area > seuil_surf_ent]
         
         # Enregistrement des entrepôts à la date voulue
         
         bati_indus_ent = bati_indus_ent.drop_duplicates(keep="first")
 
-        bati_indus_ent.to_file(make_path(appariement_file_name, app_our_dir))
+        write_layer(bati_indus_ent, cache.path)
+        cache.commit()
+
+        # table siret -> bâtiment des entrepôts retenus, pour les jointures sur ID des étapes suivantes
+        table = match_table(entrepots_siren, bati_indus, matches)
+        table[table["bati_index"].isin(bati_indus_ent.index)].reset_index(drop=True).to_parquet(matches_cache.path, index=False)
+        matches_cache.commit()
         
         logger.info(f"Appariement done for {name} on {year} : {bati_indus_ent.shape}")
+        metrics.rows(rows_in=len(entrepots_siren), rows_out=len(bati_indus_ent))
         return bati_indus_ent
 
     logger.info("Load appariement")
 
-    return gpd.read_file(make_path(appariement_file_name, root_out_dir))
+    return read_layer(cache.path)
 
 
 class AppariementRunner:
     def __init__(self, 
                  date_analysis: str,
                  centroid:Tuple[float],
-                 roi_name:str):
+                 roi_name:str,
+                 streaming: bool = False,
+                 join_order: str = "spatial",
+                 save_geosiren: bool = True,
+                 geosiren_ent: gpd.GeoDataFrame = None):
+        """
+        join_order : "spatial" (GeoSIREN complet joint à la zone puis aux siret) 
+                     ou "siret" (semi-jointure sur les siret d'entrepôts avant la jointure spatiale)
+        save_geosiren : en mode "siret", enregistre le GeoSiren entrepôts de la zone d'étude
+        geosiren_ent : en mode "siret", points d'entrepôts du rayon maximal déjà calculés (voir src/batch.py)
+        """
+        if join_order not in ("spatial", "siret"):
+            raise ValueError(f"join_order must be 'spatial' or 'siret', got {join_order}")
         
         self.centroid = centroid
         self.roi_name = '_'.join(roi_name.lower().split(" "))
         self.date_analysis = date_analysis
+        self.join_order = join_order
+        self.save_geosiren = save_geosiren
         
         # pre compute data for max buffer
-        self.siren_ent_path = TraitementSiren(self.date_analysis)
-        self.geosiren_buffer_path = TraitementGeoSiren(centroid=self.centroid,
-                                             name=self.roi_name,
-                                             year=get_year_from_datestring(self.date_analysis),
-                                             r=None
-                                             )
-        
-    @timeit
-    def run(self, radius:int):
+        self.siren_ent_path = TraitementSiren(self.date_analysis, streaming=streaming)
+        if self.join_order == "siret" and geosiren_ent is not None:
+            self.geosiren_ent = geosiren_ent
+        elif self.join_order == "siret":
+            self.geosiren_ent = SemiJoinGeoSiren(siren_date_path=self.siren_ent_path,
+                                                 centroid=self.centroid,
+                                                 name=self.roi_name,
+                                                 year=get_year_from_datestring(self.date_analysis),
+                                                 r=None,
+                                                 save=self.save_geosiren)
+        else:
+            self.geosiren_buffer_path = TraitementGeoSiren(centroid=self.centroid,
+                                                 name=self.roi_name,
+                                                 year=get_year_from_datestring(self.date_analysis),
+                                                 r=None
+                                                 )
+        
+    def _geosiren(self, radius: int):
+        if self.join_order == "siret":
+            if radius == DIST_RADIUS:
+                return self.geosiren_ent
+            return SemiJoinGeoSiren(siren_date_path=self.siren_ent_path,
+                                    centroid=self.centroid,
+                                    name=self.roi_name,
+                                    year=get_year_from_datestring(self.date_analysis),
+                                    r=radius,
+                                    geosiren=self.geosiren_ent,
+                                    save=self.save_geosiren)
         
-
         self.geosiren_buffer_path = TraitementGeoSiren(centroid=self.centroid,
                                              name=self.roi_name,
                                              year=get_year_from_datestring(self.date_analysis),
                                              r=radius
                                              )
-        
         logger.info(f"Geosiren : {self.geosiren_buffer_path}")
+        return self.geosiren_buffer_path
+        
+    @instrument
+    def run(self, radius:int):
         
         merged_siren_path = JoinSirenGeosiren(siren_date_path=self.siren_ent_path,
-                                        geosiren_zone_path=self.geosiren_buffer_path,
+                                        geosiren_zone_path=self._geosiren(radius),
                                         year=get_year_from_datestring(self.date_analysis),
                                         name=self.roi_name,
                                         r=radius)
@@ -475,5 +976,5 @@ if __name__ == "__main__":
         
             wh = wh_builder.run(radius=r)
         
-            print(wh.shape)
+            logger.info(f"Warehouses : {wh.shape}")
     
\ No newline at end of file
@@ -1,7 +1,6 @@
 import os 
 from datetime import datetime 
-from functools import wraps
-import time
+import geopandas as gpd
 
 
 def check_dir(*path):
@@ -16,13 +15,25 @@ def make_path(file_name, *path):
 def get_year_from_datestring(date_str):
     return str(datetime.strptime(date_str, "%Y-%m-%d").year)
 
-def timeit(func):
-    @wraps(func)
-    def timeit_wrapper(*args, **kwargs):
-        start_time = time.perf_counter()
-        result = func(*args, **kwargs)
-        end_time = time.perf_counter()
-        total_time = end_time - start_time
-        print(f'Function {func.__name__} Took {total_time:.4f} seconds')
-        return result
-    return timeit_wrapper
\ No newline at end of file
+def write_layer(gdf: gpd.GeoDataFrame, path: str, index=None) -> str:
+    """ écrit une couche intermédiaire selon son extension : GeoParquet (WKB + bbox) ou GPKG """
+    if path.endswith(".parquet"):
+        gdf.to_parquet(path, index=index, write_covering_bbox=True)
+    else:
+        gdf.to_file(path, index=index)
+    return path
+
+
+def read_layer(path: str, bbox=None, columns=None) -> gpd.GeoDataFrame:
+    """ lit une couche intermédiaire ; bbox (minx, miny, maxx, maxy) filtre sur la colonne bbox en GeoParquet """
+    kwargs = {k: v for k, v in {"bbox": bbox, "columns": columns}.items() if v is not None}
+    if path.endswith(".parquet"):
+        return gpd.read_parquet(path, **kwargs)
+    return gpd.read_file(path, **kwargs)
+
+
+def export_layer(path: str, ext: str = ".gpkg") -> str:
+    """ exporte une couche intermédiaire (ex. GeoParquet) vers un autre format, à côté de l'original """
+    out_path = os.path.splitext(path)[0] + ext
+    write_layer(read_layer(path), out_path, index=False)
+    return out_path
@@ -0,0 +1,14 @@
+"""
+Répertoire des données redirigé (LOGISTICS_SPRAWL_DATA) vers un répertoire temporaire avant l'import de src.config :
+les tests qui écrivent des couches ou des sorties en cache ne touchent jamais data/
+"""
+import os
+import shutil
+import tempfile
+
+_DATA_DIR = tempfile.mkdtemp(prefix="logistics_sprawl_tests_")
+os.environ["LOGISTICS_SPRAWL_DATA"] = _DATA_DIR
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_DATA_DIR, ignore_errors=True)
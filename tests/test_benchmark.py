@@ -0,0 +1,46 @@
+"""
+Comparaison de la suite de benchmarks à la référence (src.benchmark._compare)
+"""
+import pytest
+
+pytest.importorskip("geopandas")
+
+from src.benchmark import BENCHMARK_NOISE_S, _compare
+
+
+def _regressions(current, baseline, **kwargs):
+    result = _compare(current, baseline, **kwargs)
+    return set(result.loc[result["regression"], "stage"])
+
+
+def test_regression_beyond_tolerance():
+    baseline = {"10000": {"TraitementSiren": 10.0, "AppSirenBDTopo": 10.0}}
+    current = {"10000": {"TraitementSiren": 12.4, "AppSirenBDTopo": 12.6}}
+    assert _regressions(current, baseline) == {"AppSirenBDTopo"}
+
+
+def test_faster_run_is_not_a_regression():
+    baseline = {"10000": {"TraitementSiren": 10.0}}
+    assert _regressions({"10000": {"TraitementSiren": 2.0}}, baseline) == set()
+
+
+def test_noise_floor():
+    # +100 % mais sous le seuil de bruit : pas de régression
+    baseline = {"10000": {"compute_statistics": BENCHMARK_NOISE_S / 4}}
+    current = {"10000": {"compute_statistics": BENCHMARK_NOISE_S / 2}}
+    assert _regressions(current, baseline) == set()
+
+
+def test_missing_reference():
+    # échelle ou étape absente de la référence : mesurée, jamais une régression
+    result = _compare({"100000": {"TraitementSiren": 5.0}}, {"10000": {"TraitementSiren": 1.0}})
+    assert result["baseline"].isna().all()
+    assert not result["regression"].any()
+    assert result["rows"].tolist() == [100000]
+
+
+def test_custom_tolerance():
+    baseline = {"10000": {"TraitementSiren": 10.0}}
+    current = {"10000": {"TraitementSiren": 11.0}}
+    assert _regressions(current, baseline) == set()
+    assert _regressions(current, baseline, tolerance=0.05) == {"TraitementSiren"}
@@ -0,0 +1,238 @@
+"""
+Cache adressé par contenu : clés, fiches de provenance, rekey et éviction LRU de fin d'exécution
+"""
+import json
+import os
+import threading
+
+import pandas as pd
+import pytest
+
+from src import cache
+from src.cache import CacheEntry, META_SUFFIX, cache_entries, evict, evict_run, fingerprint, rekey
+
+
+def _write(entry: CacheEntry, content: bytes) -> str:
+    with open(entry.path, "wb") as f:
+        f.write(content)
+    return entry.commit()
+
+
+def _set_last_access(path: str, last_access: float) -> None:
+    meta = cache._read_meta(path)
+    meta["last_access"] = last_access
+    cache._write_meta(path, meta)
+
+
+def test_key_follows_params_and_inputs(tmp_path):
+    source = tmp_path / "source.csv"
+    source.write_text("a,b\n1,2\n")
+    entry = CacheEntry("stage", "out.csv", str(tmp_path), params={"radius": 5_000}, inputs=[str(source)])
+
+    assert CacheEntry("stage", "out.csv", str(tmp_path), {"radius": 5_000}, [str(source)]).key == entry.key
+    assert CacheEntry("stage", "out.csv", str(tmp_path), {"radius": 10_000}, [str(source)]).key != entry.key
+    assert CacheEntry("other", "out.csv", str(tmp_path), {"radius": 5_000}, [str(source)]).key != entry.key
+
+    # fichier brut modifié : taille et date changent
+    source.write_text("a,b\n1,2\n3,4\n")
+    assert CacheEntry("stage", "out.csv", str(tmp_path), {"radius": 5_000}, [str(source)]).key != entry.key
+
+    # table en mémoire : hash des lignes
+    frame = pd.DataFrame({"a": [1, 2]})
+    assert fingerprint(frame) == fingerprint(frame.copy())
+    assert fingerprint(frame) != fingerprint(pd.DataFrame({"a": [1, 3]}))
+
+
+def test_key_chains_upstream_outputs(tmp_path):
+    upstream = CacheEntry("up", "up.csv", str(tmp_path), {"v": 1})
+    _write(upstream, b"up")
+    down = CacheEntry("down", "down.csv", str(tmp_path), {}, [upstream.path])
+    assert fingerprint(upstream.path) == {"path": os.path.basename(upstream.path), "key": upstream.key}
+
+    other = CacheEntry("up", "up.csv", str(tmp_path), {"v": 2})
+    _write(other, b"up")
+    assert CacheEntry("down", "down.csv", str(tmp_path), {}, [other.path]).key != down.key
+
+
+def test_hit_requires_meta(tmp_path):
+    entry = CacheEntry("stage", "out.csv", str(tmp_path), {})
+    assert not entry.hit()
+
+    # sortie écrite, commit jamais fait (interruption) : pas de hit
+    with open(entry.path, "wb") as f:
+        f.write(b"partial")
+    assert not entry.hit()
+
+    entry.commit()
+    assert entry.hit()
+
+    os.remove(entry.path + META_SUFFIX)
+    assert not entry.hit()
+
+
+def test_hit_updates_last_access(tmp_path):
+    entry = CacheEntry("stage", "out.csv", str(tmp_path), {})
+    _write(entry, b"data")
+    _set_last_access(entry.path, 0.0)
+    assert entry.hit()
+    assert cache._read_meta(entry.path)["last_access"] > 0.0
+
+
+def test_commit_is_atomic(tmp_path, monkeypatch):
+    entry = CacheEntry("stage", "out.csv", str(tmp_path), {"v": 1})
+    with open(entry.path, "wb") as f:
+        f.write(b"data")
+
+    # échec avant le renommage : ni fiche partielle ni fichier temporaire
+    def failing_replace(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(cache.os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        entry.commit()
+    monkeypatch.undo()
+    assert not entry.hit()
+    assert sorted(os.listdir(tmp_path)) == [os.path.basename(entry.path)]
+
+    # commits et lectures concurrents : la fiche lue est toujours complète
+    errors = []
+
+    def commit():
+        for _ in range(50):
+            entry.commit()
+
+    def read():
+        for _ in range(200):
+            try:
+                with open(entry.path + META_SUFFIX) as f:
+                    assert json.load(f)["key"] == entry.key
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=commit) for _ in range(4)] + [threading.Thread(target=read) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert entry.hit()
+    assert sorted(os.listdir(tmp_path)) == sorted([os.path.basename(entry.path), os.path.basename(entry.path) + META_SUFFIX])
+
+
+def test_rekey_keeps_content(tmp_path):
+    old_source, new_source = tmp_path / "old.csv", tmp_path / "new.csv"
+    old_source.write_text("old")
+    new_source.write_text("new source")
+    entry = CacheEntry("stage", "out.parquet", str(tmp_path), {"v": 1}, [str(old_source)])
+    _write(entry, b"content")
+
+    new_path = rekey(entry.path, [fingerprint(str(new_source))])
+    rekeyed = CacheEntry("stage", "out.parquet", str(tmp_path), {"v": 1}, [str(new_source)])
+    assert new_path == rekeyed.path != entry.path
+    assert rekeyed.hit()
+    with open(new_path, "rb") as f:
+        assert f.read() == b"content"
+    assert cache._read_meta(new_path)["rekeyed_from"] == entry.key
+    # l'ancienne sortie reste valide jusqu'à son éviction
+    assert entry.hit()
+
+
+def test_rekey_directory(tmp_path):
+    entry = CacheEntry("stage", "out_dir", str(tmp_path), {})
+    os.makedirs(entry.path)
+    with open(os.path.join(entry.path, "part-0.parquet"), "wb") as f:
+        f.write(b"part")
+    entry.commit()
+
+    new_path = rekey(entry.path, [{"path": "other", "missing": True}])
+    with open(os.path.join(new_path, "part-0.parquet"), "rb") as f:
+        assert f.read() == b"part"
+
+
+def test_evict_run_lru_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "_RUN_START", 1_000.0)
+    paths = []
+    for i, last_access in enumerate([300.0, 100.0, 200.0]):
+        entry = CacheEntry("stage", f"out{i}.bin", str(tmp_path), {"i": i})
+        paths.append(_write(entry, b"x" * 100))
+        _set_last_access(entry.path, last_access)
+
+    # 300 octets pour 150 autorisés : les deux moins récemment utilisées partent, la plus ancienne d'abord
+    removed = evict_run(max_bytes=150, root=str(tmp_path))
+    assert removed == [paths[1], paths[2]]
+    assert os.path.exists(paths[0])
+    assert not os.path.exists(paths[1]) and not os.path.exists(paths[1] + META_SUFFIX)
+    assert [e["path"] for e in cache_entries(str(tmp_path))] == [paths[0]]
+
+
+def test_evict_run_keeps_current_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "_RUN_START", 1_000.0)
+    old = CacheEntry("stage", "old.bin", str(tmp_path), {"i": 0})
+    _write(old, b"x" * 100)
+    _set_last_access(old.path, 100.0)
+    used = CacheEntry("stage", "used.bin", str(tmp_path), {"i": 1})
+    _write(used, b"x" * 100)
+    _set_last_access(used.path, 50.0)
+    # lue pendant l'exécution (éventuellement par un autre processus) : protégée malgré sa date de création
+    assert used.hit()
+    written = CacheEntry("stage", "written.bin", str(tmp_path), {"i": 2})
+    _write(written, b"x" * 100)
+
+    assert evict_run(max_bytes=0, root=str(tmp_path)) == [old.path]
+    assert used.hit() and written.hit()
+
+    # keep : protégée même hors de l'exécution courante
+    _set_last_access(used.path, 10.0)
+    assert evict(max_bytes=0, root=str(tmp_path), keep=[used.path], keep_since=1_000.0) == []
+
+
+def test_evict_dedups_hard_links(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, "_RUN_START", 1_000.0)
+    entry = CacheEntry("stage", "out.bin", str(tmp_path), {}, [{"path": "a"}])
+    _write(entry, b"x" * 100)
+    linked = rekey(entry.path, [{"path": "b"}])
+    if os.stat(linked).st_ino != os.stat(entry.path).st_ino:
+        pytest.skip("hard links not supported")
+    other = CacheEntry("stage", "other.bin", str(tmp_path), {"i": 1})
+    _write(other, b"y" * 60)
+    _set_last_access(entry.path, 100.0)
+    _set_last_access(linked, 200.0)
+    _set_last_access(other.path, 300.0)
+
+    # 160 octets sur disque (et non 260) : sous la limite, rien n'est supprimé
+    assert evict_run(max_bytes=200, root=str(tmp_path)) == []
+
+    # le contenu partagé n'est libéré qu'à la suppression de son dernier lien : les deux liens partent, other reste
+    assert evict_run(max_bytes=60, root=str(tmp_path)) == [entry.path, linked]
+    assert os.path.exists(other.path)
+
+
+def test_siren_periods_rebuilt_without_meta():
+    pytest.importorskip("geopandas")
+    from src.config import SirenFPath
+    from src.ingest import read_siren_table
+    from src.traitements import TraitementSirenPeriodes
+    from src.utils import check_dir
+
+    check_dir(os.path.dirname(SirenFPath))
+    pd.DataFrame({
+        "siret": [10**13, 10**13 + 1, 10**13 + 2],
+        "dateDebut": "2000-01-01",
+        "dateFin": "",
+        "etatAdministratifEtablissement": "A",
+        "activitePrincipaleEtablissement": ["52.10B", "52.10B", "47.11A"],
+        "nomenclatureActivitePrincipaleEtablissement": "NAFRev2",
+    }).to_csv(SirenFPath, index=False)
+
+    path = TraitementSirenPeriodes()
+    assert len(read_siren_table(path)) == 2
+
+    # sortie à la clé attendue mais sans fiche (interruption avant commit) : reconstruite et enregistrée
+    os.remove(path + META_SUFFIX)
+    with open(path, "wb") as f:
+        f.write(b"truncated")
+    assert TraitementSirenPeriodes() == path
+    assert os.path.exists(path + META_SUFFIX)
+    assert len(read_siren_table(path)) == 2
@@ -0,0 +1,202 @@
+"""
+Téléchargement en flux repris par Range (src.download_bdtopo.download_file) contre un serveur http.server local
+"""
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("geopandas")
+requests = pytest.importorskip("requests")
+
+from src.download_bdtopo import download_file
+
+PAYLOAD = bytes(range(256)) * 400
+CHUNK_SIZE = 4096
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    """ sert PAYLOAD selon server.mode :
+    - range : plages honorées (206, 416 au-delà de la fin)
+    - ignore_range : toujours 200 avec le fichier entier
+    - truncated : 206 dont le corps s'arrête à la moitié de la plage annoncée
+    - missing : 404
+    """
+    def do_GET(self):
+        mode = self.server.mode
+        header = self.headers.get("Range")
+        self.server.ranges.append(header)
+        offset = int(header.split("=")[1].rstrip("-")) if header else 0
+
+        if mode == "missing":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if mode == "ignore_range" or (mode == "range" and not header):
+            body = PAYLOAD
+            self.send_response(200)
+        elif offset >= len(PAYLOAD):
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(PAYLOAD)}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        else:
+            body = PAYLOAD[offset:]
+            if mode == "truncated":
+                body = body[: len(body) // 2]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {offset}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}")
+
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), ArchiveHandler)
+    httpd.mode, httpd.ranges = "range", []
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/BDTOPO.7z"
+
+
+def _md5(data: bytes) -> str:
+    return hashlib.md5(data).hexdigest()
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_full_download(server, url, tmp_path):
+    out_path = str(tmp_path / "BDTOPO.7z")
+    assert download_file(url, out_path, md5=_md5(PAYLOAD), chunk_size=CHUNK_SIZE) == out_path
+    assert _read(out_path) == PAYLOAD
+    assert not os.path.exists(out_path + ".part")
+    assert server.ranges == [None]
+
+
+def test_resume_206(server, url, tmp_path):
+    out_path = str(tmp_path / "BDTOPO.7z")
+    offset = len(PAYLOAD) // 3
+    with open(out_path + ".part", "wb") as f:
+        f.write(PAYLOAD[:offset])
+
+    download_file(url, out_path, md5=_md5(PAYLOAD), chunk_size=CHUNK_SIZE)
+    assert server.ranges == [f"bytes={offset}-"]
+    assert _read(out_path) == PAYLOAD
+
+
+def test_complete_part_416(server, url, tmp_path):
+    out_path = str(tmp_path / "BDTOPO.7z")
+    with open(out_path + ".part", "wb") as f:
+        f.write(PAYLOAD)
+
+    download_file(url, out_path, md5=_md5(PAYLOAD), chunk_size=CHUNK_SIZE)
+    assert server.ranges == [f"bytes={len(PAYLOAD)}-"]
+    assert _read(out_path) == PAYLOAD
+    assert not os.path.exists(out_path + ".part")
+
+
+def test_range_ignored_200_restarts(server, url, tmp_path):
+    server.mode = "ignore_range"
+    out_path = str(tmp_path / "BDTOPO.7z")
+    with open(out_path + ".part", "wb") as f:
+        f.write(b"stale bytes of a previous archive")
+
+    download_file(url, out_path, md5=_md5(PAYLOAD), chunk_size=CHUNK_SIZE)
+    assert server.ranges[0] is not None
+    assert _read(out_path) == PAYLOAD
+
+
+def test_size_mismatch_keeps_part(server, url, tmp_path):
+    server.mode = "truncated"
+    out_path = str(tmp_path / "BDTOPO.7z")
+    offset = 1000
+    with open(out_path + ".part", "wb") as f:
+        f.write(PAYLOAD[:offset])
+
+    with pytest.raises(requests.HTTPError, match="incomplete download"):
+        download_file(url, out_path, chunk_size=CHUNK_SIZE)
+    assert not os.path.exists(out_path)
+    # la partie reçue est conservée pour la reprise suivante
+    received = _read(out_path + ".part")
+    assert offset < len(received) < len(PAYLOAD)
+    assert received == PAYLOAD[:len(received)]
+
+    server.mode = "range"
+    download_file(url, out_path, md5=_md5(PAYLOAD), chunk_size=CHUNK_SIZE)
+    assert server.ranges[-1] == f"bytes={len(received)}-"
+    assert _read(out_path) == PAYLOAD
+
+
+def test_md5_mismatch_removes_part(server, url, tmp_path):
+    out_path = str(tmp_path / "BDTOPO.7z")
+    with pytest.raises(requests.HTTPError, match="checksum mismatch"):
+        download_file(url, out_path, md5=_md5(b"another archive"), chunk_size=CHUNK_SIZE)
+    assert not os.path.exists(out_path)
+    assert not os.path.exists(out_path + ".part")
+
+
+def test_http_error(server, url, tmp_path):
+    server.mode = "missing"
+    out_path = str(tmp_path / "BDTOPO.7z")
+    with pytest.raises(requests.HTTPError, match="404"):
+        download_file(url, out_path, chunk_size=CHUNK_SIZE)
+    assert not os.path.exists(out_path)
+
+
+def test_department_pipeline_empty_list(tmp_path):
+    from src.download_bdtopo import DepartmentPipeline
+
+    # aucun pool créé ni index lu (url injoignable)
+    pipeline = DepartmentPipeline(str(tmp_path), "2023", roi=None, url="http://127.0.0.1:9/")
+    assert pipeline.run([]) == []
+
+
+def test_bdtopo_layers_crs_and_filter(tmp_path):
+    gpd = pytest.importorskip("geopandas")
+    from shapely import box
+    from src.config import BDTOPO_NATURE_INDUS, BDTOPO_USAGE_COMMERCE, BDTOPO_USAGE_INDUS, CRS
+    from src.download_bdtopo import _extract_bati_new_bdtopo, extract_communes_on_roi
+
+    bati = gpd.GeoDataFrame({
+        "ID": ["B0", "B1", "B2", "B3"],
+        "NATURE": [BDTOPO_NATURE_INDUS] * 3 + ["Indifférenciée"],
+        "USAGE1": [BDTOPO_USAGE_INDUS, BDTOPO_USAGE_COMMERCE, BDTOPO_USAGE_COMMERCE, BDTOPO_USAGE_INDUS],
+        "USAGE2": [None, BDTOPO_USAGE_INDUS, "Résidentiel", None],
+    }, geometry=[box(i * 100, 0, i * 100 + 50, 50) for i in range(4)], crs=CRS)
+    with_prj = str(tmp_path / "BATIMENT.shp")
+    bati.to_file(with_prj)
+    # shapefile sans .prj : CRS du projet
+    no_prj = str(tmp_path / "no_prj" / "BATIMENT.shp")
+    os.makedirs(os.path.dirname(no_prj))
+    bati.to_file(no_prj)
+    os.remove(no_prj[:-4] + ".prj")
+
+    for df in _extract_bati_new_bdtopo([with_prj, no_prj]):
+        assert df.crs == CRS
+        assert df["ID"].tolist() == ["B0", "B1"]
+
+    communes = gpd.GeoDataFrame({"ID": ["C0", "C1"]}, geometry=[box(0, 0, 100, 100), box(5_000, 0, 5_100, 100)], crs=CRS)
+    communes.to_file(str(tmp_path / "COMMUNE.shp"))
+    roi = gpd.GeoDataFrame(geometry=[box(-10, -10, 200, 200)], crs=CRS)
+    df = extract_communes_on_roi(str(tmp_path / "COMMUNE.shp"), roi)
+    assert df.crs == CRS and df["ID"].tolist() == ["C0"]
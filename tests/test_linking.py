@@ -0,0 +1,139 @@
+"""
+Liens entre bâtiments de deux millésimes : statut de chaque cas type, appariement glouton vectorisé
+face à la boucle gloutonne d'origine
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+from shapely import box
+
+from src.config import CRS, LINK_MIN_ID_IOU
+from src.linking import greedy_links, link_buildings
+from src.spatial_index import BuildingIndex, build_building_index
+
+
+def _legacy_greedy(candidates: pd.DataFrame) -> pd.DataFrame:
+    ordered = (
+        candidates.assign(priority=(candidates["link"] == "id").astype(int))
+        .sort_values(["priority", "iou"], ascending=False, kind="stable")
+        .drop(columns="priority")
+    )
+    used_before, used_after, keep = set(), set(), []
+    for row, b, a in zip(range(len(ordered)), ordered["bati_before"].values, ordered["bati_after"].values):
+        if b in used_before or a in used_after:
+            continue
+        used_before.add(b)
+        used_after.add(a)
+        keep.append(row)
+    return ordered.iloc[keep]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_greedy_links_matches_loop(seed):
+    rng = np.random.default_rng(seed)
+    n = 2_000
+    candidates = pd.DataFrame({
+        "bati_before": rng.integers(0, 300, n),
+        "bati_after": rng.integers(0, 300, n),
+        # IoU arrondis : nombreuses égalités, départagées par l'ordre d'origine (tri stable)
+        "iou": np.round(rng.uniform(0, 1, n), 1),
+        "link": rng.choice(["id", "iou"], n, p=[0.2, 0.8]),
+    }).drop_duplicates(["bati_before", "bati_after"])
+    pd.testing.assert_frame_equal(greedy_links(candidates), _legacy_greedy(candidates))
+
+
+def test_greedy_links_empty():
+    candidates = pd.DataFrame({"bati_before": [], "bati_after": [], "iou": [], "link": []})
+    assert greedy_links(candidates).empty
+
+
+# cas types, chacun dans sa propre case de 1 km : (bâtiments avant, bâtiments après) en (ID, minx, miny, maxx, maxy)
+CASES = {
+    "persistent": ([("P", 0, 0, 100, 100)], [("P", 0, 0, 100, 100)]),
+    "grown": ([("G", 0, 0, 100, 100)], [("G", 0, 0, 100, 130)]),
+    # scission en deux moitiés de nouveaux ID, IoU 0.5 chacune : une seule reliée
+    "split": ([("S", 0, 0, 100, 100)], [("S1", 0, 0, 50, 100), ("S2", 50, 0, 100, 100)]),
+    # scission dont une moitié garde l'ID : le lien par ID passe avant
+    "split_id": ([("K", 0, 0, 100, 100)], [("K2", 0, 0, 60, 100), ("K", 60, 0, 100, 100)]),
+    # ID conservé mais bâtiment déplacé : recouvrement sous LINK_MIN_ID_IOU
+    "moved": ([("M", 0, 0, 100, 100)], [("M", 95, 0, 195, 100)]),
+    "demolished": ([("D", 0, 0, 100, 100)], []),
+    # bâtiment inchangé qui n'est plus un entrepôt l'année suivante
+    "not_warehouse": ([("W", 0, 0, 100, 100)], [("W", 0, 0, 100, 100)]),
+}
+
+
+def _layer(buildings) -> gpd.GeoDataFrame:
+    rows = []
+    for k, case in enumerate(CASES):
+        for i, x0, y0, x1, y1 in buildings(case):
+            rows.append((case, i, box(k * 1_000 + x0, y0, k * 1_000 + x1, y1)))
+    case, ids, geoms = zip(*rows)
+    return gpd.GeoDataFrame({"case": case, "ID": ids}, geometry=list(geoms), crs=CRS)
+
+
+@pytest.fixture(scope="module")
+def links(tmp_path_factory):
+    before = _layer(lambda case: CASES[case][0])
+    after = _layer(lambda case: CASES[case][1])
+    root = tmp_path_factory.mktemp("links")
+    index_before = BuildingIndex(build_building_index(before, str(root / "before.index")))
+    index_after = BuildingIndex(build_building_index(after, str(root / "after.index")))
+    after_wh = after[after["case"] != "not_warehouse"]
+    table = link_buildings(before, after_wh, index_before, index_after)
+    table["case"] = np.where(table["bati_before"].notna(),
+                             before["case"].values[table["bati_before"].fillna(0).astype(int)],
+                             after["case"].values[table["bati_after"].fillna(0).astype(int)])
+    return table
+
+
+def _statuses(links, case):
+    return sorted(links.loc[links["case"] == case, "status"].astype(str))
+
+
+def test_persistent(links):
+    row = links[links["case"] == "persistent"].iloc[0]
+    assert _statuses(links, "persistent") == ["persistent"]
+    assert row["link"] == "id" and row["iou"] == 1.0
+    assert row["warehouse_before"] and row["warehouse_after"]
+
+
+def test_grown_is_modified(links):
+    row = links[links["case"] == "grown"].iloc[0]
+    assert _statuses(links, "grown") == ["modified"]
+    assert row["iou"] == pytest.approx(100 / 130)
+    assert (row["area_before"], row["area_after"]) == (10_000.0, 13_000.0)
+
+
+def test_split(links):
+    split = links[links["case"] == "split"]
+    assert _statuses(links, "split") == ["modified", "new"]
+    linked = split[split["status"] == "modified"].iloc[0]
+    assert linked["link"] == "iou" and linked["iou"] == 0.5
+    assert sorted(split["ID_after"]) == ["S1", "S2"]
+
+    split_id = links[links["case"] == "split_id"]
+    assert _statuses(links, "split_id") == ["modified", "new"]
+    assert split_id.loc[split_id["status"] == "modified", ["ID_after", "link"]].values.tolist() == [["K", "id"]]
+    assert split_id.loc[split_id["status"] == "new", "ID_after"].tolist() == ["K2"]
+
+
+def test_moved_id_not_linked(links):
+    moved = links[links["case"] == "moved"]
+    assert 5 / 195 < LINK_MIN_ID_IOU
+    assert _statuses(links, "moved") == ["demolished", "new"]
+    assert moved["link"].isna().all()
+
+
+def test_demolished(links):
+    row = links[links["case"] == "demolished"].iloc[0]
+    assert _statuses(links, "demolished") == ["demolished"]
+    assert pd.isna(row["bati_after"]) and row["area_before"] == 10_000.0
+
+
+def test_not_warehouse_after(links):
+    row = links[links["case"] == "not_warehouse"].iloc[0]
+    assert _statuses(links, "not_warehouse") == ["persistent"]
+    assert row["warehouse_before"] and not row["warehouse_after"]
@@ -0,0 +1,125 @@
+"""
+Appariement en masse (nearest_bati_matching, building_associations, match_table) face à la boucle historique
+de AppSirenBDTopo : un point à la fois, idxmin des distances, lignes point -> bâtiment le plus proche
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+from shapely import LineString, Point, box
+from shapely.ops import nearest_points
+
+from src.config import CRS
+from src.traitements import building_associations, match_table, nearest_bati_matching
+
+MAX_DISTANCE = 50.0
+SEUIL_SURF_ENT = 1000.0
+
+
+def _legacy(entrepots_siren: gpd.GeoDataFrame, bati_indus: gpd.GeoDataFrame):
+    """ boucle de la version d'origine : table (siret, ID, distance, match_type) et bâtiments d'entrepôts """
+    rows, lines = [], []
+    for siret, point in zip(entrepots_siren["siret"], entrepots_siren.geometry):
+        distances = bati_indus.geometry.distance(point)
+        nearest_bat = distances.idxmin()
+        line = LineString([point, Point(nearest_points(point, bati_indus.loc[nearest_bat, "geometry"])[1])])
+        if line.length < MAX_DISTANCE:
+            lines.append(line)
+            rows.append((siret, bati_indus.loc[nearest_bat, "ID"], distances[nearest_bat]))
+    table = pd.DataFrame(rows, columns=["siret", "ID", "distance"])
+    table["match_type"] = np.where(table["distance"] == 0, "inside", "nearest")
+
+    lines = gpd.GeoSeries(lines, crs=CRS)
+    touched = bati_indus.geometry.intersects(lines.union_all()) | bati_indus.geometry.intersects(entrepots_siren.union_all())
+    ent = bati_indus[touched]
+    return table, set(ent.loc[ent.area > SEUIL_SURF_ENT, "ID"])
+
+
+def _indexed(entrepots_siren: gpd.GeoDataFrame, bati_indus: gpd.GeoDataFrame):
+    matches = nearest_bati_matching(entrepots_siren, bati_indus, max_distance=MAX_DISTANCE)
+    table = match_table(entrepots_siren, bati_indus, matches)[["siret", "ID", "distance", "match_type"]]
+    table["match_type"] = table["match_type"].astype(str)
+
+    assoc = building_associations(entrepots_siren, bati_indus, matches)
+    ent = bati_indus.iloc[np.unique(assoc["bati_index"].values)]
+    return table, set(ent.loc[ent.area > SEUIL_SURF_ENT, "ID"])
+
+
+def _layers(points, buildings):
+    entrepots_siren = gpd.GeoDataFrame(
+        {"siret": np.arange(len(points), dtype="int64") + 10**13},
+        geometry=[Point(p) for p in points],
+        crs=CRS,
+    )
+    bati_indus = gpd.GeoDataFrame(
+        {"ID": [f"BATIMENT{i:04d}" for i in range(len(buildings))]},
+        geometry=[box(*b) for b in buildings],
+        crs=CRS,
+    )
+    return entrepots_siren, bati_indus
+
+
+def _assert_same(entrepots_siren, bati_indus):
+    legacy_table, legacy_ent = _legacy(entrepots_siren, bati_indus)
+    table, ent = _indexed(entrepots_siren, bati_indus)
+    pd.testing.assert_frame_equal(
+        table.reset_index(drop=True), legacy_table.reset_index(drop=True), check_dtype=False
+    )
+    assert ent == legacy_ent
+
+
+def test_edge_cases():
+    buildings = [
+        (10, -20, 60, 20),        # 0 : à 10 m à droite du point 0
+        (-60, -20, -10, 20),      # 1 : à 10 m à gauche du point 0 (égalité, 0 retenu comme le idxmin)
+        (1000, 0, 1040, 40),      # 2 : contient le point 1
+        (2000, 0, 2040, 40),      # 3 : point 2 sur le bord
+        (3000, 0, 3040, 40),      # 4 : point 3 à exactement MAX_DISTANCE (exclu)
+        (4000, 0, 4040, 40),      # 5 : point 4 au-delà
+        (5000, 0, 5010, 10),      # 6 : contient le point 5, sous le seuil de surface
+    ]
+    points = [
+        (0, 0),
+        (1020, 20),
+        (2000, 20),
+        (3020, 40 + MAX_DISTANCE),
+        (4020, 40 + MAX_DISTANCE + 5),
+        (5005, 5),
+    ]
+    entrepots_siren, bati_indus = _layers(points, buildings)
+    _assert_same(entrepots_siren, bati_indus)
+
+    table, _ = _indexed(entrepots_siren, bati_indus)
+    by_siret = table.set_index("siret")
+    sirets = entrepots_siren["siret"].values
+    assert by_siret.loc[sirets[0], "ID"] == "BATIMENT0000"
+    assert by_siret.loc[sirets[1], "match_type"] == "inside"
+    assert by_siret.loc[sirets[2], "distance"] == 0
+    assert sirets[3] not in by_siret.index
+    assert sirets[4] not in by_siret.index
+
+
+def test_tie_on_shared_edge():
+    # deux bâtiments contigus à égale distance : le premier est apparié, la ligne touche aussi le second
+    buildings = [(0, 0, 50, 40), (50, 0, 100, 40)]
+    entrepots_siren, bati_indus = _layers([(50, -10)], buildings)
+    _assert_same(entrepots_siren, bati_indus)
+
+    table, ent = _indexed(entrepots_siren, bati_indus)
+    assert table["ID"].tolist() == ["BATIMENT0000"]
+    assert ent == {"BATIMENT0000", "BATIMENT0001"}
+
+
+def test_random_layers():
+    rng = np.random.default_rng(1)
+    bx, by = rng.uniform(0, 5_000, 400), rng.uniform(0, 5_000, 400)
+    w, h = rng.uniform(10, 80, 400), rng.uniform(10, 80, 400)
+    buildings = list(zip(bx, by, bx + w, by + h))
+    near = rng.integers(0, 400, 150)
+    points = list(zip(bx[near] + rng.normal(0, 40, 150), by[near] + rng.normal(0, 40, 150)))
+    # points à coordonnées entières sur une grille de bâtiments alignés : égalités de distance
+    grid = [(x, y, x + 40, y + 40) for x in range(6_000, 6_400, 100) for y in range(0, 400, 100)]
+    points += [(x + 70, y + 20) for x, y, _, _ in grid[:12]]
+    entrepots_siren, bati_indus = _layers(points + [(x, y) for x, y in rng.uniform(0, 5_000, (100, 2))], buildings + grid)
+    _assert_same(entrepots_siren, bati_indus)
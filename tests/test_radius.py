@@ -0,0 +1,99 @@
+"""
+NestedRadiusEngine (une passe de distances, seuils par rayon) face à AppariementRunner (jointure par rayon)
+sur un pavage de communes dont les bords passent exactement sur les cercles des rayons, avec des points
+d'entrepôts placés sur ces cercles
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+from shapely import box
+
+from src.config import CRS, DIST_RADIUS, GeosirenFPath, RADIUS_LIST, SirenFPath
+from src.radius import NestedRadiusEngine
+from src.traitements import AppariementRunner, bati_indus_file, communes_file, get_communes_from_radius
+from src.utils import check_dir, write_layer
+
+ROI = "radius_test"
+DATE = "2023-01-01"
+YEAR = "2023"
+CENTER = (841650.0, 6517765.0)
+STEP = 2_500.0
+RADII = sorted(set(RADIUS_LIST) | {7_500, 12_500, 17_345})
+
+
+def _dataset():
+    cx, cy = CENTER
+    # pavage carré aligné sur le centre : les bords des communes passent par (cx + r, cy) et (cx, cy + r)
+    ix, iy = np.meshgrid(np.arange(-12, 12), np.arange(-12, 12))
+    minx, miny = cx + ix.ravel() * STEP, cy + iy.ravel() * STEP
+    communes = gpd.GeoDataFrame(
+        {"ID": [f"COMMUNE_{i:04d}" for i in range(minx.size)], "POPULATION": np.arange(minx.size) + 100},
+        geometry=box(minx, miny, minx + STEP, miny + STEP),
+        crs=CRS,
+    )
+
+    # points d'entrepôts exactement sur le cercle de chaque rayon (sommets du buffer et entre deux sommets),
+    # juste en deçà et au-delà, et au hasard
+    rng = np.random.default_rng(0)
+    angles = np.deg2rad([0, 90, 180, 270, 45, 30, 11.25, 5.625])
+    xy = [(cx + d * np.cos(a), cy + d * np.sin(a)) for r in RADII for d in (r - 1e-3, r, r + 1e-3) for a in angles]
+    dist, angle = rng.uniform(0, DIST_RADIUS + 5_000, 300), rng.uniform(0, 2 * np.pi, 300)
+    xy += list(zip(cx + dist * np.cos(angle), cy + dist * np.sin(angle)))
+    xy = np.array(xy)
+    sirets = np.arange(len(xy), dtype="int64") + 10**13
+
+    # un bâtiment d'entrepôt par point, à quelques mètres, et des bâtiments sans entrepôt
+    side = rng.uniform(35, 80, len(xy))
+    dx, dy = rng.uniform(-20, 20, len(xy)), rng.uniform(-20, 20, len(xy))
+    bx, by = cx + rng.uniform(-30_000, 30_000, 500), cy + rng.uniform(-30_000, 30_000, 500)
+    bati = gpd.GeoDataFrame(
+        {"ID": [f"BATIMENT{i:06d}" for i in range(len(xy) + 500)], "NATURE": "Industriel, agricole ou commercial"},
+        geometry=np.concatenate([box(xy[:, 0] + dx, xy[:, 1] + dy, xy[:, 0] + dx + side, xy[:, 1] + dy + side),
+                                 box(bx, by, bx + 50, by + 50)]),
+        crs=CRS,
+    )
+
+    check_dir(os.path.dirname(communes_file(ROI, YEAR)))
+    write_layer(communes, communes_file(ROI, YEAR), index=False)
+    write_layer(bati, bati_indus_file(ROI, YEAR), index=False)
+
+    check_dir(os.path.dirname(SirenFPath))
+    pd.DataFrame({
+        "siret": sirets,
+        "dateDebut": "2000-01-01",
+        "dateFin": "",
+        "etatAdministratifEtablissement": "A",
+        "activitePrincipaleEtablissement": "52.10B",
+        "nomenclatureActivitePrincipaleEtablissement": "NAFRev2",
+    }).to_csv(SirenFPath, index=False)
+    pd.DataFrame({"siret": sirets, "x": xy[:, 0], "y": xy[:, 1], "epsg": CRS}).to_csv(GeosirenFPath, sep=";", index=False)
+
+
+@pytest.fixture(scope="module")
+def engines():
+    _dataset()
+    runner = AppariementRunner(date_analysis=DATE, centroid=CENTER, roi_name=ROI)
+    engine = NestedRadiusEngine(date_analysis=DATE, centroid=CENTER, roi_name=ROI)
+    return runner, engine
+
+
+@pytest.mark.parametrize("r", RADII)
+def test_communes(engines, r):
+    _, engine = engines
+    expected = set(get_communes_from_radius(CENTER, r, ROI, YEAR, columns=True)["ID"])
+    assert set(engine.communes(r)["ID"]) == expected
+    # rayon d'entrée obtenu par dichotomie : même ensemble au rayon exact
+    assert set(engine.communes_table.loc[engine.communes_thresholds() <= r, "ID"]) == expected
+
+
+@pytest.mark.parametrize("r", RADII)
+def test_warehouses(engines, r):
+    runner, engine = engines
+    expected = set(runner.run(radius=r)["ID"])
+    assert set(engine.warehouses(r)["ID"]) == expected
+    table = engine.warehouses_table()
+    assert set(table.loc[table["seuil"] <= r, "ID"]) == expected
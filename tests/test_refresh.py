@@ -0,0 +1,102 @@
+"""
+Rafraîchissement incrémental : delta des tables de périodes par seaux de siret, métropoles touchées par le delta
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+from shapely import box
+
+from src.config import CRS, GeosirenFPath, processed_data_path
+from src.refresh import affected_rois, bucket_hashes, periods_delta
+from src.traitements import communes_file, filter_warehouses
+from src.utils import check_dir, write_layer
+
+
+def _periods(rows) -> pd.DataFrame:
+    siret, debut, fin, code = zip(*rows)
+    return filter_warehouses(pd.DataFrame({
+        "siret": list(siret),
+        "dateDebut": list(debut),
+        "dateFin": list(fin),
+        "etatAdministratifEtablissement": "A",
+        "activitePrincipaleEtablissement": list(code),
+        "nomenclatureActivitePrincipaleEtablissement": "NAFRev2",
+    }))
+
+
+@pytest.fixture
+def old():
+    rng = np.random.default_rng(0)
+    sirets = rng.choice(10**14, 500, replace=False) + 10**13
+    return _periods([(s, "2001-01-01", "", "52.10B") for s in sirets])
+
+
+def _sirets(frame: pd.DataFrame) -> list:
+    return sorted(frame["siret"].tolist())
+
+
+@pytest.mark.parametrize("n_buckets", [1, 16, 4096])
+def test_periods_delta(old, n_buckets):
+    s_removed, s_modified = old["siret"].iloc[3], old["siret"].iloc[10]
+    new = old[old["siret"] != s_removed].copy()
+    new.loc[new["siret"] == s_modified, "dateFin"] = pd.Timestamp("2020-06-30")
+    # nouvel établissement, et nouvelle période d'un établissement existant
+    added = _periods([(99 * 10**12 + 7, "2019-01-01", "", "52.10A"),
+                      (old["siret"].iloc[20], "2022-01-01", "", "52.10B")])
+    new = pd.concat([new, added], ignore_index=True).sample(frac=1, random_state=0)
+
+    inserted, removed = periods_delta(old, new, n_buckets)
+    # période modifiée : supprimée dans son ancienne version, insérée dans la nouvelle
+    assert _sirets(inserted) == sorted([s_modified] + added["siret"].tolist())
+    assert _sirets(removed) == sorted([s_removed, s_modified])
+    assert inserted.loc[inserted["siret"] == s_modified, "dateFin"].iloc[0] == pd.Timestamp("2020-06-30")
+    assert removed.loc[removed["siret"] == s_modified, "dateFin"].iloc[0] == pd.Timestamp("2050-01-01")
+
+
+def test_periods_delta_unchanged(old):
+    inserted, removed = periods_delta(old, old.sample(frac=1, random_state=1))
+    assert inserted.empty and removed.empty
+    # hash par seau en uint64 : la comparaison se fait sans passage en flottants
+    assert bucket_hashes(old).dtype == np.uint64
+
+
+def test_periods_delta_empty_side(old):
+    inserted, removed = periods_delta(old.iloc[:0], old, 64)
+    assert _sirets(inserted) == _sirets(old) and removed.empty
+    inserted, removed = periods_delta(old, old.iloc[:0], 64)
+    assert inserted.empty and _sirets(removed) == _sirets(old)
+
+
+def test_affected_rois():
+    zones = {"refresh_a": (700_000.0, 6_600_000.0), "refresh_b": (900_000.0, 6_300_000.0)}
+    for roi, (x, y) in zones.items():
+        for year in ("2005", "2023"):
+            communes = gpd.GeoDataFrame({"ID": [f"{roi}_1"], "POPULATION": [100]},
+                                        geometry=[box(x, y, x + 10_000, y + 10_000)], crs=CRS)
+            check_dir(os.path.dirname(communes_file(roi, year)))
+            write_layer(communes, communes_file(roi, year), index=False)
+    # métropole sans communes extraites : emprise inconnue
+    check_dir(os.path.join(processed_data_path, "refresh_c"))
+
+    delta = _periods([(10**13 + 1, "2020-01-01", "2030-01-01", "52.10B"),
+                      (10**13 + 2, "2000-01-01", "2010-01-01", "52.10B"),
+                      (10**13 + 3, "2000-01-01", "", "52.10B")])
+    check_dir(os.path.dirname(GeosirenFPath))
+    pd.DataFrame({
+        "siret": [10**13 + 1, 10**13 + 2, 10**13 + 4],
+        "x": [705_000.0, 905_000.0, 705_000.0],
+        "y": [6_605_000.0, 6_305_000.0, 6_605_000.0],
+        "epsg": CRS,
+    }).to_csv(GeosirenFPath, sep=";", index=False)
+
+    affected = affected_rois(delta, ["2023-01-01", "2005-01-01", "2040-01-01"])
+    mine = {date: rois & {"refresh_a", "refresh_b", "refresh_c"} for date, rois in affected.items()}
+    # 10**13 + 3 actif partout mais non géolocalisé, 10**13 + 4 géolocalisé mais hors delta
+    assert mine["2023-01-01"] == {"refresh_a", "refresh_c"}
+    assert mine["2005-01-01"] == {"refresh_b", "refresh_c"}
+    # aucune commune extraite pour l'année : toutes les métropoles sont considérées touchées
+    assert mine["2040-01-01"] == {"refresh_a", "refresh_b", "refresh_c"}
@@ -0,0 +1,85 @@
+"""
+Index persistant des bâtiments (BuildingIndex) face à shapely.STRtree sur des couches et requêtes aléatoires
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+import shapely
+from shapely import box
+
+from src.config import CRS
+from src.spatial_index import BuildingIndex, build_building_index
+
+
+def _layer(rng, n: int) -> gpd.GeoDataFrame:
+    x, y = rng.uniform(0, 10_000, n), rng.uniform(0, 10_000, n)
+    w, h = rng.uniform(5, 200, n), rng.uniform(5, 200, n)
+    geoms = box(x, y, x + w, y + h)
+    # quelques polygones non rectangulaires : l'emprise ne suffit plus pour les prédicats exacts
+    geoms[::7] = shapely.buffer(shapely.points(x[::7], y[::7]), w[::7] / 2)
+    return gpd.GeoDataFrame({"ID": [f"BATIMENT{i:06d}" for i in range(n)], "HAUTEUR": rng.uniform(3, 30, n)},
+                            geometry=geoms, crs=CRS)
+
+
+def _pairs(q, positions) -> set:
+    return set(zip(np.asarray(q).tolist(), np.asarray(positions).tolist()))
+
+
+@pytest.fixture(scope="module", params=[(0, 1_000, 16), (1, 37, 4), (2, 1, 16)])
+def layer_index(request, tmp_path_factory):
+    seed, n, node_size = request.param
+    bati = _layer(np.random.default_rng(seed), n)
+    path = build_building_index(bati, str(tmp_path_factory.mktemp("index") / "bati.index"), node_size=node_size)
+    return bati, BuildingIndex(path)
+
+
+def _queries(rng, n: int = 300) -> np.ndarray:
+    x, y = rng.uniform(-500, 10_500, n), rng.uniform(-500, 10_500, n)
+    size = rng.uniform(0, 800, n)
+    return box(x, y, x + size, y + size * rng.uniform(0.2, 2, n))
+
+
+def test_query_bounds_matches_strtree(layer_index):
+    bati, index = layer_index
+    tree = shapely.STRtree(shapely.envelope(bati.geometry.values))
+    queries = _queries(np.random.default_rng(10))
+    q, positions = index.query_bounds(shapely.bounds(queries))
+    assert _pairs(q, positions) == _pairs(*tree.query(queries))
+    assert len(q) == len(_pairs(q, positions))
+
+
+@pytest.mark.parametrize("predicate, distance", [(None, 0.0), ("intersects", 0.0), ("dwithin", 0.0),
+                                                 ("dwithin", 25.0), ("dwithin", 300.0)])
+def test_query_matches_strtree(layer_index, predicate, distance):
+    bati, index = layer_index
+    tree = shapely.STRtree(bati.geometry.values)
+    rng = np.random.default_rng(11)
+    queries = np.concatenate([_queries(rng), shapely.points(rng.uniform(0, 10_000, (200, 2)))])
+
+    q, positions = index.query(queries, predicate=predicate, distance=distance)
+    if predicate == "dwithin":
+        expected = tree.query(queries, predicate="dwithin", distance=distance)
+    elif predicate is None:
+        # sans prédicat : emprises à moins de distance (sur-ensemble)
+        expected = shapely.STRtree(shapely.envelope(bati.geometry.values)).query(queries)
+    else:
+        expected = tree.query(queries, predicate=predicate)
+    assert _pairs(q, positions) == _pairs(*expected)
+
+
+def test_subset_and_memoised_attributes(layer_index):
+    bati, index = layer_index
+    positions = np.random.default_rng(12).choice(len(bati), min(len(bati), 50), replace=False)
+    subset = index.subset(positions, columns=["ID"])
+    expected = bati.iloc[np.sort(positions)]
+    assert subset.index.tolist() == np.sort(positions).tolist()
+    assert subset["ID"].tolist() == expected["ID"].tolist()
+    assert shapely.equals(subset.geometry.values, expected.geometry.values).all()
+
+    # la table des attributs n'est lue qu'une fois par jeu de colonnes
+    assert index.attributes(["ID"]) is index.attributes(["ID"])
+    index.subset(positions[:3], columns=["ID"])
+    assert list(index._attributes) == [("ID",)]
+    pd.testing.assert_frame_equal(index.attributes(), pd.DataFrame(bati.drop(columns="geometry")))
@@ -0,0 +1,154 @@
+"""
+Statistiques continues en rayon (YearProfile, CommuneUnions) face aux calculs par rayon d'origine
+(compute_statistics, dissolve des communes)
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+import shapely
+from shapely import Point, box
+
+from src.config import CRS
+from src.stats import CommuneUnions, COMMUNE_UNIONS, YearProfile, commune_geometry_table, compute_statistics
+from src.synthetic import synthetic_communes
+
+CENTER = (841650.0, 6517765.0)
+RADII = [2_500.0, 5_000.0, 10_000.0, 12_345.0, 20_000.0, 25_000.0, 40_000.0]
+TEMPORAL = ["population", "density_pop_km2", "number_ware", "number_ware_per_popM",
+            "number_ware_per_1000km2", "avg_size_ware", "gravity"]
+
+
+def _communes(seed: int = 0) -> gpd.GeoDataFrame:
+    communes = synthetic_communes(np.random.default_rng(seed), n_communes=120, center=CENTER)
+    # une commune (ancien découpage) qui recouvre ses voisines : l'union n'est plus une somme d'aires
+    overlap = gpd.GeoDataFrame({"ID": ["COMMUNE_OVERLAP"], "NOM": ["Overlap"], "POPULATION": [1_000]},
+                               geometry=[Point(CENTER[0] + 6_000, CENTER[1]).buffer(3_000)], crs=CRS)
+    communes = pd.concat([communes, overlap], ignore_index=True)
+    communes["dist_centre"] = shapely.distance(communes.geometry.values, Point(CENTER))
+    return communes.rename({"POPULATION": "POPUL"}, axis=1)
+
+
+def _warehouses(seed: int = 0, n: int = 200) -> gpd.GeoDataFrame:
+    rng = np.random.default_rng(seed)
+    dist, angle = rng.uniform(0, 30_000, n), rng.uniform(0, 2 * np.pi, n)
+    x, y = CENTER[0] + dist * np.cos(angle), CENTER[1] + dist * np.sin(angle)
+    side = rng.uniform(30, 400, n)
+    ids = [f"BATIMENT{i:06d}" for i in range(n)]
+    # bâtiments apparaissant sur plusieurs lignes (plusieurs couches d'entrée) : nunique(ID) != lignes
+    ids[1], ids[3] = ids[0], ids[2]
+    return gpd.GeoDataFrame({"ID": ids, "seuil": dist}, geometry=box(x, y, x + side, y + side), crs=CRS)
+
+
+def _expected(communes, warehouses, r):
+    com = communes[communes["dist_centre"] <= r].drop(columns="dist_centre")
+    wh = warehouses[warehouses["seuil"] <= r]
+    stats = compute_statistics(wh, wh, com, com, name="test", period=("2013", "2023"))
+    row = {c: stats[f"{c}_t1"] for c in TEMPORAL}
+    row.update(area=stats["area"], number_mun=stats["number_mun"], union_area=com.dissolve().area.iloc[0])
+    return row
+
+
+@pytest.fixture(scope="module")
+def layers():
+    return _communes(), _warehouses()
+
+
+def test_statistics_match_compute_statistics(layers):
+    communes, warehouses = layers
+    profile = YearProfile(communes, communes["dist_centre"].values, warehouses)
+    stats = profile.statistics(RADII)
+    for r in RADII:
+        expected = _expected(communes, warehouses, r)
+        row = stats.loc[r]
+        assert row["number_ware"] == expected["number_ware"]
+        assert row["number_mun"] == expected["number_mun"]
+        assert row["population"] == expected["population"]
+        # arrondis à 0.01 / 0.1 : une différence d'ordre de sommation peut changer le dernier chiffre
+        for c in ["density_pop_km2", "avg_size_ware", "gravity", "number_ware_per_popM"]:
+            assert row[c] == pytest.approx(expected[c], abs=0.011), (r, c)
+        assert row["area"] == pytest.approx(expected["area"], abs=0.11)
+        assert row["number_ware_per_1000km2"] == pytest.approx(expected["number_ware_per_1000km2"], rel=1e-9)
+        # aire de l'union cumulée : celle du dissolve
+        n = int(row["number_mun"])
+        assert profile.communes["union_area"].values[n - 1] == pytest.approx(expected["union_area"], rel=1e-9)
+
+
+def test_statistics_memoised_in_any_order(layers):
+    communes, warehouses = layers
+    profile = YearProfile(communes, communes["dist_centre"].values, warehouses)
+    forward = profile.statistics(RADII)
+    backward = YearProfile(communes, communes["dist_centre"].values, warehouses).statistics(RADII[::-1])
+    pd.testing.assert_frame_equal(forward, backward.loc[RADII])
+    pd.testing.assert_frame_equal(profile.statistics(RADII[2:4]), forward.loc[RADII[2:4]])
+
+
+def test_commune_geometry_table_union_area(layers):
+    communes, _ = layers
+    table = commune_geometry_table(communes)
+    for n in [1, 10, 50, len(table)]:
+        expected = shapely.union_all(table.geometry.values[:n]).area
+        assert table["union_area"].values[n - 1] == pytest.approx(expected, rel=1e-9)
+
+
+def test_commune_unions_match_dissolve(layers):
+    communes, _ = layers
+    for r in RADII:
+        com = communes[communes["dist_centre"] <= r]
+        assert COMMUNE_UNIONS.union_area(com) == pytest.approx(com.dissolve().area.iloc[0], rel=1e-9)
+
+
+def test_commune_unions_lru_eviction(layers):
+    communes, _ = layers
+    ordered = communes.sort_values("dist_centre")
+    subsets = [ordered.iloc[:n] for n in (10, 20, 40, 80)]
+    other = [communes.sample(15, random_state=s) for s in range(3)]
+    unions = CommuneUnions(max_entries=2)
+
+    unions.union_area(subsets[0])
+    unions.union_area(subsets[1])
+    # deux ensembles sans rapport évincent les unions dont partent les rayons suivants
+    for o in other[:2]:
+        unions.union_area(o)
+    assert len(unions._unions) == 2
+    assert frozenset(zip(subsets[1]["ID"], np.round(subsets[1].area, 3))) not in unions._unions
+
+    for subset in subsets[2:] + subsets[:2] + other:
+        assert unions.union_area(subset) == pytest.approx(subset.dissolve().area.iloc[0], rel=1e-9)
+        assert len(unions._unions) <= 2
+
+
+@pytest.mark.parametrize("max_side", [400, 6_000])
+def test_bootstrap_brackets_point_estimate(layers, max_side):
+    # grands polygones devant le rayon : la gravité des polygones s'écarte de celle des centroïdes
+    communes, _ = layers
+    warehouses = _warehouses(seed=1)
+    rng = np.random.default_rng(2)
+    x, y = warehouses.geometry.bounds["minx"].values, warehouses.geometry.bounds["miny"].values
+    side = rng.uniform(30, max_side, len(x))
+    warehouses = warehouses.set_geometry(box(x, y, x + side, y + side))
+
+    profile = YearProfile(communes, communes["dist_centre"].values, warehouses)
+    radii = RADII[1:]
+    point = profile.statistics(radii)
+    boot = profile.bootstrap(radii, n_boot=1000, seed=0)
+    for stat in ["gravity", "number_ware_per_1000km2"]:
+        low, high = np.nanpercentile(boot[stat], [2.5, 97.5], axis=1)
+        estimate = point[stat].values
+        assert np.all((low <= estimate + 0.01) & (estimate - 0.01 <= high)), stat
+
+
+def test_bootstrap_density_weights_unique_ids(layers):
+    # deux lignes par bâtiment : le nombre rééchantillonné reste centré sur nunique(ID), pas sur le nombre de lignes
+    communes, warehouses = layers
+    doubled = pd.concat([warehouses, warehouses], ignore_index=True)
+    profile = YearProfile(communes, communes["dist_centre"].values, doubled)
+    radii = [25_000.0]
+    boot = profile.bootstrap(radii, n_boot=2000, seed=0)
+    # même unité que temporal_based_statistics : n / (aire en m² / 1000)
+    area = profile.communes["union_area"].values[profile.statistics(radii)["number_mun"].iloc[0] - 1]
+    count = boot["number_ware_per_1000km2"][0] * area / 1000
+    n_wh = profile.statistics(radii)["number_ware"].iloc[0]
+    assert count.mean() == pytest.approx(n_wh, rel=3 / np.sqrt(n_wh * 2000) + 0.01)
+    assert profile.statistics(radii)["gravity"].iloc[0] == pytest.approx(np.median(boot["gravity"][0]), abs=0.2)
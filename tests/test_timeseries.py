@@ -0,0 +1,96 @@
+"""
+TimeSeriesEngine.sweep (ouvertures / fermetures appliquées de date en date) sur quelques périodes choisies :
+période inversée (dateFin < dateDebut), bâtiments partageant un ID ; millésime le plus proche de chaque pas
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+gpd = pytest.importorskip("geopandas")
+from shapely import box
+
+from src.config import CRS, GeosirenFPath, SirenFPath
+from src.stats import temporal_based_statistics
+from src.timeseries import TimeSeriesEngine, nearest_vintages
+from src.traitements import bati_indus_file, communes_file
+from src.utils import check_dir, write_layer
+
+ROI = "timeseries_test"
+YEAR = "2023"
+CENTER = (841650.0, 6517765.0)
+DATES = pd.date_range("2010-01-01", "2020-01-01", freq="YS")
+
+
+def communes_t() -> gpd.GeoDataFrame:
+    cx, cy = CENTER
+    return gpd.GeoDataFrame({"ID": ["COMMUNE_0001"], "POPUL": [500_000]},
+                            geometry=[box(cx - 30_000, cy - 30_000, cx + 30_000, cy + 30_000)], crs=CRS)
+
+
+def _dataset():
+    cx, cy = CENTER
+    communes = communes_t().rename({"POPUL": "POPULATION"}, axis=1)
+    # b0 et b2 : deux géométries du même bâtiment (même ID)
+    corners = [(cx + 1_000, cy), (cx + 5_000, cy), (cx, cy + 8_000)]
+    bati = gpd.GeoDataFrame({"ID": ["BATIMENT000000", "BATIMENT000001", "BATIMENT000000"],
+                             "NATURE": "Industriel, agricole ou commercial"},
+                            geometry=[box(x, y, x + 100, y + 100) for x, y in corners], crs=CRS)
+    check_dir(os.path.dirname(communes_file(ROI, YEAR)))
+    write_layer(communes, communes_file(ROI, YEAR), index=False)
+    write_layer(bati, bati_indus_file(ROI, YEAR), index=False)
+
+    periods = [
+        # (siret, dateDebut, dateFin, bâtiment)
+        (20**12 + 0, "2000-01-01", "", 0),
+        (20**12 + 1, "2012-06-01", "2016-06-01", 1),
+        # période inversée sur le même bâtiment : active à aucune date, ne doit pas fermer b1 en 2015
+        (20**12 + 2, "2018-06-01", "2014-06-01", 1),
+        (20**12 + 3, "2000-01-01", "", 2),
+    ]
+    siret, debut, fin, building = zip(*periods)
+    check_dir(os.path.dirname(SirenFPath))
+    pd.DataFrame({
+        "siret": siret,
+        "dateDebut": debut,
+        "dateFin": fin,
+        "etatAdministratifEtablissement": "A",
+        "activitePrincipaleEtablissement": "52.10B",
+        "nomenclatureActivitePrincipaleEtablissement": "NAFRev2",
+    }).to_csv(SirenFPath, index=False)
+    x = np.array([corners[b][0] + 50 for b in building])
+    y = np.array([corners[b][1] + 50 for b in building])
+    pd.DataFrame({"siret": siret, "x": x, "y": y, "epsg": CRS}).to_csv(GeosirenFPath, sep=";", index=False)
+
+
+@pytest.fixture(scope="module")
+def sweep():
+    _dataset()
+    engine = TimeSeriesEngine(CENTER, ROI, str(DATES[0].date()), str(DATES[-1].date()), bdtopo_year=YEAR)
+    return engine.sweep(DATES, radius_list=[25_000]).set_index("date")
+
+
+def test_inverted_period_never_closes(sweep):
+    b1_active = (DATES >= "2013-01-01") & (DATES <= "2016-01-01")
+    # avant le correctif (opens >= closes compté) : b1 fermé en 2015 et 2016 par la période inversée
+    assert sweep["number_ware"].tolist() == list(np.where(b1_active, 2, 1))
+    assert sweep["avg_size_ware"].tolist() == [10_000.0] * len(DATES)
+
+
+def test_number_ware_counts_unique_ids(sweep):
+    # b0 et b2 (même ID) actifs à toutes les dates : un entrepôt, deux géométries pour la gravité
+    row = sweep.loc[DATES[0].date()]
+    assert row["number_ware"] == 1
+    geoms = [box(CENTER[0] + 1_000, CENTER[1], CENTER[0] + 1_100, CENTER[1] + 100),
+             box(CENTER[0], CENTER[1] + 8_000, CENTER[0] + 100, CENTER[1] + 8_100)]
+    wh = gpd.GeoDataFrame({"ID": ["BATIMENT000000"] * 2}, geometry=geoms, crs=CRS)
+    stats = temporal_based_statistics(wh, communes_t(), "t")
+    assert row["gravity"] == stats["gravity_t"]
+    assert row["number_ware_per_1000km2"] == pytest.approx(stats["number_ware_per_1000km2_t"])
+    assert row["number_ware_per_popM"] == stats["number_ware_per_popM_t"]
+
+
+def test_nearest_vintages():
+    dates = pd.DatetimeIndex(["2008-01-01", "2010-06-01", "2011-01-01", "2018-01-01", "2019-01-01", "2030-01-01"])
+    assert nearest_vintages(dates, ["2008", "2013", "2023"]).tolist() == ["2008", "2008", "2013", "2013", "2023", "2023"]